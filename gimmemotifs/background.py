@@ -14,22 +14,25 @@ similar genomic distribution as the input.
 from __future__ import division
 
 # Python imports
+import fcntl
 import gzip
+import hashlib
+import json
 import os
 import random
-import re
 import sys
+import time
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
-from random import choice
 
 # External imports
 import numpy as np
-import pybedtools
 from genomepy import Genome
 
 # GimmeMotifs imports
-from gimmemotifs import mytmpdir
+from gimmemotifs.config import CACHE_DIR
 from gimmemotifs.fasta import Fasta
+from gimmemotifs.genome_index import regions_to_fasta
 
 def create_random_genomic_bedfile(out, genome, length, n):
     features = Genome(genome).get_random_sequences(n, length)
@@ -40,7 +43,25 @@ def create_random_genomic_bedfile(out, genome, length, n):
         tmp.write("%s\t%d\t%d\n" % (chrom, start, end))
     tmp.flush()    
 
-def create_promoter_bedfile(out, genefile, length, n):
+@contextmanager
+def _seeded_random(seed=None):
+    """Seed the random module, restore the previous state on exit.
+
+    This is used for functions that use the global random state, such as
+    Genome.get_random_sequences().
+    """
+    if seed is None:
+        yield
+        return
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+def _promoter_regions(genefile, length, n, seed=None):
+    """Return n random promoter regions as (chrom, start, end, strand)."""
     strand_map = {"+":True, "-":False, 1:True, -1:False, "1":True, "-1":False}
 
     features = []
@@ -62,14 +83,20 @@ def create_promoter_bedfile(out, genefile, length, n):
     fin.close()
     
     if n < len(features):
-        features = random.sample(features, n)
+        features = random.Random(seed).sample(features, n)
     else:
         sys.stdout.write("Too few promoters to generate %s random promoters! Just using all of them." % n)
 
+    return [(chrom, start, end, {True:"+",False:"-"}[strand]) 
+            for chrom, start, end, strand in sorted(features, key=lambda x: x[0])]
+
+def create_promoter_bedfile(out, genefile, length, n):
+    features = _promoter_regions(genefile, length, n)
+
     # Write result to temporary bedfile
     tmp = open(out, "w")
-    for chrom, start, end, strand in sorted(features, key=lambda x: x[0]):
-        tmp.write("%s\t%s\t%s\t0\t0\t%s\n" % (chrom, start, end, {True:"+",False:"-"}[strand]))
+    for chrom, start, end, strand in features:
+        tmp.write("%s\t%s\t%s\t0\t0\t%s\n" % (chrom, start, end, strand))
     tmp.flush()
 
 class MarkovFasta(Fasta):
@@ -82,7 +109,10 @@ class MarkovFasta(Fasta):
     Optional arg 'length' can be used to generate sequences of a different length
     Optional arg 'n' specifies the number of sequences to generate
     Optional arg 'k' specifies the order of the Markov model, default is 1 for 1st
-    order
+    order (up to 30 is supported). Up to 5 the model contains all k-mers, for 
+    higher orders only the k-mers that occur in the input sequences. Other 
+    k-mers are followed by a random nucleotide.
+    Optional arg 'seed' can be used to get reproducible sequences
 
     Returns a Fasta object
     
@@ -95,8 +125,15 @@ class MarkovFasta(Fasta):
     
     """
     
-    def __init__(self, fasta, length=None, n=None, k=1, matrix_only=False):
+    alphabet = "ACGT"
+    # highest order for which the model contains all k-mers
+    dense_max_k = 5
+
+    def __init__(self, fasta, length=None, n=None, k=1, matrix_only=False, seed=None):
+        if k < 1 or k > 30:
+            raise ValueError("order of the Markov model should be 1-30")
         self.k = k
+        self.random_state = np.random.RandomState(seed)
 
         # Initialize super Fasta object
         Fasta.__init__(self)
@@ -107,162 +144,546 @@ class MarkovFasta(Fasta):
         if matrix_only:
             return
         
-        c = 0
         if not n:
             n = len(fasta)
 
-        while len(self) < n:
-            seq = choice(fasta.seqs)
+        if length:
+            lengths = np.ones(n, dtype=int) * length
+        else:
+            # empty input sequences are skipped
+            seq_lengths = np.array([len(seq) for seq in fasta.seqs], dtype=int)
+            seq_lengths = seq_lengths[seq_lengths > 0]
+            if len(seq_lengths) == 0:
+                raise ValueError("all input sequences are empty")
+            lengths = self.random_state.choice(seq_lengths, n)
+        
+        for c, random_seq in enumerate(self._generate_sequences(lengths)):
             name = "random_Markov%s_%s" % (k,c)
-            if length:
-                random_seq = self._generate_sequence(length)
-            else:
-                random_seq = self._generate_sequence(len(seq))
             self.add(name, random_seq)    
-            c += 1
-
-    def _initialize_matrices(self, seqs, k=1, alphabet=None):
-        if alphabet is None:
-            alphabet = ['A','C','G','T']
 
-        self.frequencies = {}
-        kmercount = {}
-        
-        init = alphabet[:]
-        for i in range(k - 1):
-            new_init = []
-            for x in init:
-                for l in alphabet:
-                    new_init.append(x + l)
-            init = new_init[:]
-
-        self.trans = dict([(word, dict([(l, 0.0) for l in alphabet])) for word in init])
-        new_init = []
-        for x in init:
-            for l in alphabet:
-                new_init.append(x + l)
-        
-        kmercount = dict([(word, 0) for word in new_init])
-        lettercount =  dict([(word[:k], 0) for word in new_init])
-        p = re.compile("^[%s]+$" % "".join(alphabet))
-        total = 0
+    def _encode(self, seq):
+        """Encode a sequence as integers, A=0, C=1, G=2, T=3 and other=4."""
+        table = np.full(256, 4, dtype=np.uint8)
+        for i, l in enumerate(self.alphabet):
+            table[ord(l)] = i
+            table[ord(l.lower())] = i
+        return table[np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)]
+
+    def _decode(self, state, k):
+        """Return the k-mer of a state index."""
+        return "".join(self.alphabet[state // 4 ** (k - i - 1) % 4] 
+                for i in range(k))
+
+    def _initialize_matrices(self, seqs, k=1):
+        weights = 4 ** np.arange(k, -1, -1, dtype=np.int64)
+        kmers = [np.zeros(0, dtype=np.int64)]
         for seq in seqs:
-            seq = seq.upper()
-            for i in range(len(seq) - k):
-                if p.search(seq[i:i + k + 1]):
-                    lettercount[seq[i:i + k]] += 1
-                    kmercount[seq[i:i + k + 1]] += 1
-                    total += 1
+            codes = self._encode(seq)
+            if len(codes) <= k:
+                continue
+            # all k+1-mers as rows of a strided view
+            windows = np.lib.stride_tricks.as_strided(codes, 
+                    shape=(len(codes) - k, k + 1), 
+                    strides=(codes.strides[0], codes.strides[0]))
+            valid = (windows < 4).all(1)
+            kmers.append(windows[valid].astype(np.int64).dot(weights))
+        kmers = np.hstack(kmers)
+        if len(kmers) == 0:
+            raise ValueError(
+                    "input sequences contain no {}-mers".format(k + 1))
         
-        for k,v in kmercount.items():
-            self.trans[k[:-1]][k[-1]] = float(v)
+        if k <= self.dense_max_k:
+            # all k-mers
+            self.states = np.arange(4 ** k, dtype=np.int64)
+            counts = np.bincount(kmers, minlength=4 ** (k + 1)).astype(float)
+        else:
+            # only the k-mers that occur, in sorted order
+            kmers, kmer_counts = np.unique(kmers, return_counts=True)
+            self.states, state_idx = np.unique(kmers // 4, return_inverse=True)
+            counts = np.zeros(len(self.states) * 4)
+            counts[state_idx * 4 + kmers % 4] = kmer_counts
         
-        for k,v in self.trans.items():
-            s = np.sum(np.array(list(v.values())))
-            for x,y in v.items():
-                v[x] = y / s
+        # transition probabilities for every k-mer
+        counts = counts.reshape(-1, 4)
+        lettercount = counts.sum(1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.trans_matrix = counts / lettercount[:, None]
+        # k-mers that were not seen get uniform transition probabilities
+        self.trans_matrix[lettercount == 0] = 0.25
+        self.init_prob = lettercount / lettercount.sum()
+
+        words = [self._decode(state, k) for state in self.states]
+        self.trans = dict([(word, dict(zip(self.alphabet, row))) 
+            for word, row in zip(words, self.trans_matrix)])
+        self.init = dict(zip(words, self.init_prob))
+        self.frequencies = {}
+            
+    def _generate_sequences(self, lengths):
+        """Generate sequences of the specified lengths.
+
+        All sequences of the same length are generated at once.
+        """
+        k = self.k
+        n_words = 4 ** k
+        rng = self.random_state
+        states = self.states
+        cum_init = np.cumsum(self.init_prob)
+        # the last row is used for k-mers that are not in the model
+        cum_trans = np.vstack((np.cumsum(self.trans_matrix, 1), 
+            [0.25, 0.5, 0.75, 1.0]))
+        letters = np.array(list(self.alphabet), dtype="S1")
         
-        self.init = {}
-        total = float(np.sum(np.array(list(lettercount.values()))))
-        for k,v in lettercount.items():
-            self.init[k] = v / total
+        lengths = np.asarray(lengths, dtype=int)
+        result = [None] * len(lengths)
+        for length in np.unique(lengths):
+            idx = np.nonzero(lengths == length)[0]
+            if length <= 0:
+                for i in idx:
+                    result[i] = ""
+                continue
             
+            n = len(idx)
+            codes = np.zeros((n, max(length, k)), dtype=np.uint8)
+            
+            # first k nucleotides
+            state = states[np.minimum(np.searchsorted(cum_init, 
+                rng.random_sample(n), side="right"), len(states) - 1)]
+            for i in range(k):
+                codes[:, i] = state // 4 ** (k - i - 1) % 4
+            
+            # all other nucleotides, according to the transition matrix
+            for i in range(k, length):
+                row = np.minimum(np.searchsorted(states, state), len(states) - 1)
+                row[states[row] != state] = len(states)
+                r = rng.random_sample(n)[:, None]
+                nuc = np.minimum((r >= cum_trans[row]).sum(1), 3)
+                codes[:, i] = nuc
+                state = (state * 4 + nuc) % n_words
+           
+            seqs = letters[codes[:, :length]].view("S{}".format(length)).flatten()
+            for i, seq in zip(idx, seqs):
+                result[i] = seq.decode()
+        return result
+
     def _generate_sequence(self, l):
-        sequence = list(self._weighted_random(list(self.init.items())))
-        for _ in range(l - self.k):
-            sequence.append(
-                    self._weighted_random(
-                        list(self.trans["".join(sequence[-self.k:])].items())
-                        ))
-        return "".join(sequence)
-
-    def _weighted_random(self, l):
-        n = random.uniform(0,1)
-        item = None
-        for item, weight in l:
-            if n < weight:
-                break    
-            else:
-                n -= weight
-        return item
+        return self._generate_sequences([l])[0]
+
+def _gc_index_file(genome_fa, length, step):
+    """Return the name of the cached GC index for a genome FASTA file.
+
+    The size and modification time of the FASTA file are part of the name, 
+    so the index is recreated if the genome changes.
+    """
+    st = os.stat(genome_fa)
+    key = "{}|{}|{}".format(os.path.abspath(genome_fa), st.st_size, int(st.st_mtime))
+    checksum = hashlib.md5(key.encode()).hexdigest()[:12]
+    return os.path.join(
+            CACHE_DIR, 
+            "gc_index", 
+            "{}.{}.{}.{}.npz".format(os.path.basename(genome_fa), checksum, length, step)
+            )
+
+def _default_gc_step(length):
+    """Return the default step of the GC window index.
+
+    This is the largest divisor of the length of at most a quarter of the 
+    length, so windows can start at many positions. If there is no divisor
+    between an eighth and a quarter of the length, the step is the length.
+    """
+    for step in range(max(length // 4, 1), max(length // 8, 1) - 1, -1):
+        if length % step == 0:
+            return step
+    return length
+
+def gc_window_index(genome, length=200, step=None):
+    """Return the GC and N content of all genomic windows of a specific length.
 
-def matched_gc_bedfile(bedfile, matchfile, genome, number):
-    N_FRACTION = 0.1
+    The index is created once per genome, window length and step, and is 
+    cached in the GimmeMotifs cache directory.
+
+    Parameters
+    ----------
+    genome : str
+        Genome name or FASTA file.
+    
+    length : int, optional
+        Window length, default is 200.
+
+    step : int, optional
+        Distance between the start of consecutive windows. The length should
+        be a multiple of the step. By default the step is about a quarter of
+        the length, i.e. overlapping windows.
+
+    Returns
+    -------
+    index : dict
+        Dictionary with the chromosome names ('chroms'), the number of windows
+        per chromosome ('counts'), and the G+C count ('gc') and N count ('n')
+        of every window. 
+    """
+    length = int(length)
+    if step is None:
+        step = _default_gc_step(length)
+    step = int(step)
+    if step <= 0 or length % step != 0:
+        raise ValueError("window length should be a multiple of the step")
     
     g = Genome(genome)
-    genome_fa = g.filename
+    fname = _gc_index_file(g.filename, length, step)
+    if os.path.exists(fname):
+        with np.load(fname) as f:
+            return dict((k, f[k]) for k in f.files)
+
+    # lookup tables for G+C and non-ACGT
+    is_gc = np.zeros(256, dtype=np.uint8)
+    is_n = np.ones(256, dtype=np.uint8)
+    for l in "ACGTacgt":
+        is_n[ord(l)] = 0
+    for l in "CGcg":
+        is_gc[ord(l)] = 1
+    
+    nblocks = length // step
+    # the counts fit in a byte for the usual window lengths
+    if length < 2 ** 8:
+        dtype = np.uint8
+    elif length < 2 ** 16:
+        dtype = np.uint16
+    else:
+        dtype = np.uint32
+    chroms, counts, gc, n = [], [], [], []
+    for chrom in g.keys():
+        seq = np.frombuffer(g[chrom][:].seq.encode("ascii", "replace"), dtype=np.uint8)
+        nwin = (len(seq) - length) // step + 1
+        if nwin <= 0:
+            continue
+        
+        # counts per block of 'step' nucleotides, which are summed per window
+        seq = seq[:(nwin + nblocks - 1) * step].reshape(-1, step)
+        for table, result in [(is_gc, gc), (is_n, n)]:
+            blocks = np.zeros(len(seq) + 1, dtype=np.int64)
+            blocks[1:] = np.cumsum(table[seq].sum(1, dtype=np.int64))
+            result.append(
+                    (blocks[nblocks:] - blocks[:-nblocks]).astype(dtype)
+                    )
+        chroms.append(chrom)
+        counts.append(nwin)
+    
+    index = {
+            "chroms": np.array(chroms),
+            "counts": np.array(counts, dtype=np.int64),
+            "gc": np.hstack(gc) if gc else np.zeros(0, dtype=dtype),
+            "n": np.hstack(n) if n else np.zeros(0, dtype=dtype),
+            "length": np.array(length),
+            "step": np.array(step),
+            }
+
+    # write to a temporary file first, so parallel runs don't read a partial index
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp = NamedTemporaryFile(dir=dirname, suffix=".npz", delete=False).name
+    np.savez(tmp, **index)
+    os.rename(tmp, fname)
+    
+    return index
+
+def _gc_bin_counts(gc_hist, number):
+    """Scale GC histogram counts to a total number of sequences."""
+    norm = number * gc_hist / (float(sum(gc_hist))) + 0.5
+    inorm = norm.astype(np.int)
+
+    s = np.argsort(norm - inorm)
+    while sum(inorm) > number:
+        if inorm[np.argmin(s)] > 0:
+            inorm[np.argmin(s)] -= 1
+        s[np.argmin(s)] = len(s)
+    while sum(inorm) < number:
+        inorm[np.argmax(s)] += 1
+        s[np.argmax(s)] = 0
+    return inorm
+
+def _input_composition(matchfile, genome=None):
+    """Return the GC fraction, N fraction and length of the input sequences.
+
+    Parameters
+    ----------
+    matchfile : str
+        Input file in FASTA or BED format.
+
+    genome : str, optional
+        Genome name or FASTA file, needed for BED input.
+
+    Returns
+    -------
+    gc, n, lengths : tuple of numpy.ndarray
+        GC fraction, fraction of non-ACGT nucleotides and length of every 
+        sequence.
+    """
     try:
         fa = Fasta(matchfile)
-        gc = [(seq.upper().count("C") + seq.upper().count("G")) / len(seq) for seq in fa.seqs]
-        lengths = [len(seq) for seq in fa.seqs]
     except Exception:
         try:
-            # pylint: disable=unexpected-keyword-arg
-            bed = pybedtools.BedTool(matchfile)
-            gc = [float(x[4]) for x in bed.nucleotide_content(fi=genome_fa)]
-            lengths = [x.length for x in bed]
+            fa = regions_to_fasta(genome, matchfile)
         except:
             sys.stderr.write("Please provide input file in BED or FASTA format\n")
             raise
-    gc_hist,bins = np.histogram(gc, range=(0,1), bins=20)
     
-    length = np.median(lengths)
-    if np.std(lengths) > length * 0.05:
-        sys.stderr.write("Sequences do not seem to be of equal length.\n")
-        sys.stderr.write("GC% matched sequences of the median length ({}) will be created\n".format(length))
-
-    if number:
-        norm = number * gc_hist / (float(sum(gc_hist))) + 0.5
-        inorm = norm.astype(np.int)
-
-        s = np.argsort(norm - inorm)
-        while sum(inorm) > number:
-            if inorm[np.argmin(s)] > 0:
-                inorm[np.argmin(s)] -= 1
-            s[np.argmin(s)] = len(s)
-        while sum(inorm) < number:
-            inorm[np.argmax(s)] += 1
-            s[np.argmax(s)] = 0
-        gc_hist = inorm
-
-    rnd = pybedtools.BedTool()
-    out = open(bedfile, "w")
-    #sys.stderr.write("Generating sequences\n")
-    #sys.stderr.write("{}\n".format(number))
+    seqs = [seq.upper() for seq in fa.seqs]
+    lengths = np.array([len(seq) for seq in seqs])
+    # empty sequences count as 0% GC and no Ns
+    div = np.maximum(lengths, 1).astype(float)
+    gc = np.array([seq.count("C") + seq.count("G") for seq in seqs]) / div
+    acgt = np.array([sum(seq.count(l) for l in "ACGT") for seq in seqs])
+    n = (lengths - acgt) / div
+    return gc, n, lengths
+
+def _n_bins(n, n_fraction, n_bins):
+    """Return the N content bin of N fractions.
+
+    The first bin contains sequences without Ns, the other bins divide the
+    N fractions up to n_fraction in equal parts. Larger N fractions are 
+    assigned to the last bin.
+    """
+    n = np.asarray(n, dtype=float)
+    if n_fraction <= 0 or n_bins < 2:
+        return np.zeros(len(n), dtype=int)
+    idx = np.ceil(n / n_fraction * (n_bins - 1) - 1e-9).astype(int)
+    return np.clip(idx, 0, n_bins - 1)
+
+def composition_bins(gc, n, bins=20, n_fraction=0.1, n_bins=5):
+    """Return the combined GC% and N content bin of sequences.
+
+    Parameters
+    ----------
+    gc : array_like
+        GC fraction of every sequence.
+
+    n : array_like
+        N fraction of every sequence.
+
+    bins : int, optional
+        Number of GC% bins, default is 20.
+
+    n_fraction : float, optional
+        Maximum N fraction, default is 0.1.
+
+    n_bins : int, optional
+        Number of N content bins, default is 5.
+
+    Returns
+    -------
+    numpy.ndarray
+        Bin of every sequence, gc_bin * n_bins + n_bin.
+    """
+    # same bins as np.histogram(gc, bins=bins, range=(0, 1))
+    gc_bin = np.digitize(gc, np.linspace(0, 1, bins + 1)[1:-1])
+    return gc_bin * n_bins + _n_bins(n, n_fraction, n_bins)
+
+def gc_histogram(matchfile, genome=None, bins=20):
+    """Return the GC% histogram of sequences in a FASTA or BED file.
+
+    Parameters
+    ----------
+    matchfile : str
+        Input file in FASTA or BED format.
+
+    genome : str, optional
+        Genome name or FASTA file, needed for BED input.
+
+    bins : int, optional
+        Number of GC% bins, default is 20.
+
+    Returns
+    -------
+    gc_hist : numpy.ndarray
+        Number of sequences per bin.
+
+    bin_edges : numpy.ndarray
+        Edges of the GC% bins.
+
+    lengths : list
+        Sequence lengths.
+
+    n : numpy.ndarray
+        Fraction of non-ACGT nucleotides of every sequence.
+    """
+    gc, n, lengths = _input_composition(matchfile, genome)
+    gc_hist, bin_edges = np.histogram(gc, range=(0,1), bins=bins)
+    return gc_hist, bin_edges, list(lengths), n
+
+def matched_gc_bedfile(bedfile, matchfile, genome, number, length=None, 
+        n_fraction=0.1, seed=None):
+    """Create a BED file with genomic regions matched for GC% to the input.
+
+    See `matched_gc_regions` for a description of the parameters, the 
+    regions are written to `bedfile`.
+    """
+    regions = matched_gc_regions(matchfile, genome, number, length=length,
+            n_fraction=n_fraction, seed=seed)
+    with open(bedfile, "w") as out:
+        for chrom, start, end in regions:
+            out.write("{}\t{}\t{}\n".format(chrom, start, end))
+
+def _length_classes(lengths, max_classes=5):
+    """Divide sequence lengths in classes of similar length.
+
+    Returns the class of every sequence and the window length of every 
+    class. Window lengths are rounded to a multiple of 10, so the GC
+    window indexes can be reused.
+    """
+    lengths = np.asarray(lengths)
+    edges = np.unique(np.percentile(lengths, np.linspace(0, 100, max_classes + 1)))
+    cls = np.clip(np.searchsorted(edges, lengths, side="right") - 1, 0, max(len(edges) - 2, 0))
+    
+    windows = {}
+    for c in np.unique(cls):
+        window = int(np.round(np.median(lengths[cls == c]) / 10.0)) * 10
+        windows.setdefault(max(window, 10), []).append(c)
     
-    # Create a file with chromosome sizes if it doesn't exist yet
-    genome_size = genome_fa + ".sizes"
-    del_size = False
-    if not os.path.exists(genome_size):
-        genome_size = NamedTemporaryFile().name
-        del_size = True
-        with open(genome_size, "w") as f:
-            for seqname in g.keys():
-                f.write("{}\t{}\n".format(seqname, len(g[seqname])))
-   
-    # pylint: disable=unexpected-keyword-arg
-    r = rnd.random(l=length, n=number * 30, g=genome_size).nucleotide_content(fi=genome_fa)
-    if del_size:
-        os.unlink(genome_size)
+    # classes with the same window length are merged
+    result = np.zeros(len(lengths), dtype=int)
+    window_lengths = sorted(windows)
+    for i, window in enumerate(window_lengths):
+        result[np.in1d(cls, windows[window])] = i
+    return result, window_lengths
+
+def matched_gc_regions(matchfile, genome, number, length=None, 
+        n_fraction=0.1, seed=None, bins=20, n_bins=5):
+    """Return genomic regions matched for GC%, N content and length.
+
+    Regions are randomly selected from a cached GC index of the genome 
+    (see `gc_window_index`) per combination of GC% bin and N content bin, in
+    the same proportions as the input sequences. Regions with more than 
+    n_fraction Ns are never selected.
     
-    features = [f[:3] + [float(f[7])] for f in r if float(f[12]) <= length * N_FRACTION]
-    gc = [f[3] for f in features]
+    If no length is specified and the input sequences differ in length, 
+    the length of the regions is drawn from the input lengths. The input 
+    sequences are divided in (at most 5) classes of similar length, and 
+    regions of every class are selected from windows of the median length of
+    that class, before the length is adjusted around the center of the 
+    window. The GC% and N content are therefore matched approximately 
+    for sequences of different length.
+
+    Parameters
+    ----------
+    matchfile : str
+        Input file in FASTA or BED format.
+
+    genome : str
+        Genome name or FASTA file.
+
+    number : int
+        Number of regions. If this is None, the number of input sequences
+        is used.
+
+    length : int, optional
+        Length of all regions. By default the lengths are matched to the 
+        input sequences.
+
+    n_fraction : float, optional
+        Maximum fraction of N nucleotides of a region, the default is 0.1.
+
+    seed : int, optional
+        Seed for the random number generator.
+
+    bins : int, optional
+        Number of GC% bins, default is 20.
+
+    n_bins : int, optional
+        Number of N content bins, the first bin contains sequences without
+        Ns. Default is 5.
+
+    Returns
+    -------
+    regions : list
+        List of (chrom, start, end) tuples.
+    """
+    gc, n, lengths = _input_composition(matchfile, genome)
+    if number is None:
+        number = len(lengths)
+    
+    if length is not None:
+        classes = np.zeros(len(lengths), dtype=int)
+        window_lengths = [int(length)]
+    elif np.std(lengths) <= np.median(lengths) * 0.05:
+        # (nearly) equal length, use the median length for all regions
+        length = int(np.median(lengths))
+        classes = np.zeros(len(lengths), dtype=int)
+        window_lengths = [length]
+    else:
+        classes, window_lengths = _length_classes(lengths)
+    
+    seq_bin = composition_bins(gc, n, bins, n_fraction, n_bins)
+    nbin = bins * n_bins
+    class_counts = _gc_bin_counts(np.bincount(classes, minlength=len(window_lengths)), number)
+
+    rng = np.random.RandomState(seed)
+    regions = []
+    for c, window in enumerate(window_lengths):
+        if class_counts[c] == 0:
+            continue
+        in_class = classes == c
+        counts = _gc_bin_counts(np.bincount(seq_bin[in_class], minlength=nbin), class_counts[c])
+
+        index = gc_window_index(genome, window)
+        step = int(index["step"])
+        
+        # combined bin of every window, windows with too many Ns are skipped
+        window_bin = composition_bins(
+                index["gc"] / float(window), index["n"] / float(window), 
+                bins, n_fraction, n_bins).astype(np.int16)
+        window_bin[index["n"] > window * n_fraction] = -1
+        
+        # windows sorted by bin, to select all windows of a bin at once
+        order = np.argsort(window_bin, kind="mergesort")
+        bounds = np.searchsorted(window_bin[order], np.arange(nbin + 1))
+        
+        selected, selected_bin = [], []
+        for b in np.nonzero(counts)[0]:
+            candidates = order[bounds[b]:bounds[b + 1]]
+            if len(candidates) > counts[b]:
+                candidates = rng.choice(candidates, counts[b], replace=False)
+            selected.append(candidates)
+            selected_bin.append(np.full(len(candidates), b))
+            
+            if counts[b] != len(candidates):
+                gc_bin, n_bin = divmod(b, n_bins)
+                sys.stderr.write("not enough random sequences found for {} <= GC < {}, N bin {} ({} instead of {})\n".format(
+                    gc_bin / float(bins), (gc_bin + 1) / float(bins), n_bin, len(candidates), counts[b]))
+        
+        if not selected:
+            continue
+        selected = np.hstack(selected)
+        selected_bin = np.hstack(selected_bin)
+        
+        # convert window index to genomic coordinates
+        offsets = np.hstack(([0], np.cumsum(index["counts"])))
+        chrom_idx = np.searchsorted(offsets, selected, side="right") - 1
+        starts = (selected - offsets[chrom_idx]) * step
+        ends = starts + window
+        
+        if length is None:
+            # draw the lengths from the input sequences of this class 
+            # with the same composition bin, or of the class otherwise
+            region_lengths = np.zeros(len(selected), dtype=int)
+            class_lengths = lengths[in_class]
+            class_bins = seq_bin[in_class]
+            for b in np.unique(selected_bin):
+                idx = selected_bin == b
+                pool = class_lengths[class_bins == b]
+                if len(pool) == 0:
+                    pool = class_lengths
+                region_lengths[idx] = rng.choice(pool, idx.sum())
+            
+            chrom_end = (index["counts"][chrom_idx] - 1) * step + window
+            starts = starts + (window - region_lengths) // 2
+            starts = np.clip(starts, 0, np.maximum(chrom_end - region_lengths, 0))
+            ends = np.minimum(starts + region_lengths, chrom_end)
+        
+        regions += [(str(chrom), int(start), int(end)) for chrom, start, end in 
+                zip(index["chroms"][chrom_idx], starts, ends)]
     
-    #sys.stderr.write("Done\n")
-    for bin_start, bin_end, count in zip(bins[:-1], bins[1:], gc_hist):
-        #sys.stderr.write("CG {}-{}\n".format(bin_start, bin_end))
-        if count > 0:
-            rcount = 0
-            for f in features:
-                if (f[3] >= bin_start and f[3] < bin_end):
-                    out.write("{}\t{}\t{}\n".format(*f[:3]))
-                    rcount += 1
-                    if rcount >= count:
-                        break
-
-            if count != rcount:
-                sys.stderr.write("not enough random sequences found for {} <= GC < {} ({} instead of {})\n".format(bin_start, bin_end, rcount, count))
-    out.close()
+    return sorted(regions)
 
 class MatchedGcFasta(Fasta):
     """ 
@@ -274,27 +695,21 @@ class MatchedGcFasta(Fasta):
     
     Optional arg 'number' specifies the number of sequences to generate, 
     default is the number of input sequences/
+    Optional arg 'length' specifies the length, by default the lengths are
+    matched to the input sequences
+    Optional arg 'seed' can be used to get reproducible sequences
 
     Returns a Fasta object
     
     """
-    def __init__(self, matchfile, genome="hg19", number=None):
-        # Create temporary files
-        tmpbed = NamedTemporaryFile(dir=mytmpdir()).name
-        tmpfasta = NamedTemporaryFile(dir=mytmpdir()).name
+    def __init__(self, matchfile, genome="hg19", number=None, length=None, seed=None):
+        # Coordinates of random sequences
+        regions = matched_gc_regions(matchfile, genome, number, length=length, seed=seed)
         
-        # Create bed-file with coordinates of random sequences
-        matched_gc_bedfile(tmpbed, matchfile, genome, number)
-        
-        # Convert track to fasta
-        Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta)
-
         # Initialize super Fasta object
-        Fasta.__init__(self, tmpfasta)
-
-        # Delete the temporary files
-        os.remove(tmpbed)
-        os.remove(tmpfasta)
+        Fasta.__init__(self)
+        fa = regions_to_fasta(genome, regions)
+        self.ids, self.seqs = fa.ids, fa.seqs
 
 class PromoterFasta(Fasta):
     """ 
@@ -306,29 +721,21 @@ class PromoterFasta(Fasta):
     columns including the strand information). 
     Required arg 'length' specifies the length 
     Required arg 'in' specifies the number of sequences to generate.
+    Optional arg 'seed' can be used to get reproducible sequences
 
     Returns a Fasta object
     
     """
-    def __init__(self, genefile, genome, length=None, n=None):
+    def __init__(self, genefile, genome, length=None, n=None, seed=None):
         length = int(length)
 
-        # Create temporary files
-        tmpbed = NamedTemporaryFile(dir=mytmpdir()).name
-        tmpfasta = NamedTemporaryFile(dir=mytmpdir()).name
-        
-        # Create bed-file with coordinates of random sequences
-        create_promoter_bedfile(tmpbed, genefile, length, n)
+        # Coordinates of random promoters
+        regions = _promoter_regions(genefile, length, n, seed=seed)
         
-        # Convert track to fasta
-        Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, stranded=True)
-
         # Initialize super Fasta object
-        Fasta.__init__(self, tmpfasta)
-
-        # Delete the temporary files
-        os.remove(tmpbed)
-        os.remove(tmpfasta)
+        Fasta.__init__(self)
+        fa = regions_to_fasta(genome, regions, stranded=True)
+        self.ids, self.seqs = fa.ids, fa.seqs
 
 class RandomGenomicFasta(Fasta):
     """ 
@@ -337,28 +744,256 @@ class RandomGenomicFasta(Fasta):
     columns including the strand information). 
     Required arg 'length' specifies the length 
     Required arg 'in' specifies the number of sequences to generate.
+    Optional arg 'seed' can be used to get reproducible sequences
 
     Returns a Fasta object
     
     """
-    def __init__(self, genome, length=None, n=None):
+    def __init__(self, genome, length=None, n=None, seed=None):
         length = int(length)
 
-        # Create temporary files
-        tmpbed = NamedTemporaryFile(dir=mytmpdir()).name
-        tmpfasta = NamedTemporaryFile(dir=mytmpdir()).name
+        # Coordinates of random sequences
+        with _seeded_random(seed):
+            regions = Genome(genome).get_random_sequences(n, length)
         
-        # Create bed-file with coordinates of random sequences
-        create_random_genomic_bedfile(tmpbed, genome, length, n)
-        
-        # Convert track to fasta
-        Genome(genome).track2fasta(tmpbed, fastafile=tmpfasta, stranded=True)
-
         # Initialize super Fasta object
-        Fasta.__init__(self, tmpfasta)
-
-        # Delete the temporary files
-        os.remove(tmpbed)
-        os.remove(tmpfasta)
-
-
+        Fasta.__init__(self)
+        fa = regions_to_fasta(genome, [tuple(r) for r in regions])
+        self.ids, self.seqs = fa.ids, fa.seqs
+
+class BackgroundCache(object):
+    """Registry of generated background sequences that is shared between runs.
+
+    Backgrounds are stored in the GimmeMotifs cache directory, with the 
+    sequences as compressed arrays. They are identified by genome, background 
+    type, sequence length, number of sequences, random seed, (for GC% 
+    matched backgrounds) the GC% histogram of the input and (for promoter
+    backgrounds) the gene file. The least recently used backgrounds are 
+    removed when the total size exceeds `max_size`. The index of the cache is
+    locked while it is updated, so the cache can be used by several processes
+    at the same time.
+    
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory to store the backgrounds. The default is a subdirectory of
+        the GimmeMotifs cache directory.
+
+    max_size : int, optional
+        Maximum total size of the cached backgrounds in bytes, default is 1 GB.
+
+    Examples
+    --------
+    >>> cache = BackgroundCache()
+    >>> fa = cache.get_or_create("genomic", "hg38", 200, 10000)
+    """
+    
+    def __init__(self, cache_dir=None, max_size=1e9):
+        if cache_dir is None:
+            cache_dir = os.path.join(CACHE_DIR, "backgrounds")
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(cache_dir, "index.json")
+    
+    @staticmethod
+    def key(genome, bg_type, length, n, seed=None, gc_hist=None, genefile=None):
+        """Return the cache key of a background."""
+        if gc_hist is not None:
+            gc_hist = [int(x) for x in gc_hist]
+        if genefile is not None:
+            # the gene file is identified by path, size and modification time
+            st = os.stat(genefile)
+            genefile = [os.path.abspath(genefile), st.st_size, st.st_mtime]
+        key = json.dumps([str(genome), bg_type, int(length), int(n), seed, gc_hist])
+        if genefile is not None:
+            key = json.dumps([key, genefile])
+        return hashlib.md5(key.encode()).hexdigest()
+    
+    @contextmanager
+    def _locked(self):
+        """Lock the index, for a read-modify-write of the index."""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(self.index_file + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    
+    def _read_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except ValueError:
+            # corrupt index, start again
+            return {}
+        
+    def _write_index(self, index):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = NamedTemporaryFile(mode="w", dir=self.cache_dir, delete=False)
+        json.dump(index, tmp, indent=1)
+        tmp.close()
+        os.rename(tmp.name, self.index_file)
+
+    def get(self, genome, bg_type, length, n, seed=None, gc_hist=None, 
+            genefile=None):
+        """Return a cached background as a Fasta object, or None if it is not 
+        in the cache.
+        """
+        key = self.key(genome, bg_type, length, n, seed, gc_hist, genefile)
+        index = self._read_index()
+        if key not in index:
+            return None
+        
+        fname = os.path.join(self.cache_dir, index[key]["file"])
+        try:
+            with np.load(fname) as data:
+                seqs = data["seqs"].tobytes()
+                ends = np.cumsum(data["lengths"])
+                names = data["names"]
+        except (IOError, KeyError, ValueError):
+            with self._locked():
+                index = self._read_index()
+                index.pop(key, None)
+                self._write_index(index)
+            return None
+
+        fa = Fasta()
+        start = 0
+        for name, end in zip(names, ends):
+            fa.add(str(name), seqs[start:end].decode())
+            start = end
+        
+        with self._locked():
+            index = self._read_index()
+            if key in index:
+                index[key]["last_used"] = time.time()
+                self._write_index(index)
+        return fa
+    
+    def set(self, fa, genome, bg_type, length, n, seed=None, gc_hist=None, 
+            genefile=None):
+        """Store a background Fasta object in the cache."""
+        key = self.key(genome, bg_type, length, n, seed, gc_hist, genefile)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        
+        fname = os.path.join(self.cache_dir, "{}.npz".format(key))
+        tmp = NamedTemporaryFile(dir=self.cache_dir, suffix=".npz", delete=False).name
+        np.savez_compressed(
+                tmp, 
+                seqs=np.frombuffer("".join(fa.seqs).encode(), dtype=np.uint8),
+                lengths=np.array([len(seq) for seq in fa.seqs], dtype=np.int64),
+                names=np.array(fa.ids),
+                )
+        os.rename(tmp, fname)
+        
+        with self._locked():
+            index = self._read_index()
+            index[key] = {
+                    "genome": str(genome),
+                    "type": bg_type,
+                    "length": int(length),
+                    "n": int(n),
+                    "seed": seed,
+                    "file": os.path.basename(fname),
+                    "size": os.path.getsize(fname),
+                    "last_used": time.time(),
+                    }
+            self._write_index(self._evict(index))
+
+    def _evict(self, index):
+        """Remove least recently used backgrounds above the maximum size."""
+        total = sum(entry["size"] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda x: x[1]["last_used"]):
+            if total <= self.max_size or len(index) == 1:
+                break
+            fname = os.path.join(self.cache_dir, entry["file"])
+            if os.path.exists(fname):
+                os.unlink(fname)
+            total -= entry["size"]
+            del index[key]
+        return index
+
+    def list(self):
+        """Return a list with the cached backgrounds, most recently used first."""
+        entries = [dict(entry, key=key) for key, entry in self._read_index().items()]
+        return sorted(entries, key=lambda x: x["last_used"], reverse=True)
+
+    def clear(self):
+        """Remove all cached backgrounds."""
+        with self._locked():
+            for entry in self._read_index().values():
+                fname = os.path.join(self.cache_dir, entry["file"])
+                if os.path.exists(fname):
+                    os.unlink(fname)
+            self._write_index({})
+
+    def get_or_create(self, bg_type, genome, length, n, seed=None, 
+            matchfile=None, genefile=None):
+        """Return a background from the cache, create it if needed.
+
+        Parameters
+        ----------
+        bg_type : str
+            Background type: 'genomic', 'gc' or 'promoter'.
+
+        genome : str
+            Genome name or FASTA file.
+
+        length : int
+            Length of the sequences.
+
+        n : int
+            Number of sequences.
+
+        seed : int, optional
+            Random seed to get a reproducible background. Backgrounds with a 
+            different seed are cached separately.
+
+        matchfile : str, optional
+            Input file in FASTA or BED format, required for GC% matched
+            backgrounds.
+
+        genefile : str, optional
+            BED file with genes, required for promoter backgrounds.
+
+        Returns
+        -------
+        fa : Fasta object
+            Background sequences.
+        """
+        length = int(length)
+        gc_hist = None
+        if bg_type == "gc":
+            if matchfile is None:
+                raise ValueError("need an input file for a GC% matched background")
+            # number of input sequences per GC% and N content bin
+            gc, n_frac, _ = _input_composition(matchfile, genome)
+            gc_hist = np.bincount(composition_bins(gc, n_frac), minlength=100)
+        elif bg_type == "promoter":
+            if genefile is None:
+                raise ValueError("need a gene file for a promoter background")
+        elif bg_type != "genomic":
+            raise ValueError("can't cache background of type {}".format(bg_type))
+        
+        if bg_type != "promoter":
+            genefile = None
+        
+        fa = self.get(genome, bg_type, length, n, seed, gc_hist, genefile)
+        if fa is not None:
+            return fa
+
+        if bg_type == "genomic":
+            fa = RandomGenomicFasta(genome, length, n, seed=seed)
+        elif bg_type == "gc":
+            fa = MatchedGcFasta(matchfile, genome, n, length=length, seed=seed)
+        else:
+            fa = PromoterFasta(genefile, genome, length, n, seed=seed)
+        
+        self.set(fa, genome, bg_type, length, n, seed, gc_hist, genefile)
+        return fa
@@ -118,103 +118,104 @@ def cluster_motifs(motifs, match="total", metric="wic", combine="mean", pval=Tru
     if type([]) != type(motifs):
         motifs = read_motifs(motifs, fmt="pwm")
     
-    mc = MotifComparer()
-
-    # Trim edges with low information content
-    if trim_edges:
-        for motif in motifs:
-            motif.trim(edge_ic_cutoff)
+    with MotifComparer() as mc:
+        # Trim edges with low information content
+        if trim_edges:
+            for motif in motifs:
+                motif.trim(edge_ic_cutoff)
     
-    # Make a MotifTree node for every motif
-    nodes = [MotifTree(m) for m in motifs]
+        # Make a MotifTree node for every motif
+        nodes = [MotifTree(m) for m in motifs]
     
-    # Determine all pairwise scores and maxscore per motif
-    scores = {}
-    motif_nodes = dict([(n.motif.id,n) for n in nodes])
-    motifs = [n.motif for n in nodes]
+        # Determine all pairwise scores and maxscore per motif
+        scores = {}
+        motif_nodes = dict([(n.motif.id,n) for n in nodes])
+        motifs = [n.motif for n in nodes]
     
-    if progress:
-        sys.stderr.write("Calculating initial scores\n")
-    result = mc.get_all_scores(motifs, motifs, match, metric, combine, pval, parallel=True, ncpus=ncpus)
+        if progress:
+            sys.stderr.write("Calculating initial scores\n")
+        result = mc.get_all_scores(motifs, motifs, match, metric, combine, pval, parallel=True, ncpus=ncpus)
     
-    for m1, other_motifs in result.items():
-        for m2, score in other_motifs.items():
-            if m1 == m2:
-                if pval:
-                    motif_nodes[m1].maxscore = 1 - score[0]
+        for m1, other_motifs in result.items():
+            for m2, score in other_motifs.items():
+                if m1 == m2:
+                    if pval:
+                        motif_nodes[m1].maxscore = 1 - score[0]
+                    else:
+                        motif_nodes[m1].maxscore = score[0]
                 else:
-                    motif_nodes[m1].maxscore = score[0]
-            else:
-                if pval:
-                    score = [1 - score[0]] + score[1:]
-                scores[(motif_nodes[m1],motif_nodes[m2])] = score
+                    if pval:
+                        score = [1 - score[0]] + score[1:]
+                    scores[(motif_nodes[m1],motif_nodes[m2])] = score
                
-    cluster_nodes = [node for node in nodes]
-    ave_count = 1
+        cluster_nodes = [node for node in nodes]
+        ave_count = 1
     
-    total = len(cluster_nodes)
-
-    while len(cluster_nodes) > 1:
-        l = sorted(scores.keys(), key=lambda x: scores[x][0])
-        i = -1
-        (n1, n2) = l[i]
-        while n1 not in cluster_nodes or n2 not in cluster_nodes:
-            i -= 1
-            (n1,n2) = l[i]
+        total = len(cluster_nodes)
+
+        while len(cluster_nodes) > 1:
+            l = sorted(scores.keys(), key=lambda x: scores[x][0])
+            i = -1
+            (n1, n2) = l[i]
+            while n1 not in cluster_nodes or n2 not in cluster_nodes:
+                i -= 1
+                (n1,n2) = l[i]
         
-        if len(n1.motif) > 0 and len(n2.motif) > 0:
-            (score, pos, orientation) = scores[(n1,n2)]
-            ave_motif = n1.motif.average_motifs(n2.motif, pos, orientation, include_bg=include_bg)
+            if len(n1.motif) > 0 and len(n2.motif) > 0:
+                (score, pos, orientation) = scores[(n1,n2)]
+                ave_motif = n1.motif.average_motifs(n2.motif, pos, orientation, include_bg=include_bg)
             
-            ave_motif.trim(edge_ic_cutoff)
+                ave_motif.trim(edge_ic_cutoff)
             
-            # Check if the motif is not empty
-            if len(ave_motif) == 0:
-                ave_motif = Motif([[0.25,0.25,0.25,0.25]])
+                # Check if the motif is not empty
+                if len(ave_motif) == 0:
+                    ave_motif = Motif([[0.25,0.25,0.25,0.25]])
 
-            ave_motif.id = "Average_%s" % ave_count
-            ave_count += 1
+                ave_motif.id = "Average_%s" % ave_count
+                ave_count += 1
             
-            new_node = MotifTree(ave_motif)
-            if pval:
-                new_node.maxscore = 1 - mc.compare_motifs(new_node.motif, new_node.motif, match, metric, combine, pval)[0]
-            else:
-                new_node.maxscore = mc.compare_motifs(new_node.motif, new_node.motif, match, metric, combine, pval)[0]
+                new_node = MotifTree(ave_motif)
+                if pval:
+                    new_node.maxscore = 1 - mc.compare_motifs(new_node.motif, new_node.motif, match, metric, combine, pval)[0]
+                else:
+                    new_node.maxscore = mc.compare_motifs(new_node.motif, new_node.motif, match, metric, combine, pval)[0]
                 
-            new_node.mergescore = score
-            #print "%s + %s = %s with score %s" % (n1.motif.id, n2.motif.id, ave_motif.id, score)
-            n1.parent = new_node
-            n2.parent = new_node
-            new_node.left = n1
-            new_node.right = n2
+                new_node.mergescore = score
+                #print "%s + %s = %s with score %s" % (n1.motif.id, n2.motif.id, ave_motif.id, score)
+                n1.parent = new_node
+                n2.parent = new_node
+                new_node.left = n1
+                new_node.right = n2
             
-            cmp_nodes = dict([(node.motif, node) for node in nodes if not node.parent])
+                cmp_nodes = dict([(node.motif, node) for node in nodes if not node.parent])
             
-            if progress:
-                progress = (1 - len(cmp_nodes) / float(total)) * 100
-                sys.stderr.write('\rClustering [{0}{1}] {2}%'.format(
-                    '#' * (int(progress) // 10), 
-                    " " * (10 - int(progress) // 10), 
-                    int(progress)))
+                if progress:
+                    progress = (1 - len(cmp_nodes) / float(total)) * 100
+                    sys.stderr.write('\rClustering [{0}{1}] {2}%'.format(
+                        '#' * (int(progress) // 10), 
+                        " " * (10 - int(progress) // 10), 
+                        int(progress)))
             
-            result = mc.get_all_scores(
-                    [new_node.motif], 
-                    list(cmp_nodes.keys()), 
-                    match, 
-                    metric, 
-                    combine, 
-                    pval, 
-                    parallel=True)
+                result = mc.get_all_scores(
+                        [new_node.motif], 
+                        list(cmp_nodes.keys()), 
+                        match, 
+                        metric, 
+                        combine, 
+                        pval, 
+                        parallel=True,
+                        ncpus=ncpus)
             
-            for motif, n in cmp_nodes.items():
-                x = result[new_node.motif.id][motif.id]
-                if pval:
-                    x = [1 - x[0]] + x[1:]
-                scores[(new_node, n)] = x
+                for motif, n in cmp_nodes.items():
+                    x = result[new_node.motif.id][motif.id]
+                    if pval:
+                        x = [1 - x[0]] + x[1:]
+                    scores[(new_node, n)] = x
             
-            nodes.append(new_node)
+                nodes.append(new_node)
+    
+            cluster_nodes = [node for node in nodes if not node.parent]
     
-        cluster_nodes = [node for node in nodes if not node.parent]
          
     if progress:
         sys.stderr.write("\n") 
@@ -224,6 +225,99 @@ def cluster_motifs(motifs, match="total", metric="wic", combine="mean", pval=Tru
     
     return root
 
+def reduce_motifs(motifs, threshold=0.95, average=False, ntop=20, match="total", metric="wic", combine="mean", edge_ic_cutoff=0.2, ncpus=None):
+    """Reduce a set of motifs to a non-redundant set.
+
+    This is much faster than cluster_motifs() and can be used for large 
+    motif databases. Candidate similar motifs are selected based on k-mer
+    similarity (see MotifComparer.get_candidates()), only these candidates
+    are compared using 'match', 'metric' and 'combine'. The similarity
+    of two motifs is 1 - p-value of the match, as in cluster_motifs(). 
+
+    Motifs are greedily clustered: the motif with the most similar motifs
+    becomes the representative of a cluster, and all motifs with a 
+    similarity above the threshold to this motif are added to the cluster. 
+    This is repeated for the remaining motifs.
+
+    Parameters
+    ----------
+    motifs : list or str
+        List of Motif instances or file with motifs.
+
+    threshold : float, optional
+        Similarity threshold, default is 0.95.
+
+    average : bool, optional
+        Return the average of all motifs in a cluster instead of the 
+        representative motif.
+
+    ntop : int, optional
+        Number of candidate similar motifs to compare to every motif, default
+        is 20.
+
+    match : str, optional
+
+    metric : str, optional
+
+    combine : str, optional
+
+    edge_ic_cutoff : float, optional
+        Edges of averaged motifs with an IC below this cutoff are removed.
+
+    ncpus : int, optional
+        Number of threads to use.
+
+    Returns
+    -------
+    clusters : list
+        List of [motif, members] for every cluster. The cluster motif has the
+        same id as the representative motif.
+    """
+    if type([]) != type(motifs):
+        motifs = read_motifs(motifs, fmt="pwm")
+    
+    with MotifComparer() as mc:
+        candidates = mc.get_candidates(motifs, motifs, ntop=ntop + 1)
+        for motif in motifs:
+            candidates[motif.id] = [m for m in candidates[motif.id] if m.id != motif.id]
+        
+        scores = mc.get_candidate_scores(motifs, candidates, match, metric, combine, pval=True, ncpus=ncpus)
+    
+    # Symmetric graph of all motifs more similar than threshold
+    neighbors = dict([(m.id, set()) for m in motifs])
+    for m1, other_motifs in scores.items():
+        for m2, score in other_motifs.items():
+            if score and 1 - score[0] > threshold:
+                neighbors[m1].add(m2)
+                neighbors[m2].add(m1)
+    
+    motif_lookup = dict([(m.id, m) for m in motifs])
+    order = sorted(motifs, key=lambda m: (len(neighbors[m.id]), m.information_content()), reverse=True)
+    
+    clusters = []
+    assigned = set()
+    for rep in order:
+        if rep.id in assigned:
+            continue
+        members = [rep] + [motif_lookup[m] for m in sorted(neighbors[rep.id]) if m not in assigned]
+        assigned.update([m.id for m in members])
+        
+        motif = rep
+        if average and len(members) > 1:
+            for member in members[1:]:
+                _, pos, orientation = mc.compare_motifs(motif, member, match, metric, combine)
+                motif = motif.average_motifs(member, pos, orientation, include_bg=True)
+            motif.trim(edge_ic_cutoff)
+            
+            # Check if the motif is not empty
+            if len(motif) == 0:
+                motif = rep
+            motif.id = rep.id
+        clusters.append([motif, members])
+
+    logger.info("reduced %d motifs to %d clusters", len(motifs), len(clusters))
+    return clusters
+
 def cluster_motifs_with_report(infile, outfile, outdir, threshold, title=None):
     # Cluster significant motifs
 
@@ -7,14 +7,37 @@ from __future__ import print_function
 
 import sys
 import os
+import time
 from gimmemotifs.fasta import Fasta
 import gimmemotifs.background as bg
 from genomepy import Genome
 from gimmemotifs.config import MotifConfig, BG_TYPES
 from gimmemotifs.utils import number_of_seqs_in_file
 
+def list_cache():
+    """Print the cached backgrounds."""
+    entries = bg.BackgroundCache().list()
+    if len(entries) == 0:
+        print("No cached backgrounds")
+        return
+    print("genome\ttype\tlength\tnumber\tseed\tsize (MB)\tlast used")
+    for entry in entries:
+        print("{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}".format(
+            entry["genome"], entry["type"], entry["length"], entry["n"], 
+            entry["seed"], entry["size"] / 1024.0 ** 2, 
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+            ))
+
 def background(args):
 
+    if args.list_cache:
+        list_cache()
+        return
+
+    if not args.outputfile or not args.bg_type:
+        print("need both an outputfile and a background type")
+        sys.exit(1)
+    
     inputfile = args.inputfile
     out = args.outputfile
     bg_type = args.bg_type
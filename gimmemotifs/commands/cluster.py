@@ -7,7 +7,7 @@
 
 from gimmemotifs.motif import pwmfile_to_motifs
 from gimmemotifs.comparison import MotifComparer
-from gimmemotifs.cluster import cluster_motifs
+from gimmemotifs.cluster import cluster_motifs, reduce_motifs
 from gimmemotifs.config import MotifConfig
 import sys
 import os
@@ -67,6 +67,41 @@ def _create_images(outdir, clusters):
         ids[-1][2] = [dict([("src", "%s.png" % m.id.replace(" ", "_")), ("alt", m.id.replace(" ", "_"))]) for m in members]
     return ids
 
+def _write_reduced(outdir, clusters, inputfile):
+    with open(os.path.join(outdir, "reduced_motifs.pfm"), "w") as f:
+        for motif, _ in clusters:
+            f.write("%s\n" % motif.to_pfm())
+
+    with open(os.path.join(outdir, "cluster_key.txt"), "w") as f:
+        for motif, members in clusters:
+            f.write("%s\t%s\n" % (motif.id, ",".join([m.id for m in members])))
+
+    # Carry over the factor annotation of all cluster members
+    map_file = os.path.splitext(inputfile)[0] + ".motif2factors.txt"
+    if not os.path.exists(map_file):
+        return
+    
+    anno = {}
+    header = None
+    with open(map_file) as f:
+        for line in f:
+            motif_id, *factor_info = line.rstrip("\n").split("\t")
+            if motif_id == "Motif":
+                header = line
+                continue
+            anno.setdefault(motif_id, []).append(tuple(factor_info))
+    
+    with open(os.path.join(outdir, "reduced_motifs.motif2factors.txt"), "w") as f:
+        if header:
+            f.write(header)
+        for motif, members in clusters:
+            seen = set()
+            for member in members:
+                for factor_info in anno.get(member.id, []):
+                    if factor_info not in seen:
+                        seen.add(factor_info)
+                        f.write("%s\n" % "\t".join((motif.id,) + factor_info))
+
 def cluster(args):
 
     outdir = os.path.abspath(args.outdir)
@@ -75,6 +110,11 @@ def cluster(args):
 
     ncpus = args.ncpus
     
+    if args.reduce:
+        clusters = reduce_motifs(args.inputfile, threshold=args.threshold, average=args.average, ncpus=ncpus)
+        _write_reduced(outdir, clusters, args.inputfile)
+        return
+
     clusters = []
     motifs = pwmfile_to_motifs(args.inputfile)
     if len(motifs) == 1:
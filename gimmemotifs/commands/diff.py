@@ -8,11 +8,11 @@ import sys
 import os
 import shutil
 import numpy as np
-from genomepy import Genome
 
 from gimmemotifs.scanner import Scanner
 from gimmemotifs.motif import pwmfile_to_motifs
 from gimmemotifs.fasta import Fasta
+from gimmemotifs.genome_index import regions_to_fasta
 from gimmemotifs.plot import diff_plot
 from tempfile import mkdtemp
 
@@ -44,12 +44,8 @@ def diff(args):
         
         for cluster,regions in clusters.items():
             sys.stderr.write("Creating FASTA file for {0}\n".format(cluster))
-            inbed = os.path.join(tmpdir, "{0}.bed".format(cluster))
             outfa = os.path.join(tmpdir, "{0}.fa".format(cluster))
-            with open(inbed, "w") as f:
-                for vals in regions:
-                    f.write("{0}\t{1}\t{2}\n".format(*vals))
-            Genome(genome).track2fasta(inbed, outfa)
+            regions_to_fasta(genome, ["\t".join(vals) for vals in regions]).writefasta(outfa)
             infiles.append(outfa)
     
     pwms = dict([(m.id, m) for m in pwmfile_to_motifs(pwmfile)])
@@ -15,7 +15,7 @@ def match(args):
     db = dict([(m.id, m) for m in pwmfile_to_motifs(args.dbpwmfile)])
 
     mc = MotifComparer()
-    result = mc.get_closest_match(sample.values(), db.values(), "partial", "wic", "mean")
+    result = mc.get_closest_match(sample.values(), db.values(), "partial", "wic", "mean", prefilter=args.prefilter)
 
     print("Motif\tMatch\tScore\tP-value")
     for motif, match in result.items():
@@ -11,8 +11,10 @@ from __future__ import print_function
 # Python imports
 import sys
 import os
+import hashlib
 import random
 import logging
+from collections import OrderedDict
 
 # External imports
 from scipy.stats import norm,entropy,chi2_contingency
@@ -144,6 +146,52 @@ RCDB = (
 "ACATAGCTTCCCGTTCCGGTCGATCACAAAAA"
 )
 
+# Score distributions, loaded once per process
+_SCORE_DISTS = {}
+
+# Score profiles of motifs along RCDB, the most recently used profiles are 
+# cached by motif content. One entry takes about 260 kB.
+_RCDB_PROFILES = OrderedDict()
+_RCDB_PROFILES_MAX = 1000
+
+def _load_score_dist(fname):
+    """Load a score distribution file as mean and sd lookup tables.
+
+    The file contains the mean and standard deviation of scores of random
+    motifs for combinations of motif lengths. The lookup tables are indexed
+    by the lengths of both motifs. Values for lengths that are not present in
+    the file are linearly interpolated, lengths below the minimum are set to
+    the value of the minimum length.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the score distribution file.
+
+    Returns
+    -------
+    mean, sd : tuple of numpy.ndarray
+        2D arrays of shape (max_length + 1, max_length + 1).
+    """
+    if fname not in _SCORE_DISTS:
+        data = np.loadtxt(fname, usecols=(0, 1, 2, 3), ndmin=2)
+        lengths = np.unique(data[:,:2].astype(int))
+        idx = np.searchsorted(lengths, data[:,:2].astype(int))
+        all_lengths = np.arange(lengths[-1] + 1)
+        
+        tables = []
+        for col in [2, 3]:
+            grid = np.full((len(lengths), len(lengths)), np.nan)
+            grid[idx[:,0], idx[:,1]] = data[:, col]
+            # Interpolate along both axes, skipping missing combinations
+            has_data = ~np.all(np.isnan(grid), axis=1)
+            rows = np.array([np.interp(all_lengths, lengths[~np.isnan(r)], r[~np.isnan(r)]) for r in grid[has_data]])
+            table = np.array([np.interp(all_lengths, lengths[has_data], c) for c in rows.T]).T
+            tables.append(table)
+        _SCORE_DISTS[fname] = tuple(tables)
+    
+    return _SCORE_DISTS[fname]
+
 # Function that can be parallelized
 def _get_all_scores(mc, motifs, dbmotifs, match, metric, combine, pval):
     try:
@@ -157,6 +205,127 @@ def _get_all_scores(mc, motifs, dbmotifs, match, metric, combine, pval):
         logging.exception("_get_all_scores failed")
 
 
+# Comparer and motifs of the worker processes of the MotifComparer pool, 
+# these are set once when the pool is started.
+_pool_data = {}
+
+def _init_pool(motifs):
+    # Every worker has its own comparer. The pool should not refer to the 
+    # comparer that started it, otherwise that is never garbage collected.
+    _pool_data["mc"] = MotifComparer()
+    _pool_data["motifs"] = motifs
+
+def _motif_key(motif):
+    """Return a key that identifies the content of a motif.
+
+    The key changes if the motif is changed in place, for instance when it 
+    is trimmed.
+    """
+    h = hashlib.md5(np.array(motif.pwm, dtype=float).tobytes())
+    h.update(np.array(motif.pfm, dtype=float).tobytes())
+    return h.hexdigest()
+
+def _pool_motifs(items):
+    # Items are either the index of a motif in the pool or a Motif instance
+    motifs = _pool_data["motifs"]
+    return [motifs[x] if isinstance(x, int) else x for x in items]
+
+def _get_pool_scores(query, targets, match, metric, combine, pval):
+    """Compare motifs in a worker process of the MotifComparer pool.
+
+    Returns an array of shape (len(query), len(targets), 3) with score, 
+    position and strand. If there is no score, these are NaN.
+    """
+    mc = _pool_data["mc"]
+    query = _pool_motifs(query)
+    targets = _pool_motifs(targets)
+    
+    result = np.full((len(query), len(targets), 3), np.nan)
+    for i, m1 in enumerate(query):
+        for j, m2 in enumerate(targets):
+            try:
+                score = mc.compare_motifs(m1, m2, match, metric, combine, pval=pval)
+            except Exception as e:
+                raise RuntimeError("Comparison of {} and {} failed: {}: {}".format(
+                    m1.id, m2.id, type(e).__name__, e))
+            if score:
+                result[i, j] = score
+    return result
+
+def _get_pool_candidate_scores(pairs, match, metric, combine, pval):
+    """Compare motifs to their candidates in a worker process.
+
+    Returns a list with an array of shape (len(targets), 3) for every 
+    (query, targets) pair.
+    """
+    return [_get_pool_scores([query], targets, match, metric, combine, pval)[0] 
+            for query, targets in pairs]
+
+def _to_score(row):
+    """Convert a row of score, position, strand to the format returned by 
+    compare_motifs().
+    """
+    if np.isnan(row[0]):
+        return []
+    return [float(row[0])] + [x if np.isnan(x) else int(x) for x in row[1:]]
+
+def _get_candidate_scores(mc, motifs, candidates, match, metric, combine, pval):
+    try:
+        scores = {}
+        for m1 in motifs:
+            scores[m1.id] = {}
+            for m2 in candidates[m1.id]:
+                scores[m1.id][m2.id] = mc.compare_motifs(m1, m2, match, metric, combine, pval=pval)
+        return scores
+    except Exception:
+        logging.exception("_get_candidate_scores failed")
+
+def _rc_kmer_index(k):
+    """Return, for every k-mer index, the index of its reverse complement.
+
+    K-mers are encoded in base 4 with A=0, C=1, G=2 and T=3, most significant
+    position first.
+    """
+    idx = np.arange(4 ** k)
+    digits = (idx[:, None] // 4 ** np.arange(k)) % 4
+    return ((3 - digits) * 4 ** np.arange(k)[::-1]).sum(1)
+
+def motif_embedding(motif, k=4):
+    """Return a fixed-length, strand-independent k-mer embedding of a motif.
+
+    Every element corresponds to a k-mer and contains the highest probability
+    of that k-mer at any position of the motif. A k-mer and its reverse 
+    complement get the same value, so motifs on opposite strands have 
+    identical embeddings. The vector is normalized to unit length, so the dot
+    product of two embeddings is their cosine similarity.
+
+    Parameters
+    ----------
+    motif : Motif instance
+        Motif to embed.
+    
+    k : int, optional
+        Length of the k-mers, default is 4.
+    
+    Returns
+    -------
+    embedding : numpy.ndarray
+        Array of length 4^k.
+    """
+    pwm = np.array(motif.pwm, dtype=float)
+    if len(pwm) < k:
+        pwm = np.vstack([pwm, np.full((k - len(pwm), 4), 0.25)])
+    
+    # Probability of every k-mer for all windows of length k
+    n = len(pwm) - k + 1
+    p = pwm[:n]
+    for i in range(1, k):
+        p = (p[:, :, None] * pwm[i:i + n][:, None, :]).reshape(n, -1)
+    
+    v = p.max(0)
+    v = np.maximum(v, v[_rc_kmer_index(k)])
+    return v / np.linalg.norm(v)
+
 def akl(p1, p2):
     """Calculates motif position similarity based on average Kullback-Leibler similarity.
     
@@ -210,6 +379,41 @@ def ssd(p1, p2):
     """
     return 2 - np.sum([(a-b)**2 for a,b in zip(p1,p2)])
 
+def _rcdb_profiles(motif):
+    """Return the score profiles of a motif along RCDB.
+
+    The profiles of the most recently used motifs are cached, so a motif is
+    usually only scanned once.
+
+    Parameters
+    ----------
+    motif : Motif instance
+        Motif to scan with.
+
+    Returns
+    -------
+    forward, reverse : tuple of numpy.ndarray
+        Scores of the motif and of its reverse complement at every position.
+    """
+    h = _motif_key(motif)
+    if h in _RCDB_PROFILES:
+        _RCDB_PROFILES[h] = _RCDB_PROFILES.pop(h)
+    else:
+        rc = motif.rc()
+        _RCDB_PROFILES[h] = (
+            np.array(pfmscan(RCDB, motif.pwm, motif.pwm_min_score(), len(RCDB), False, True), dtype=float),
+            np.array(pfmscan(RCDB, rc.pwm, rc.pwm_min_score(), len(RCDB), False, True), dtype=float),
+            )
+        while len(_RCDB_PROFILES) > _RCDB_PROFILES_MAX:
+            _RCDB_PROFILES.popitem(last=False)
+    return _RCDB_PROFILES[h]
+
+def _pearson(a, b):
+    """Pearson correlation of a and b, NaN if a or b is constant."""
+    if np.ptp(a) == 0 or np.ptp(b) == 0:
+        return np.nan
+    return 1 - distance.correlation(a, b)
+
 def seqcor(m1, m2, seq=None):
     """Calculates motif similarity based on Pearson correlation of scores.
 
@@ -218,6 +422,10 @@ def seqcor(m1, m2, seq=None):
     This sequence is taken from ShortCAKE (Orenstein & Shamir, 2015). 
     Optionally another sequence can be given as an argument.
 
+    The correlation is not defined for a constant score window, for 
+    instance for a motif with a uniform PFM. These windows are skipped, if
+    all windows are constant the score is NaN.
+
     Parameters
     ----------
     m1 : Motif instance
@@ -240,30 +448,149 @@ def seqcor(m1, m2, seq=None):
 
     if seq is None:
         seq = RCDB 
+        
+        # Use the cached scan results of RC de Bruijn sequence
+        result1 = _rcdb_profiles(m1)[0]
+        result2, result3 = _rcdb_profiles(m2)
+    else:
+        result1 = pfmscan(seq, m1.pwm, m1.pwm_min_score(), len(seq), False, True)
+        result2 = pfmscan(seq, m2.pwm, m2.pwm_min_score(), len(seq), False, True)
     
-    L = len(seq)
-
-    # Scan RC de Bruijn sequence
-    result1 = pfmscan(seq, m1.pwm, m1.pwm_min_score(), len(seq), False, True)
-    result2 = pfmscan(seq, m2.pwm, m2.pwm_min_score(), len(seq), False, True)
+        # Reverse complement of motif 2
+        result3 = pfmscan(seq, m2.rc().pwm, m2.rc().pwm_min_score(), len(seq), False, True)
     
-    # Reverse complement of motif 2
-    result3 = pfmscan(seq, m2.rc().pwm, m2.rc().pwm_min_score(), len(seq), False, True)
+    L = len(seq)
     
-    result1 = np.array(result1)
-    result2 = np.array(result2)
-    result3 = np.array(result3)
+    result1 = np.array(result1, dtype=float)
+    result2 = np.array(result2, dtype=float)
+    result3 = np.array(result3, dtype=float)
 
-    # Return maximum correlation
+    # Return maximum correlation, the last one in case of ties
     c = []
     for i in range(l1 - l1 // 3):
-        c.append([1 - distance.correlation(result1[:L-l-i],result2[i:L-l]), i, 1])
-        c.append([1 - distance.correlation(result1[:L-l-i],result3[i:L-l]), i, -1])
+        c.append([_pearson(result1[:L-l-i],result2[i:L-l]), i, 1])
+        c.append([_pearson(result1[:L-l-i],result3[i:L-l]), i, -1])
     for i in range(l2 - l2 // 3):
-        c.append([1 - distance.correlation(result1[i:L-l],result2[:L-l-i]), -i, 1])
-        c.append([1 - distance.correlation(result1[i:L-l],result3[:L-l-i]), -i, -1])
+        c.append([_pearson(result1[i:L-l],result2[:L-l-i]), -i, 1])
+        c.append([_pearson(result1[i:L-l],result3[:L-l-i]), -i, -1])
+    
+    defined = [x for x in c if not np.isnan(x[0])]
+    if len(defined) == 0:
+        return [np.nan] + c[-1][1:]
+    return sorted(defined, key=lambda x: x[0])[-1]
+
+def seqcor_matrix(motifs, dbmotifs):
+    """Calculates seqcor motif similarity of all motifs to all dbmotifs.
+
+    This returns the same score, position and strand as seqcor() for every 
+    pair of motifs, but is much faster for many motifs. The score profiles 
+    along RCDB are calculated once per motif and the correlations of all 
+    pairs are calculated using matrix multiplications for every position 
+    offset. The motifs are compared in chunks, so that the profiles of a 
+    chunk of motifs and of a chunk of dbmotifs fit in the profile cache. 
+    Profiles are only scanned again if there are more motifs than fit in the
+    cache.
+
+    Parameters
+    ----------
+    motifs : list
+        List of Motif instances.
+    
+    dbmotifs : list
+        List of Motif instances.
+
+    Returns
+    -------
+    scores, positions, strands : tuple of numpy.ndarray
+        Arrays of shape (len(motifs), len(dbmotifs)).
+    """
+    motifs = list(motifs)
+    dbmotifs = list(dbmotifs)
+    chunksize = max(1, _RCDB_PROFILES_MAX // 2)
+    
+    scores = np.zeros((len(motifs), len(dbmotifs)))
+    positions = np.zeros((len(motifs), len(dbmotifs)), dtype=int)
+    strands = np.ones((len(motifs), len(dbmotifs)), dtype=int)
+    for j in range(0, len(dbmotifs), chunksize):
+        for i in range(0, len(motifs), chunksize):
+            result = _seqcor_chunk(
+                    motifs[i:i + chunksize], dbmotifs[j:j + chunksize])
+            for a, chunk in zip((scores, positions, strands), result):
+                a[i:i + chunksize, j:j + chunksize] = chunk
+    
+    return scores, positions, strands
+
+def _seqcor_chunk(motifs, dbmotifs):
+    """Calculates seqcor of all motifs to all dbmotifs, see seqcor_matrix().
+    """
+    L = len(RCDB)
+    len1 = np.array([len(m) for m in motifs])
+    len2 = np.array([len(m) for m in dbmotifs])
+    
+    profiles1 = [_rcdb_profiles(m)[0] for m in motifs]
+    profiles2 = [_rcdb_profiles(m) for m in dbmotifs]
+
+    scores = np.full((len(motifs), len(dbmotifs)), -np.inf)
+    positions = np.zeros((len(motifs), len(dbmotifs)), dtype=int)
+    strands = np.ones((len(motifs), len(dbmotifs)), dtype=int)
+    
+    # The sequence length that is used depends on the length of the longest 
+    # motif of a pair. 
+    for l in np.unique(np.hstack((len1, len2))):
+        for rows, cols in [(len1 == l, len2 <= l), (len1 < l, len2 == l)]:
+            rows, cols = np.nonzero(rows)[0], np.nonzero(cols)[0]
+            if len(rows) == 0 or len(cols) == 0:
+                continue
+            
+            n = L - l
+            a = np.array([profiles1[i][:n] for i in rows], dtype=float)
+            b = [np.array([profiles2[j][k][:n] for j in cols], dtype=float)
+                    for k in (0, 1)]
+            # Maximum offset to check
+            max1 = (len1[rows] - len1[rows] // 3)[:, None]
+            max2 = (len2[cols] - len2[cols] // 3)[None, :]
+            
+            # Check the offsets in the same order as seqcor(), so that
+            # the same offset is selected in case of ties
+            idx = np.ix_(rows, cols)
+            for sign, max_i in [(1, max1), (-1, max2)]:
+                for i in range(max_i.max()):
+                    if sign == 1:
+                        window_a, start_b = a[:, :n - i], i
+                    else:
+                        window_a, start_b = a[:, i:n], 0
+                    for strand, profiles in zip((1, -1), b):
+                        c = _correlation(window_a, 
+                                profiles[:, start_b:start_b + n - i])
+                        update = (i < max_i) & (c >= scores[idx])
+                        scores[idx] = np.where(update, c, scores[idx])
+                        positions[idx] = np.where(update, sign * i, positions[idx])
+                        strands[idx] = np.where(update, strand, strands[idx])
     
-    return sorted(c, key=lambda x: x[0])[-1]
+    # No defined correlation, seqcor() returns the last offset
+    undefined = np.isinf(scores)
+    scores[undefined] = np.nan
+    positions[undefined] = np.broadcast_to(
+            -(len2 - len2 // 3 - 1), scores.shape)[undefined]
+    strands[undefined] = -1
+    
+    return scores, positions, strands
+
+def _correlation(a, b):
+    """Pearson correlation of all rows of a to all rows of b.
+
+    The correlation with a constant row is NaN.
+    """
+    a_centered = a - a.mean(1)[:, None]
+    b_centered = b - b.mean(1)[:, None]
+    norm_a = np.sqrt((a_centered ** 2).sum(1))
+    norm_b = np.sqrt((b_centered ** 2).sum(1))
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        c = a_centered.dot(b_centered.T) / np.outer(norm_a, norm_b)
+    c[np.ptp(a, 1) == 0] = np.nan
+    c[:, np.ptp(b, 1) == 0] = np.nan
+    return c
 
 class MotifComparer(object):
     """Class for motif comparison.
@@ -302,22 +629,103 @@ class MotifComparer(object):
         self.metrics = ["pcc", "ed", "distance", "wic"]
         self.combine = ["mean", "sum"]
         self._load_scores()
-        # Create a parallel python job server, to use for fast motif comparison
         
+        # Pool for parallel comparisons, started on first use
+        self._pool = None
+        self._pool_ncpus = None
+        self._pool_index = {}
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        # Don't pickle the score distributions, they're loaded from the 
+        # per-process cache when unpickling. The pool can't be pickled.
+        state = self.__dict__.copy()
+        del state["scoredist"]
+        state["_pool"] = None
+        state["_pool_ncpus"] = None
+        state["_pool_index"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_scores()
+
+    def close(self):
+        """Stop the worker processes of the pool for parallel comparisons.
+
+        The pool is started again when needed. A MotifComparer can also be 
+        used as a context manager, which closes the pool on exit.
+        """
+        if getattr(self, "_pool", None) is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pool_index = {}
+
+    def _get_pool(self, motifs, ncpus=None):
+        """Return the pool for parallel comparisons.
+
+        The pool is kept alive between calls, until close() is called. Motifs
+        are sent to the workers once, when the pool is started, so that only 
+        their indices have to be sent with every job. Motifs are identified by
+        their content, so a motif that has been changed is sent again. If most
+        motifs are new, a new pool is started. 
+
+        Parameters
+        ----------
+        motifs : list
+            List of Motif instances that will be compared.
+
+        ncpus : int, optional
+            Number of processes. If not specified, the number of processes of
+            the current pool or the default number from the config is used.
+
+        Returns
+        -------
+        pool : multiprocessing.Pool
+        """
+        if ncpus is None:
+            ncpus = self._pool_ncpus 
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params()["ncpus"])
+        
+        # Unique motifs by content
+        motifs = list(dict([(_motif_key(m), m) for m in motifs]).items())
+        unknown = [m for key, m in motifs if key not in self._pool_index]
+        
+        if self._pool is None or ncpus != self._pool_ncpus or len(unknown) > len(motifs) // 2:
+            self.close()
+            self._pool_index = dict([(key, i) for i, (key, _) in enumerate(motifs)])
+            self._pool_ncpus = ncpus
+            self._pool = Pool(processes=ncpus, initializer=_init_pool, 
+                    initargs=([m for _, m in motifs],))
+        
+        return self._pool
+
+    def _pool_items(self, motifs):
+        # Index of a motif in the pool or the motif itself if it is unknown
+        return [self._pool_index.get(_motif_key(m), m) for m in motifs]
+
+    def _score_file(self, match, metric, combine):
+        return os.path.join(self.config.get_score_dir(), "%s_%s_%s_score_dist.txt" % (match, metric, combine))
 
     def _load_scores(self):
         self.scoredist = {}
         for metric in self.metrics:
-            self.scoredist[metric] = {"total": {}, "subtotal": {}}
+            self.scoredist[metric] = {}
             for match in ["total", "subtotal"]:
                 for combine in ["mean"]:
-                    self.scoredist[metric]["%s_%s" % (match, combine)] = {}
-                    score_file = os.path.join(self.config.get_score_dir(), "%s_%s_%s_score_dist.txt" % (match, metric, combine))
+                    score_file = self._score_file(match, metric, combine)
                     if os.path.exists(score_file):
-                        with open(score_file) as f:
-                            for line in f:
-                                l1, l2, m, sd = line.strip().split("\t")[:4]
-                                self.scoredist[metric]["%s_%s" % (match, combine)].setdefault(int(l1), {})[int(l2)] = [float(m), float(sd)]
+                        self.scoredist[metric]["%s_%s" % (match, combine)] = _load_score_dist(score_file)
     
     def compare_motifs(self, m1, m2, match="total", metric="wic", combine="mean", pval=False):
         """Compare two motifs.
@@ -386,29 +794,15 @@ class MotifComparer(object):
                 return self.max_subtotal(m1.pfm, m2.pfm, metric, combine)
     
 
-    def _check_length(self, l):
-        # Set the length to a length represented in randomly generated JASPAR motifs 
-        if l < 4:
-            return 4
-        if l == 13:
-            return 14
-        if l == 17:
-            return 18
-        if l == 19:
-            return 20
-        if l == 21:
-            return 22
-        if l > 22:
-            return 30    
-        return l    
-    
     def pvalue(self, m1, m2, match, metric, combine, score):
-        l1, l2 = len(m1.pwm), len(m2.pwm)
+        mean, sd = self.scoredist[metric]["%s_%s" % (match, combine)]
         
-        l1 = self._check_length(l1)    
-        l2 = self._check_length(l2)    
+        # Lengths longer than the longest length in the table are set to the 
+        # maximum length
+        l1 = min(len(m1.pwm), len(mean) - 1)
+        l2 = min(len(m2.pwm), len(mean) - 1)
         
-        m,s = self.scoredist[metric]["%s_%s" % (match, combine)][l1][l2]    
+        m,s = mean[l1, l2], sd[l1, l2]
         
         try:
             [1 - norm.cdf(score[0], m, s), score[1], score[2]]
@@ -571,6 +965,45 @@ class MotifComparer(object):
             p2 = p2[:len(p1)]
         return p1,p2
 
+    def get_score_matrix(self, motifs, dbmotifs, match, metric, combine, 
+                            pval=False, ncpus=None):
+        """Parallel pairwise comparison of motifs, returned as arrays.
+
+        The comparisons are run in a pool that is kept alive between calls, 
+        see get_all_scores() for a description of the parameters.
+        
+        Returns
+        -------
+        scores, positions, strands : tuple of numpy.ndarray
+            Arrays of shape (len(motifs), len(dbmotifs)). If there is no score
+            for a pair of motifs, the values are NaN.
+        """
+        motifs = list(motifs)
+        dbmotifs = list(dbmotifs)
+        
+        if metric == "seqcor":
+            return seqcor_matrix(motifs, dbmotifs)
+
+        pool = self._get_pool(motifs + dbmotifs, ncpus)
+        query = self._pool_items(motifs)
+        targets = self._pool_items(dbmotifs)
+        
+        # Divide the largest dimension into one chunk per process, to keep
+        # parallel overhead to minimum 
+        axis = int(len(targets) >= len(query))
+        items = [query, targets][axis]
+        batch_len = max(len(items) // self._pool_ncpus, 1)
+        
+        jobs = []
+        for i in range(0, len(items), batch_len):
+            args = [query, targets]
+            args[axis] = items[i: i + batch_len]
+            jobs.append(pool.apply_async(_get_pool_scores, 
+                args=tuple(args) + (match, metric, combine, pval)))
+        
+        result = np.concatenate([job.get() for job in jobs], axis=axis)
+        return result[:,:,0], result[:,:,1], result[:,:,2]
+
     def get_all_scores(self, motifs, dbmotifs, match, metric, combine, 
                             pval=False, parallel=True, trim=None, ncpus=None):
         """Pairwise comparison of a set of motifs compared to reference motifs.
@@ -622,44 +1055,192 @@ class MotifComparer(object):
         # hash of result scores
         scores = {}
         
-        if parallel:    
-            # Divide the job into big chunks, to keep parallel overhead to minimum
-            # Number of chunks = number of processors available
-            if ncpus is None:
-                ncpus = int(MotifConfig().get_default_params()["ncpus"])
-
-            pool = Pool(processes=ncpus, maxtasksperchild=1000)
- 
-            batch_len = len(dbmotifs) // ncpus
-            if batch_len <= 0:
-                batch_len = 1
-            jobs = []
-            for i in range(0, len(dbmotifs), batch_len): 
-                # submit jobs to the job server
-                
-                p = pool.apply_async(_get_all_scores, 
-                    args=(self, motifs, dbmotifs[i: i + batch_len], match, metric, combine, pval))
-                jobs.append(p)
-            
-            pool.close()
-            for job in jobs:
-                # Get the job result
-                result = job.get()
-                # and update the result score
-                for m1,v in result.items():
-                    for m2, s in v.items():
-                        if m1 not in scores:
-                            scores[m1] = {}
-                        scores[m1][m2] = s
-        
-            pool.join()
+        if metric == "seqcor":
+            # All pairs at once, this is faster than the parallel version
+            result = np.dstack(seqcor_matrix(motifs, dbmotifs))
+            for i, m1 in enumerate(motifs):
+                scores[m1.id] = {}
+                for j, m2 in enumerate(dbmotifs):
+                    scores[m1.id][m2.id] = _to_score(result[i, j])
+        elif parallel:
+            result = np.dstack(self.get_score_matrix(motifs, dbmotifs, match, metric, combine, pval, ncpus))
+            for i, m1 in enumerate(motifs):
+                scores[m1.id] = {}
+                for j, m2 in enumerate(dbmotifs):
+                    scores[m1.id][m2.id] = _to_score(result[i, j])
         else:
             # Do the whole thing at once if we don't want parallel
             scores = _get_all_scores(self, motifs, dbmotifs, match, metric, combine, pval)
         
         return scores
 
-    def get_closest_match(self, motifs, dbmotifs=None, match="partial", metric="wic",combine="mean", parallel=True, ncpus=None):
+    def get_candidates(self, motifs, dbmotifs, ntop=50, k=4):
+        """Return the most likely matches in the database for every motif.
+
+        Candidates are selected based on the cosine similarity of the k-mer
+        embeddings of the motifs (see motif_embedding). This is much faster 
+        than an exact comparison and can be used as a pre-filter to select 
+        the motifs that should be compared with compare_motifs().
+
+        Parameters
+        ----------
+        motifs : list
+            List of Motif instances.
+
+        dbmotifs : list
+            List of Motif instances.
+
+        ntop : int, optional
+            Number of candidates to return per motif, default is 50.
+        
+        k : int, optional
+            K-mer length used for the embedding, default is 4.
+
+        Returns
+        -------
+        candidates : dict
+            Dictionary with motif id as key and a list of candidate database 
+            motifs, sorted by similarity, as value.
+        """
+        motifs = parse_motifs(motifs)
+        dbmotifs = parse_motifs(dbmotifs)
+        
+        query = np.array([motif_embedding(m, k) for m in motifs])
+        db = np.array([motif_embedding(m, k) for m in dbmotifs])
+        
+        ntop = min(ntop, len(dbmotifs))
+        
+        # Calculate similarities in chunks to limit memory usage for large
+        # numbers of motifs
+        chunksize = 1000
+        candidates = {}
+        for start in range(0, len(motifs), chunksize):
+            sim = query[start:start + chunksize].dot(db.T)
+            
+            # Select the top ntop per row, then sort only those
+            rows = np.arange(len(sim))[:, None]
+            top = np.argpartition(-sim, ntop - 1, axis=1)[:, :ntop]
+            top = top[rows, np.argsort(-sim[rows, top], axis=1)]
+        
+            for motif, idx in zip(motifs[start:start + chunksize], top):
+                candidates[motif.id] = [dbmotifs[i] for i in idx]
+        return candidates
+
+    def get_candidate_scores(self, motifs, candidates, match, metric, combine, 
+                            pval=False, parallel=True, ncpus=None):
+        """Compare motifs only to their candidate matches.
+
+        Parameters
+        ----------
+        motifs : list
+            List of Motif instances.
+
+        candidates : dict
+            Dictionary with motif id as key and a list of Motif instances
+            to compare to as value, as returned by get_candidates().
+
+        match : str
+            Match can be "partial", "subtotal" or "total". 
+
+        metric : str
+            Distance metric.
+
+        combine : str
+            Combine positional scores using "mean" or "sum". 
+
+        pval : bool , optional
+            Calculate p-vale of match.
+        
+        parallel : bool , optional
+            Use multiprocessing for parallel execution. True by default.
+
+        ncpus : int or None
+            Specifies the number of cores to use for parallel execution.
+
+        Returns
+        -------
+        scores : dict
+            Dictionary with scores.
+        """
+        if not parallel:
+            return _get_candidate_scores(self, motifs, candidates, match, metric, combine, pval)
+        
+        all_motifs = list(motifs)
+        for m in motifs:
+            all_motifs += candidates[m.id]
+        pool = self._get_pool(all_motifs, ncpus)
+        
+        batch_len = max(len(motifs) // self._pool_ncpus, 1)
+        jobs = []
+        for i in range(0, len(motifs), batch_len):
+            batch = motifs[i: i + batch_len]
+            pairs = [(self._pool_items([m])[0], self._pool_items(candidates[m.id])) for m in batch]
+            jobs.append(pool.apply_async(_get_pool_candidate_scores, 
+                args=(pairs, match, metric, combine, pval)))
+        
+        scores = {}
+        for i, job in zip(range(0, len(motifs), batch_len), jobs):
+            for m1, result in zip(motifs[i: i + batch_len], job.get()):
+                scores[m1.id] = {}
+                for m2, row in zip(candidates[m1.id], result):
+                    scores[m1.id][m2.id] = _to_score(row)
+        
+        return scores
+
+    def prefilter_recall(self, motifs, dbmotifs, ntop=50, match="partial", 
+            metric="wic", combine="mean", k=4, parallel=True, ncpus=None):
+        """Return the recall of the candidate pre-filter.
+
+        The recall is the fraction of motifs for which the best match, as 
+        determined by an exact comparison to all database motifs, is 
+        present in the candidates returned by get_candidates().
+
+        Parameters
+        ----------
+        motifs : list or str
+            Filename of motifs or list of motifs.
+
+        dbmotifs : list or str
+            Filename of database motifs or list of database motifs.
+
+        ntop : int, optional
+            Number of candidates per motif.
+
+        match : str, optional
+
+        metric : str, optional
+
+        combine : str, optional
+        
+        k : int, optional
+            K-mer length used for the embedding.
+
+        parallel : bool , optional
+            Use multiprocessing for parallel execution. True by default.
+
+        ncpus : int, optional
+            Number of threads to use.
+
+        Returns
+        -------
+        recall : float
+        """
+        motifs = parse_motifs(motifs)
+        dbmotifs = parse_motifs(dbmotifs)
+        
+        candidates = self.get_candidates(motifs, dbmotifs, ntop=ntop, k=k)
+        scores = self.get_all_scores(motifs, dbmotifs, match, metric, combine, 
+                parallel=parallel, ncpus=ncpus)
+        
+        found = 0
+        for motif in motifs:
+            best = sorted(scores[motif.id].items(), key=lambda x:x[1][0])[-1][0]
+            if best in [m.id for m in candidates[motif.id]]:
+                found += 1
+
+        return found / float(len(motifs))
+
+    def get_closest_match(self, motifs, dbmotifs=None, match="partial", metric="wic",combine="mean", parallel=True, ncpus=None, prefilter=None):
         """Return best match in database for motifs.
 
         Parameters
@@ -679,6 +1260,12 @@ class MotifComparer(object):
         ncpus : int, optional
             Number of threads to use.
 
+        prefilter : int, optional
+            If specified, only the best `prefilter` candidates, as selected
+            by get_candidates(), are compared to every motif. This is much
+            faster for large databases, at the cost of a (small) chance of
+            missing the best match. Use prefilter_recall() to check.
+
         Returns
         -------
         closest_match : dict
@@ -694,7 +1281,14 @@ class MotifComparer(object):
 
         dbmotif_lookup = dict([(m.id, m) for m in dbmotifs])
 
-        scores = self.get_all_scores(motifs, dbmotifs, match, metric, combine, parallel=parallel, ncpus=ncpus)
+        try:
+            if prefilter:
+                candidates = self.get_candidates(motifs, dbmotifs, ntop=prefilter)
+                scores = self.get_candidate_scores(motifs, candidates, match, metric, combine, parallel=parallel, ncpus=ncpus)
+            else:
+                scores = self.get_all_scores(motifs, dbmotifs, match, metric, combine, parallel=parallel, ncpus=ncpus)
+        finally:
+            self.close()
         for motif in scores:
             scores[motif] = sorted(
                     scores[motif].items(), 
@@ -710,27 +1304,74 @@ class MotifComparer(object):
         
         return scores
 
-    def generate_score_dist(self, motifs, match, metric, combine):
-        
-        score_file = os.path.join(self.config.get_score_dir(), "%s_%s_%s_score_dist.txt" % (match, metric, combine))    
-        f = open(score_file, "w")
+    def generate_score_dist(self, motifs, match, metric, combine, outfile=None, ncpus=None):
+        """Generate the score distribution of random motifs.
 
-        all_scores = {}
-        for l in [len(motif) for motif in motifs]:
-            all_scores[l] = {}
+        All motifs are compared to each other and the mean and standard
+        deviation of the scores is determined for every combination of motif
+        lengths. These are used to calculate the p-value of a match.
 
-        sorted_motifs = {}
-        for l in all_scores.keys():
-            sorted_motifs[l] = [motif for motif in motifs if len(motif) == l]
-        
-        for l1 in all_scores.keys():
-            for l2 in all_scores.keys():
-                scores = self.get_all_scores(sorted_motifs[l1], sorted_motifs[l2], match, metric, combine)
-                scores = [[y[0] for y in x.values() if y] for x in scores.values()]
-                scores = np.array(scores).ravel()
-                f.write("%s\t%s\t%s\t%s\n" % (l1, l2, np.mean(scores), np.std(scores)))
+        Parameters
+        ----------
+        motifs : list
+            List of (random) Motif instances.
+
+        match : str
+            Match can be "partial", "subtotal" or "total". 
+
+        metric : str
+            Distance metric.
+
+        combine : str
+            Combine positional scores using "mean" or "sum". 
 
-        f.close()    
+        outfile : str, optional
+            Name of the output file. By default the score distribution is 
+            saved in the score directory in the configuration.
+        
+        ncpus : int, optional
+            Number of threads to use.
+        """
+        if outfile is None:
+            outfile = self._score_file(match, metric, combine)
+        
+        motifs = parse_motifs(motifs)
+        
+        # All scores in one (parallel) run
+        try:
+            result = self.get_all_scores(motifs, motifs, match, metric, combine, ncpus=ncpus)
+        finally:
+            self.close()
+        scores = np.array([[
+            result[m1.id][m2.id][0] if result[m1.id][m2.id] else np.nan 
+            for m2 in motifs] for m1 in motifs], dtype=float)
+        
+        lengths = np.array([len(m) for m in motifs])
+        uniq_lengths, idx = np.unique(lengths, return_inverse=True)
+        
+        # Index of the length combination of every motif pair
+        nl = len(uniq_lengths)
+        pair_idx = (idx[:, None] * nl + idx[None, :]).ravel()
+        scores = scores.ravel()
+        valid = ~np.isnan(scores)
+        
+        n = np.bincount(pair_idx[valid], minlength=nl * nl)
+        total = np.bincount(pair_idx[valid], weights=scores[valid], minlength=nl * nl)
+        total_sq = np.bincount(pair_idx[valid], weights=scores[valid] ** 2, minlength=nl * nl)
+        
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / n
+            sd = np.sqrt(np.maximum(total_sq / n - mean ** 2, 0))
+        
+        with open(outfile, "w") as f:
+            for i, l1 in enumerate(uniq_lengths):
+                for j, l2 in enumerate(uniq_lengths):
+                    k = i * nl + j
+                    f.write("%s\t%s\t%s\t%s\n" % (l1, l2, mean[k], sd[k]))
+        
+        # Make sure the new distribution is used
+        _SCORE_DISTS.pop(outfile, None)
+        self._load_scores()
 
 # import here is necessary as workaround
 # see: http://stackoverflow.com/questions/18947876/using-python-multiprocessing-pool-in-the-terminal-and-in-code-modules-for-django
@@ -35,13 +35,14 @@ from genomepy import Genome
 
 from gimmemotifs.config import MotifConfig, BG_RANK, parse_denovo_params
 from gimmemotifs import mytmpdir
+from gimmemotifs.shutils import open_file
 from gimmemotifs.validation import check_denovo_input
 from gimmemotifs.utils import ( divide_file, divide_fa_file, 
                                     write_equalwidth_bedfile )
 from gimmemotifs.fasta import Fasta
-from gimmemotifs.background import ( MarkovFasta, MatchedGcFasta,
-                                    PromoterFasta, RandomGenomicFasta )
-from gimmemotifs.stats import calc_stats, rank_motifs, write_stats
+from gimmemotifs.genome_index import regions_to_fasta
+from gimmemotifs.background import BackgroundCache, MarkovFasta
+from gimmemotifs.stats import calc_background_stats, rank_motifs, write_stats
 from gimmemotifs.report import create_denovo_motif_report
 from gimmemotifs.motif import read_motifs
 
@@ -71,7 +72,7 @@ def prepare_denovo_input_narrowpeak(inputfile, params, outdir):
     logger.info("preparing input (narrowPeak to BED, width %s)", width)
     warn_no_summit = True
     with open(bedfile, "w") as f_out:
-        with open(inputfile) as f_in:
+        with open_file(inputfile) as f_in:
             for line in f_in:
                 if p.search(line):
                     continue
@@ -131,10 +132,9 @@ def prepare_denovo_input_bed(inputfile, params, outdir):
 
     config = MotifConfig()
    
-    genome = Genome(params["genome"])
+    genome = params["genome"]
     for infile in [pred_bedfile, val_bedfile]:
-        genome.track2fasta(
-            infile, 
+        regions_to_fasta(genome, infile).writefasta(
             infile.replace(".bed", ".fa"), 
             )
 
@@ -142,13 +142,13 @@ def prepare_denovo_input_bed(inputfile, params, outdir):
     lwidth = int(params["lwidth"])
     extend = (lwidth - width) // 2
     
-    genome.track2fasta(
+    regions_to_fasta(
+            genome,
             val_bedfile, 
-            os.path.join(outdir, "localization.fa"), 
             extend_up=extend, 
             extend_down=extend, 
             stranded=params["use_strand"], 
-            )
+            ).writefasta(os.path.join(outdir, "localization.fa"))
 
 def prepare_denovo_input_fa(inputfile, params, outdir):
     """Create all the FASTA files for de novo motif prediction and validation.
@@ -225,10 +225,12 @@ def create_background(bg_type, fafile, outfile, genome="hg18", width=200, nr_tim
         logger.debug("Random background: %s", outfile)
     elif bg_type == "genomic":
         logger.debug("Creating genomic background")
-        f = RandomGenomicFasta(genome, width, nr_times * len(fg))
+        f = BackgroundCache().get_or_create(
+                "genomic", genome, width, nr_times * len(fg))
     elif bg_type == "gc":
         logger.debug("Creating GC matched background")
-        f = MatchedGcFasta(fafile, genome, nr_times * len(fg))
+        f = BackgroundCache().get_or_create(
+                "gc", genome, width, nr_times * len(fg), matchfile=fafile)
         logger.debug("GC matched background: %s", outfile)
     elif bg_type == "promoter":
         fname = Genome(genome).filename
@@ -244,7 +246,8 @@ def create_background(bg_type, fafile, outfile, genome="hg18", width=200, nr_tim
         logger.info(
                 "Creating random promoter background (%s, using genes in %s)",
                 genome, gene_file)
-        f = PromoterFasta(gene_file, genome, width, nr_times * len(fg))
+        f = BackgroundCache().get_or_create(
+                "promoter", genome, width, nr_times * len(fg), genefile=gene_file)
         logger.debug("Random promoter background: %s", outfile)
     elif bg_type == "custom":
         bg_file = custom_background
@@ -437,12 +440,8 @@ def best_motif_in_cluster(single_pwm, clus_pwm, clusters, fg_fa, background, sta
             if str(motif) not in stats:
                 clustered_motifs.append(motifs[str(motif)])
     
-    new_stats = {}
-    for bg, bg_fa in background.items():
-        for m,s in calc_stats(clustered_motifs, fg_fa, bg_fa).items():
-            if m not in new_stats:
-                new_stats[m] = {}
-            new_stats[m][bg] = s
+    # scan the sequences once for all backgrounds
+    new_stats = calc_background_stats(clustered_motifs, fg_fa, background)
     stats.update(new_stats)
     
     rank = rank_motifs(stats, metrics)
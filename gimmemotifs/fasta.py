@@ -10,32 +10,172 @@ import random
 import re
 import numpy as np
 
+from gimmemotifs.shutils import is_gzipped, open_file
+
+SEQ_P = re.compile(r'[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]')
+
+def iter_fasta(fname, split_whitespace=False):
+    """Iterate over the records of a FASTA file.
+
+    The file is read line by line, so only one record is in memory at a 
+    time. The file can be gzip or bgzip compressed.
+
+    Parameters
+    ----------
+    fname : str
+        Name of FASTA file.
+
+    split_whitespace : bool, optional
+        Only use the first word of the header as sequence name.
+
+    Yields
+    ------
+    tuple
+        (name, sequence) tuple for every record.
+    """
+    with open_file(fname) as f:
+        line = f.readline()
+        if not line.startswith(">"):
+            raise IOError("Not a valid FASTA file")
+        
+        seq_name = None
+        lines = []
+        while line:
+            if line.startswith(">"):
+                if seq_name is not None:
+                    yield seq_name, _check_seq("".join(lines))
+                seq_name = line[1:].rstrip("\r\n")
+                if split_whitespace:
+                    seq_name = seq_name.split(" ")[0]
+                lines = []
+            else:
+                lines.append(line.rstrip("\r\n"))
+            line = f.readline()
+        
+        if seq_name is not None:
+            yield seq_name, _check_seq("".join(lines))
+
+def _check_seq(sequence):
+    if SEQ_P.match(sequence):
+        raise IOError("Not a valid FASTA file")
+    return sequence
+
+class _LazySequences(object):
+    """List-like access to the sequences of an indexed FASTA file.
+
+    Sequences are only read from the memory-mapped file when they are 
+    accessed, and are validated at that point.
+    """
+    def __init__(self, genome, names):
+        self.genome = genome
+        self.names = names
+
+    def _get(self, name):
+        return _check_seq(self.genome.get_seq(name, 0, self.genome.size(name)))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(name) for name in self.names[i]]
+        return self._get(self.names[i])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for name in self.names:
+            yield self._get(name)
+
 class Fasta(object):
 
-    def __init__(self, fname=None, split_whitespace=False):
-        """ Instantiate fasta object. Optional Fasta-formatted file as argument"""
-        self.ids = []
-        self.seqs = []
-        p = re.compile(r'[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]')
+    def __init__(self, fname=None, split_whitespace=False, lazy=False):
+        """ Instantiate fasta object. Optional Fasta-formatted file as argument.
+        
+        With lazy=True sequences are only read from the file when they are 
+        accessed, using a faidx-style index of the file. An invalid sequence
+        then only raises an IOError when it is accessed."""
+        self._ids = []
+        self._seqs = []
+        self._index = None
+        self._index_size = 0
+        # True if the id and sequence lists are shared with a FastaView
+        self._shared = False
         if fname:
-            f = open(fname, "r")
-            c = f.read()
-            f.close()
-            if not(c.startswith(">")):
-                raise IOError("Not a valid FASTA file")
+            if lazy and self._load_lazy(fname, split_whitespace):
+                return
             
-            for seq in c.split(">"):
-                if len(seq) > 1:
-                    lines = seq.split("\n")
-                    seq_name = lines[0]
-                    if split_whitespace:
-                        seq_name = seq_name.split(" ")
-                    self.ids.append(seq_name)
-                    sequence = "".join(lines[1:])
-                    if p.match(sequence):
-                        raise IOError("Not a valid FASTA file")
-                    self.seqs.append(sequence)
+            for seq_name, sequence in iter_fasta(fname, split_whitespace):
+                self._ids.append(seq_name)
+                self._seqs.append(sequence)
+    
+    def _load_lazy(self, fname, split_whitespace=False):
+        """ Index the file and read sequences on access. Returns False if the
+        file can't be indexed. """
+        from gimmemotifs.genome_index import fai_records, MappedGenome
+        if is_gzipped(fname):
+            return False
+        try:
+            records = fai_records(fname, headers=True)
+        except ValueError:
+            # different line lengths, can't index
+            return False
+        
+        names = [r[0] for r in records]
+        if len(set(names)) != len(names):
+            return False
         
+        # sequence ids are the full header lines
+        for record in records:
+            seq_name = record[-1]
+            if split_whitespace:
+                seq_name = seq_name.split(" ")[0]
+            self._ids.append(seq_name)
+        
+        genome = MappedGenome(dict(
+            (name, (fname, length, offset, line_bases, line_bytes)) 
+            for name, length, offset, line_bases, line_bytes, _ in records))
+        self._seqs = _LazySequences(genome, names)
+        return True
+
+    def _materialize(self):
+        """ Read all sequences of a lazily loaded file into memory. """
+        if not isinstance(self._seqs, list):
+            self._seqs = list(self._seqs)
+
+    def _unshare(self):
+        """ Copy the id and sequence lists if they are shared with a view,
+        before they are changed. """
+        if self._shared:
+            self._ids = list(self._ids)
+            self._seqs = list(self._seqs)
+            self._shared = False
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @ids.setter
+    def ids(self, ids):
+        self._ids = ids
+        self._index = None
+
+    @property
+    def seqs(self):
+        return self._seqs
+
+    @seqs.setter
+    def seqs(self, seqs):
+        self._seqs = seqs
+
+    def _get_index(self):
+        """ Return the id -> position dictionary, create it if needed. """
+        if self._index is None or self._index_size != len(self._ids):
+            index = {}
+            for i, seq_id in enumerate(self._ids):
+                index.setdefault(seq_id, i)
+            self._index = index
+            self._index_size = len(self._ids)
+        return self._index
+
     def hardmask(self):
         """ Mask all lowercase nucleotides with N's """
         p = re.compile("a|c|g|t|n")
@@ -43,18 +183,53 @@ class Fasta(object):
             self.fasta_dict[seq_id] = p.sub("N", self.fasta_dict[seq_id])
         return self
 
+    def subset(self, idx):
+        """Return a view of the sequences at the positions in idx.
+
+        The sequences are not copied, see FastaView.
+
+        Parameters
+        ----------
+        idx : slice or array_like
+            Slice or sequence of integer positions.
+
+        Returns
+        -------
+        FastaView
+            View of the selected sequences.
+        """
+        return FastaView(self, idx)
+
+    def split(self, n):
+        """Randomly split the sequences in two views.
+
+        Parameters
+        ----------
+        n : int
+            Number of sequences in the first view.
+
+        Returns
+        -------
+        tuple
+            (sample, rest) tuple of FastaView objects. Both keep the order 
+            of the sequences in this Fasta object.
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        mask[random.sample(range(len(self)), n)] = True
+        return self.subset(np.flatnonzero(mask)), self.subset(np.flatnonzero(~mask))
+
     def get_random(self, n, l=None):
         """ Return n random sequences from this Fasta object """
-        random_f = Fasta()
         if l:
-            ids = self.ids[:]
-            random.shuffle(ids)
+            random_f = Fasta()
+            positions = list(range(len(self)))
+            random.shuffle(positions)
             i = 0
-            while (i < n) and (len(ids) > 0):
-                seq_id = ids.pop()
-                if (len(self[seq_id]) >= l):
-                    start = random.randint(0, len(self[seq_id]) - l)
-                    random_f["random%s" % (i + 1)] = self[seq_id][start:start+l]
+            while (i < n) and (len(positions) > 0):
+                seq = self.seqs[positions.pop()]
+                if (len(seq) >= l):
+                    start = random.randint(0, len(seq) - l)
+                    random_f["random%s" % (i + 1)] = seq[start:start+l]
                     i += 1
             if len(random_f) != n:
                 sys.stderr.write("Not enough sequences of required length")
@@ -63,22 +238,16 @@ class Fasta(object):
                 return random_f
 
         else:
-            choice = random.sample(self.ids, n)
-            for i in range(n):
-                random_f[choice[i]] = self[choice[i]]
-        return random_f
+            return self.subset(random.sample(range(len(self)), n))
 
 
     def __getitem__(self, idx):
         if isinstance(idx, slice):
-            f = Fasta()
-            f.ids = self.ids[idx][:]
-            f.seqs = self.seqs[idx][:]
-            return f
-        elif idx in self.ids:
-            return self.seqs[self.ids.index(idx)]
-        else:
+            return self.subset(idx)
+        i = self._get_index().get(idx)
+        if i is None:
             return None
+        return self.seqs[i]
 
     def __repr__(self):
         return "%s sequences" % len(self.ids)
@@ -87,29 +256,39 @@ class Fasta(object):
         return len(self.ids)
 
     def __setitem__(self, key, value):
-        if key in self.ids:
-            self.seqs[self.ids.index(key)] = value
+        self._materialize()
+        self._unshare()
+        i = self._get_index().get(key)
+        if i is not None:
+            self.seqs[i] = value
         else:
-            self.ids.append(key)
-            self.seqs.append(value)
+            self.add(key, value)
 
     def __delitem__(self, key):
-        i = self.ids.index(key)
+        self._materialize()
+        self._unshare()
+        i = self._get_index()[key]
         self.ids.pop(i)
         self.seqs.pop(i)
+        self._index = None
         
     def _format_seq(self, seq):
         return seq
 
     def add(self, seq_id, seq):
+        self._materialize()
+        self._unshare()
+        if self._index is not None and self._index_size == len(self.ids):
+            self._index.setdefault(seq_id, len(self.ids))
+            self._index_size += 1
         self.ids.append(seq_id)
         self.seqs.append(seq)
     
     def has_key(self, key):
-        if key in self.ids:
-            return True
-        else:
-            return False
+        return key in self._get_index()
+
+    def __contains__(self, key):
+        return self.has_key(key)
 
     def __str__(self):
         return "%s sequences" % len(self.ids)
@@ -126,3 +305,110 @@ class Fasta(object):
 
     def median_length(self):
         return np.median([len(seq) for seq in self.seqs])
+
+def _fasta_from_lists(ids, seqs):
+    f = Fasta()
+    f.ids = ids
+    f.seqs = seqs
+    return f
+
+class FastaView(Fasta):
+    """A subset of the sequences of a Fasta object.
+
+    The view refers to the id and sequence lists of the parent and stores 
+    the positions of the selected sequences, so creating a view takes 
+    constant time for a slice and time proportional to the number of 
+    selected sequences otherwise. Views of views refer to the same lists.
+    The lists are copied on write: when the parent or the view is changed, 
+    it first gets its own copy, so later changes to the parent don't change 
+    the view and vice versa. For a lazily loaded Fasta object, the sequences 
+    of the view are also only read when they are accessed. A view is pickled
+    as a Fasta object with only the selected sequences.
+
+    Parameters
+    ----------
+    fasta : Fasta
+        Parent Fasta object.
+
+    idx : slice or array_like
+        Slice or sequence of integer positions in fasta.
+
+    Attributes
+    ----------
+    positions : range or numpy.ndarray
+        Positions of the selected sequences in the parent.
+    """
+    def __init__(self, fasta, idx):
+        Fasta.__init__(self)
+        self.positions = self._take(range(len(fasta)), idx)
+        
+        if isinstance(fasta, FastaView) and fasta._base is not None:
+            self._base = fasta._base
+            self._base_positions = self._take(fasta._base_positions, idx)
+        else:
+            self._base = (fasta._ids, fasta._seqs)
+            self._base_positions = self.positions
+            fasta._shared = True
+        
+        self._view_ids = None
+        self._view_seqs = None
+
+    @staticmethod
+    def _take(positions, idx):
+        if isinstance(idx, slice):
+            return positions[idx]
+        idx = np.asarray(idx, dtype=int)
+        if len(idx) and (idx.min() < -len(positions) or idx.max() >= len(positions)):
+            raise IndexError("index out of range")
+        idx = np.where(idx < 0, idx + len(positions), idx)
+        if isinstance(positions, range):
+            return positions.start + positions.step * idx
+        return positions[idx]
+
+    @property
+    def _ids(self):
+        if self._view_ids is None:
+            ids = self._base[0]
+            self._view_ids = [ids[i] for i in self._base_positions]
+        return self._view_ids
+
+    @_ids.setter
+    def _ids(self, ids):
+        self._detach()
+        self._view_ids = ids
+
+    @property
+    def _seqs(self):
+        if self._view_seqs is None:
+            seqs = self._base[1]
+            if isinstance(seqs, _LazySequences):
+                self._view_seqs = _LazySequences(
+                        seqs.genome, [seqs.names[i] for i in self._base_positions])
+            else:
+                self._view_seqs = [seqs[i] for i in self._base_positions]
+        return self._view_seqs
+
+    @_seqs.setter
+    def _seqs(self, seqs):
+        self._detach()
+        self._view_seqs = seqs
+
+    def _detach(self):
+        """ Stop referring to the lists of the parent. """
+        if getattr(self, "_base", None) is not None:
+            self._view_ids = list(self._ids)
+            self._view_seqs = self._seqs
+            self._base = None
+            self._base_positions = None
+
+    def _materialize(self):
+        self._detach()
+        Fasta._materialize(self)
+
+    def __len__(self):
+        if self._base is not None:
+            return len(self._base_positions)
+        return len(self._view_ids)
+
+    def __reduce__(self):
+        return (_fasta_from_lists, (list(self.ids), list(self.seqs)))
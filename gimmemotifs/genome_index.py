@@ -10,9 +10,12 @@ from glob import glob
 import subprocess as sp
 import random
 import bisect
+import mmap
 import sys
 import os
+import threading
 from tempfile import NamedTemporaryFile
+from multiprocessing import Pool
 try:
     from urllib.request import urlopen, urlretrieve
 except:
@@ -22,10 +25,11 @@ import re
 from distutils.spawn import find_executable
 import gzip 
 
+import numpy as np
 import pybedtools
 from genomepy import Genome
 
-from gimmemotifs.shutils import find_by_ext
+from gimmemotifs.shutils import find_by_ext, open_file
 from gimmemotifs.config import FASTA_EXT,MotifConfig
 from gimmemotifs.fasta import Fasta
 
@@ -242,6 +246,266 @@ def get_genome(genomebuild, fastadir, indexdir=None):
     g = g.create_index(genome_dir, index_dir)
     create_bedtools_fa(index_dir, genome_dir)
 
+def fai_records(fasta_file, headers=False):
+    """Index a FASTA file in a single pass.
+
+    The FASTA file can contain multiple sequences. All lines of a sequence, 
+    except the last one, should have the same length.
+
+    Parameters
+    ----------
+    fasta_file : str
+        Name of FASTA file.
+
+    headers : bool, optional
+        Add the complete header line, without the '>', to every record.
+
+    Returns
+    -------
+    records : list
+        List of (name, length, offset, line_bases, line_bytes) tuples, as in a
+        samtools faidx index. With headers=True the header is added as the 
+        last element of the tuple.
+    """
+    if os.path.getsize(fasta_file) == 0:
+        raise IOError("{} is empty".format(fasta_file))
+    
+    records = []
+    with open(fasta_file, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm[:1] != b">":
+            raise IOError(
+                "{} is not a valid FASTA file, expected > at first line".format(
+                    fasta_file))
+        size = len(mm)
+        pos = 0
+        while pos < size:
+            header_end = mm.find(b"\n", pos)
+            if header_end == -1:
+                header_end = size
+            header = mm[pos + 1:header_end].decode()
+            name = header.strip().split(" ")[0].split("\t")[0]
+            offset = min(header_end + 1, size)
+            next_header = mm.find(b"\n>", header_end)
+            seq_end = size if next_header == -1 else next_header + 1
+            
+            if seq_end - offset < 65536:
+                # short sequence, split the lines directly
+                lines = mm[offset:seq_end].split(b"\n")
+                line_bytes = len(lines[0]) + 1
+                bases = [len(line.rstrip(b"\r")) for line in lines]
+            else:
+                data = np.frombuffer(mm, dtype=np.uint8, count=seq_end - offset, offset=offset)
+                ends = np.flatnonzero(data == 10)
+                if data[-1] != 10:
+                    # no newline at the end of the file
+                    ends = np.hstack((ends, [len(data)]))
+                starts = np.hstack(([0], ends[:-1] + 1))
+                line_bytes = int(ends[0] - starts[0] + 1)
+                bases = ends - starts
+                bases = bases - ((bases > 0) & (data[np.maximum(ends - 1, 0)] == 13))
+                del data
+            
+            # ignore empty lines at the end of a sequence
+            last = len(bases)
+            while last > 0 and bases[last - 1] == 0:
+                last -= 1
+            
+            if last == 0:
+                record = (name, 0, offset, 0, 0)
+            else:
+                bases = bases[:last]
+                line_bases = int(bases[0])
+                if isinstance(bases, np.ndarray):
+                    inner = set(np.unique(bases[:-1]))
+                    total = int(bases.sum())
+                else:
+                    inner = set(bases[:-1])
+                    total = sum(bases)
+                if len(inner - set([line_bases])) > 0 or bases[-1] > line_bases:
+                    raise ValueError(
+                        "Different line lengths in sequence {} of {}, "
+                        "can't index".format(name, fasta_file))
+                record = (name, total, offset, line_bases, line_bytes)
+            
+            if headers:
+                record += (header.rstrip("\r\n"),)
+            records.append(record)
+            pos = seq_end
+    finally:
+        mm.close()
+    return records
+
+class MappedGenome(object):
+    """Memory-mapped access to the sequences in one or more FASTA files.
+
+    Every FASTA file is memory-mapped once. Sequences are retrieved by 
+    slicing the mapped file, based on the offset of the sequence and the 
+    number of bases and bytes per line, as in a samtools faidx index. 
+    As there is no shared file position, one MappedGenome can be used from
+    multiple threads.
+
+    Parameters
+    ----------
+    records : dict
+        Dictionary with sequence names as keys and (fasta_file, length,
+        offset, line_bases, line_bytes) tuples as values.
+
+    Examples
+    --------
+    >>> g = MappedGenome.from_fai("hg38.fa.fai")
+    >>> g.get_seq("chr17", 7520037, 7531588)
+    """
+    
+    def __init__(self, records):
+        self.records = records
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_fai(cls, fai_file, fasta_file=None):
+        """Create a MappedGenome from a samtools faidx index.
+
+        Parameters
+        ----------
+        fai_file : str
+            Name of the .fai file.
+
+        fasta_file : str, optional
+            Name of the FASTA file, the default is the .fai filename without
+            the .fai extension.
+        """
+        if fasta_file is None:
+            fasta_file = re.sub(r'\.fai$', '', fai_file)
+        records = {}
+        with open(fai_file) as f:
+            for line in f:
+                vals = line.rstrip("\n").split("\t")
+                if len(vals) < 5:
+                    continue
+                name, length, offset, line_bases, line_bytes = vals[:5]
+                records[name] = (fasta_file, int(length), int(offset), 
+                        int(line_bases), int(line_bytes))
+        return cls(records)
+
+    def __getstate__(self):
+        # memory-maps and the lock can't be pickled
+        return {"records": self.records}
+
+    def __setstate__(self, state):
+        self.__init__(state["records"])
+
+    def _map(self, fname):
+        """Return the memory-map of a FASTA file, map it if needed."""
+        mm = self._maps.get(fname)
+        if mm is None:
+            with self._lock:
+                mm = self._maps.get(fname)
+                if mm is None:
+                    with open(fname, "rb") as f:
+                        if os.path.getsize(fname) == 0:
+                            mm = b""
+                        else:
+                            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[fname] = mm
+        return mm
+
+    def keys(self):
+        """Return the sequence names."""
+        return list(self.records.keys())
+
+    def size(self, chrom):
+        """Return the length of a sequence."""
+        if chrom not in self.records:
+            raise KeyError("chromosome {} not in index".format(chrom))
+        return self.records[chrom][1]
+
+    def get_seq_bytes(self, chrom, start, end):
+        """Return a sequence as a bytes-like object, using 0-based, half-open 
+        coordinates.
+
+        If the sequence is on a single line of the FASTA file, a read-only 
+        memoryview of the memory-mapped file is returned, without copying. 
+        Otherwise the line ends are removed and bytes are returned.
+        """
+        if chrom not in self.records:
+            raise KeyError("chromosome {} not in index".format(chrom))
+        fasta_file, length, offset, line_bases, line_bytes = self.records[chrom]
+        
+        if start > length:
+            raise ValueError(
+                    "Invalid start {0}, greater than sequence length {1} of {2}!".format(start, length, chrom))
+        if start < 0:
+            raise ValueError("Invalid start, < 0!")
+        if end > length:
+            raise ValueError(
+                    "Invalid end {0}, greater than sequence length {1} of {2}!".format(end, length, chrom))
+        if end <= start:
+            return b""
+
+        mm = self._map(fasta_file)
+        byte_start = offset + (start // line_bases) * line_bytes + start % line_bases
+        byte_end = offset + ((end - 1) // line_bases) * line_bytes + (end - 1) % line_bases + 1
+        if byte_end - byte_start == end - start:
+            return memoryview(mm)[byte_start:byte_end]
+        return mm[byte_start:byte_end].replace(b"\n", b"").replace(b"\r", b"")
+
+    def get_seq(self, chrom, start, end, strand=None):
+        """Return a sequence, using 0-based, half-open coordinates.
+
+        The reverse complement is returned if strand is '-'.
+        """
+        seq = str(self.get_seq_bytes(chrom, start, end), "ascii")
+        if strand == "-":
+            seq = rc(seq)
+        return seq
+
+    def get_seqs(self, regions, as_bytes=False):
+        """Return the sequences of multiple regions.
+
+        The regions are retrieved sorted by chromosome and position, for 
+        locality of access, and returned in the input order.
+
+        Parameters
+        ----------
+        regions : list
+            List of (chrom, start, end) or (chrom, start, end, strand) tuples.
+
+        as_bytes : bool, optional
+            Return the sequences as bytes instead of str.
+
+        Returns
+        -------
+        seqs : list
+            List of sequences.
+        """
+        regions = list(regions)
+        order = sorted(range(len(regions)), key=lambda i: tuple(regions[i][:2]))
+        seqs = [None] * len(regions)
+        for i in order:
+            chrom, start, end = regions[i][:3]
+            seq = bytes(self.get_seq_bytes(chrom, int(start), int(end)))
+            if len(regions[i]) > 3 and regions[i][3] == "-":
+                seq = seq[::-1].translate(RC_BYTES)
+            seqs[i] = seq if as_bytes else seq.decode()
+        return seqs
+
+    def close(self):
+        """Close the memory-mapped files.
+
+        A file that is still referred to by a memoryview returned by 
+        get_seq_bytes() is closed when the last memoryview is released.
+        """
+        with self._lock:
+            for mm in self._maps.values():
+                if isinstance(mm, mmap.mmap):
+                    try:
+                        mm.close()
+                    except BufferError:
+                        pass
+            self._maps = {}
+
 class GenomeIndex(object):
     """ Index fasta-formatted files for faster retrieval of sequences
         Typical use:
@@ -270,6 +534,7 @@ class GenomeIndex(object):
         self.index_file = {}
         self.line_size = {}
         self.pack_char = "L"
+        self.genome = None
 
         if self.index_dir:
             if os.path.exists(os.path.join(self.index_dir, self.param_file)):
@@ -281,24 +546,10 @@ class GenomeIndex(object):
             print("Directory %s does not exist!" % dirname)
             sys.exit(1)
     
-    def _make_index(self, fasta, index):
-        """ Index a single, one-sequence fasta-file"""
-        out = open(index, "wb")
-        f = open(fasta)
-        # Skip first line of fasta-file
-        line = f.readline()
-        offset = f.tell()
-        line = f.readline()
-        while line:
-            out.write(pack(self.pack_char, offset))
-            offset = f.tell()
-            line = f.readline()
-        f.close()
-        out.close()
-
-    def create_index(self,fasta_dir=None, index_dir=None):
-        """Index all fasta-files in fasta_dir (one sequence per file!) and
-        store the results in index_dir"""
+    def create_index(self,fasta_dir=None, index_dir=None, ncpus=None):
+        """Index all fasta-files in fasta_dir and store the results in 
+        index_dir. Files are indexed in parallel, a samtools faidx 
+        compatible .fai file is created for every FASTA file."""
         
         # Use default directories if they are not supplied
         if not fasta_dir:
@@ -359,38 +610,28 @@ class GenomeIndex(object):
                 sys.stderr.write(e)
         s_out = open(size_file, "w")
 
-        for fasta_file in fastafiles:
-            #sys.stderr.write("Indexing %s\n" % fasta_file)
-            f = open(fasta_file)
-            line = f.readline()
-            if not line.startswith(">"):
-                sys.stderr.write("%s is not a valid FASTA file, expected > at first line\n" % fasta_file)
-                sys.exit()
-            
-            seqname = line.strip().replace(">", "")
-            line = f.readline()
-            line_size = len(line.strip())
-
-            total_size = 0 
-            while line:
-                line = line.strip()
-                if line.startswith(">"):
-                    sys.stderr.write("Sorry, can only index genomes with "
-                    "one sequence per FASTA file\n%s contains multiple "
-                    "sequences\n" % fasta_file)
-                    sys.exit()
-                
-                total_size += len(line)
-                line = f.readline()
-
-            index_file = os.path.join(index_dir, "%s.index" % seqname)
-
-            out.write("{}\t{}\t{}\t{}\t{}\n".format(
-                seqname, fasta_file, index_file, line_size, total_size))
-            s_out.write("{}\t{}\n".format(seqname, total_size))
-            
-            self._make_index(fasta_file, index_file)
-            f.close()
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params().get("ncpus", 2))
+        ncpus = max(1, min(ncpus, len(fastafiles)))
+        
+        if ncpus > 1:
+            pool = Pool(ncpus)
+            all_records = pool.map(fai_records, fastafiles)
+            pool.close()
+            pool.join()
+        else:
+            all_records = [fai_records(fname) for fname in fastafiles]
+        
+        for fasta_file, records in zip(fastafiles, all_records):
+            index_file = os.path.join(
+                    index_dir, "{}.fai".format(os.path.basename(fasta_file)))
+            with open(index_file, "w") as fai:
+                for name, total_size, offset, line_size, line_bytes in records:
+                    fai.write("{}\t{}\t{}\t{}\t{}\n".format(
+                        name, total_size, offset, line_size, line_bytes))
+                    out.write("{}\t{}\t{}\t{}\t{}\n".format(
+                        name, fasta_file, index_file, line_size, total_size))
+                    s_out.write("{}\t{}\n".format(name, total_size))
         out.close()
         s_out.close()
 
@@ -407,12 +648,37 @@ class GenomeIndex(object):
                 self.fasta_file[name] = fasta_file
                 self.index_file[name] = index_file
                 self.line_size[name] = int(line_size)
-
-    def _read_seq_from_fasta(self, fasta, offset, nr_lines):
-        """ retrieve a number of lines from a fasta file-object, starting at offset"""
-        fasta.seek(offset)
-        lines = [fasta.readline().strip() for _ in range(nr_lines)]
-        return "".join(lines)
+        
+        records = {}
+        fai_files = {}
+        for name in self.size:
+            if self.index_file[name].endswith(".fai"):
+                fai_files[self.index_file[name]] = self.fasta_file[name]
+            else:
+                # index with one offset per line
+                records[name] = self._mapped_record(name)
+        for fai_file, fasta_file in fai_files.items():
+            records.update(MappedGenome.from_fai(fai_file, fasta_file).records)
+        self.genome = MappedGenome(records)
+
+    def _mapped_record(self, name):
+        """Return the offset and line layout of a sequence for MappedGenome."""
+        fasta_file = self.fasta_file[name]
+        line_size = self.line_size[name]
+        with open(self.index_file[name], "rb") as index:
+            if len(index.read(1)) == 0:
+                # empty sequence
+                return (fasta_file, 0, 0, max(line_size, 1), max(line_size, 1) + 1)
+            offset = self._get_offset_from_index(index, 0)
+        with open(fasta_file, "rb") as fasta:
+            fasta.seek(offset)
+            line_bytes = len(fasta.readline())
+        if line_size == 0:
+            line_size = 1
+        if line_bytes <= line_size:
+            # single line without newline
+            line_bytes = line_size + 1
+        return (fasta_file, self.size[name], offset, line_size, line_bytes)
 
     def _get_offset_from_index(self, index, offset):    
         size = len(pack(self.pack_char, 0))
@@ -434,30 +700,6 @@ class GenomeIndex(object):
         f.close()
                 
     
-    def _read(self, index, fasta, start, end, line_size):
-        #start = start - 1
-        start_line = start // line_size 
-        size = len(pack(self.pack_char, 0))
-        nr_lines = (end - start) // line_size + 2 
-        i_offset = size * (start_line)
-        #print start
-        #print start_line
-        #print size
-        #print nr_lines
-        #print i_offset
-        
-        d_offset = self._get_offset_from_index(index, i_offset)
-        seq = self._read_seq_from_fasta(fasta, d_offset, nr_lines)
-        #print start, nr_lines, line_size, end
-        #print start - (nr_lines - 2) * line_size, end - start
-        #print seq
-        length = end - start 
-        start = start - start_line  * line_size 
-        seq = seq[start: start + length ]
-        #print seq
-        #print
-        return seq
-    
     def get_sequences(self, chr, coords):
         """ Retrieve multiple sequences from same chr (RC not possible yet)"""    
         # Check if we have an index_dir
@@ -465,36 +707,15 @@ class GenomeIndex(object):
             print("Index dir is not defined!")
             sys.exit()
 
-        # retrieve all information for this specific sequence
-        fasta_file = self.fasta_file[chr]
-        index_file = self.index_file[chr]
-        line_size = self.line_size[chr]
-        total_size = self.size[chr]
-        index = open(index_file, "rb")
-        fasta = open(fasta_file)
-        
         seqs = []
         for coordset in coords:
             seq = ""
             for (start,end) in coordset: 
-                if start > total_size:
-                    raise ValueError("%s: %s, invalid start, greater than sequence length!" % (chr,start))
-            
-                if start < 0:
-                    raise ValueError("Invalid start, < 0!")
-                
-                if end > total_size:
-                    raise ValueError("Invalid end, greater than sequence length!")
-
-
-                seq += self._read(index, fasta, start, end, line_size)
+                seq += self.genome.get_seq(chr, start, end)
             seqs.append(seq)
-        index.close()
-        fasta.close()
 
         return seqs
 
-
     def get_sequence(self, chrom, start, end, strand=None):
         """ Retrieve a sequence """    
         # Check if we have an index_dir
@@ -502,34 +723,17 @@ class GenomeIndex(object):
             print("Index dir is not defined!")
             sys.exit()
 
-        # retrieve all information for this specific sequence
-        fasta_file = self.fasta_file[chrom]
-        index_file = self.index_file[chrom]
-        line_size = self.line_size[chrom]
-        total_size = self.size[chrom]
-
-        #print fasta_file, index_file, line_size, total_size
-        if start > total_size:
-            raise ValueError(
-                    "Invalid start {0}, greater than sequence length {1} of {2}!".format(start, total_size, chrom))
-        
-        if start < 0:
-            raise ValueError("Invalid start, < 0!")
-        
-        if end > total_size:
-            raise ValueError(
-                    "Invalid end {0}, greater than sequence length {1} of {2}!".format(end, total_size, chrom))
-
+        return self.genome.get_seq(chrom, start, end, strand)
 
-        index = open(index_file, "rb")
-        fasta = open(fasta_file)
-        seq = self._read(index, fasta, start, end, line_size)
-        index.close()
-        fasta.close()
+    def get_regions(self, regions):
+        """ Retrieve the sequences of a list of (chrom, start, end[, strand])
+        regions, sorted by chromosome and position for efficient access """
+        # Check if we have an index_dir
+        if not self.index_dir:
+            print("Index dir is not defined!")
+            sys.exit()
 
-        if strand and strand == "-":
-            seq = rc(seq)
-        return seq
+        return self.genome.get_seqs(regions)
 
     def get_chromosomes(self):
         """ Return all sequences in the index """
@@ -557,6 +761,155 @@ def rc(seq):
     d = maketrans("actgACTG","tgacTGAC")
     return seq[::-1].translate(d)
 
+RC_BYTES = bytes.maketrans(b"actgACTG", b"tgacTGAC")
+
+_MAPPED_GENOMES = {}
+
+def mapped_genome(genome):
+    """Return a MappedGenome for a genome.
+
+    The MappedGenome is created once per process for every genome.
+
+    Parameters
+    ----------
+    genome : str or Genome
+        Genome name, FASTA file or genomepy Genome object.
+
+    Returns
+    -------
+    MappedGenome
+    """
+    if not isinstance(genome, Genome):
+        genome = Genome(genome)
+    fname = os.path.abspath(genome.filename)
+    if fname not in _MAPPED_GENOMES:
+        fai_file = fname + ".fai"
+        _MAPPED_GENOMES[fname] = MappedGenome.from_fai(fai_file, fname)
+    return _MAPPED_GENOMES[fname]
+
+def _track_to_regions(track, stranded=False):
+    """Yield (name, chrom, blocks, strand) for every region in a list of 
+    regions, a region file or a BED file."""
+    if isinstance(track, list):
+        lines = track
+    else:
+        with open_file(track) as f:
+            lines = f.read().splitlines()
+    
+    region_p = re.compile(r'^(.+):(\d+)-(\d+)$')
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("track"):
+            continue
+        m = region_p.search(line)
+        if m and "\t" not in line:
+            chrom, start, end = m.group(1), int(m.group(2)), int(m.group(3))
+            yield line, chrom, [(start, end)], "+"
+            continue
+
+        vals = line.split("\t")
+        chrom, start, end = vals[0], int(vals[1]), int(vals[2])
+        name = "{}:{}-{}".format(chrom, start, end)
+        if len(vals) > 3:
+            name = " ".join((name, vals[3]))
+        strand = "+"
+        if stranded and len(vals) > 5 and vals[5] == "-":
+            strand = "-"
+        blocks = [(start, end)]
+        if len(vals) == 12:
+            # BED12
+            starts = [int(x) for x in vals[11].split(",")[:-1]]
+            sizes = [int(x) for x in vals[10].split(",")[:-1]]
+            blocks = [(start + x, start + x + size) for x, size in zip(starts, sizes)]
+        yield name, chrom, blocks, strand
+
+def fetch_sequences(genome, regions, as_bytes=False):
+    """Return the sequences of a list of genomic regions.
+
+    The regions are retrieved in sorted order from a memory-mapped genome 
+    and returned in input order.
+
+    Parameters
+    ----------
+    genome : str or Genome
+        Genome name, FASTA file or genomepy Genome object.
+
+    regions : list or array
+        Regions as (chrom, start, end) or (chrom, start, end, strand), with 
+        0-based, half-open coordinates.
+
+    as_bytes : bool, optional
+        Return the sequences as bytes instead of str.
+
+    Returns
+    -------
+    seqs : list
+        List of sequences.
+    """
+    return mapped_genome(genome).get_seqs(regions, as_bytes=as_bytes)
+
+def regions_to_fasta(genome, track, stranded=False, extend_up=0, extend_down=0):
+    """Return the sequences of genomic regions as a Fasta object.
+
+    This is an in-memory replacement of genomepy's track2fasta, the 
+    sequence names are the same.
+
+    Parameters
+    ----------
+    genome : str or Genome
+        Genome name, FASTA file or genomepy Genome object.
+
+    track : str or list
+        BED file, file with regions (chrom:start-end) or a list of regions
+        as strings or (chrom, start, end[, strand]) tuples.
+
+    stranded : bool, optional
+        Return the reverse complement of regions on the - strand.
+
+    extend_up : int, optional
+        Extend the regions upstream.
+
+    extend_down : int, optional
+        Extend the regions downstream.
+
+    Returns
+    -------
+    Fasta object
+    """
+    g = mapped_genome(genome)
+    if isinstance(track, list) and len(track) > 0 and not isinstance(track[0], str):
+        # (chrom, start, end[, strand]) tuples
+        track = [("{}:{}-{}".format(*r[:3]), r[0], [(int(r[1]), int(r[2]))], 
+                    r[3] if len(r) > 3 and stranded else "+") for r in track]
+    else:
+        track = _track_to_regions(track, stranded)
+
+    names = []
+    regions = []
+    for name, chrom, blocks, strand in track:
+        size = g.size(chrom)
+        blocks = [list(b) for b in blocks]
+        up, down = (extend_down, extend_up) if strand == "-" else (extend_up, extend_down)
+        blocks[0][0] = max(0, blocks[0][0] - up)
+        blocks[-1][1] = min(size, blocks[-1][1] + down)
+        names.append(name)
+        regions.append((chrom, blocks, strand))
+
+    # retrieve all blocks at once
+    flat = [(chrom, start, min(max(end, start), size)) 
+            for chrom, blocks, _ in regions 
+            for start, end in blocks 
+            for size in [g.size(chrom)]]
+    block_seqs = iter(g.get_seqs(flat, as_bytes=True))
+    
+    fa = Fasta()
+    for name, (_, blocks, strand) in zip(names, regions):
+        seq = b"".join([next(block_seqs) for _ in blocks])
+        if strand == "-":
+            seq = seq[::-1].translate(RC_BYTES)
+        fa.add(name, seq.decode())
+    return fa
+
 #def track2fasta(name, bedfile, fastafile, extend_up=0, extend_down=0, use_strand=False, ignore_missing=False):
 #    """ Convert a bedfile to a fastafile, given a certain index """
 #    g = genome(name)
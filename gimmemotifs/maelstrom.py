@@ -17,6 +17,7 @@ import re
 import subprocess as sp
 import shutil
 import sys
+import time
 from tempfile import NamedTemporaryFile
 import logging
 from functools import partial
@@ -34,14 +35,15 @@ sns.set_style('white')
 
 from gimmemotifs.background import RandomGenomicFasta
 from gimmemotifs.config import MotifConfig
-from gimmemotifs.moap import moap, Moap
+from gimmemotifs.moap import moap, Moap, read_motif_table, write_motif_table
 from gimmemotifs.rank import rankagg
 from gimmemotifs.motif import read_motifs
 from gimmemotifs.scanner import Scanner
 from gimmemotifs.report import maelstrom_html_report
 from gimmemotifs.utils import join_max, pwmfile_location
 
-from multiprocessing import Pool
+from multiprocessing import Pool, Process
+from multiprocessing.connection import wait
 
 BG_LENGTH = 200
 BG_NUMBER = 10000
@@ -138,6 +140,90 @@ def moap_with_table(input_table, motif_table, data_dir, method, scoring, ncpus=N
     moap(input_table, outfile=outfile, method=method, scoring=scoring, 
             motiffile=motif_table, fpr=FPR, ncpus=ncpus)
 
+def _run_method(method, scoring, func, args, kwargs):
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        logger.warning("Method %s with scoring %s failed", method, scoring)
+        logger.warning(e)
+        raise
+    logger.info("%s (%s) finished in %.1fs", method, scoring, time.time() - start)
+
+def run_methods(jobs, ncpus=None):
+    """Run motif activity methods in parallel.
+
+    Every method runs in a separate process with its own number of cores.
+    Methods are started in order as long as their cores fit in the total
+    number of cores, a method that doesn't fit waits until enough running
+    methods have finished, while later methods that do fit are started.
+
+    Parameters
+    ----------
+    jobs : list
+        List of (method, scoring, function, args, kwargs, method_ncpus) 
+        tuples. The function is called as 
+        function(*args, ncpus=method_ncpus, **kwargs). If method_ncpus is 
+        None or larger than ncpus, ncpus is used.
+
+    ncpus : int, optional
+        Total number of cores to use. Default is the number specified in 
+        the config.
+    """
+    if ncpus is None:
+        ncpus = int(MotifConfig().get_default_params().get("ncpus", 2))
+    ncpus = max(1, ncpus)
+    
+    queue = []
+    for method, scoring, func, args, kwargs, method_ncpus in jobs:
+        if method_ncpus is None:
+            method_ncpus = ncpus
+        method_ncpus = max(1, min(method_ncpus, ncpus))
+        queue.append((method, scoring, func, args, kwargs, method_ncpus))
+    logger.info("Running %s methods using %s core(s)", len(queue), ncpus)
+
+    free = ncpus
+    running = {}
+    failed = []
+    while len(queue) > 0 or len(running) > 0:
+        if not failed:
+            for job in queue[:]:
+                method, scoring, func, args, kwargs, method_ncpus = job
+                if method_ncpus > free:
+                    continue
+                queue.remove(job)
+                kwargs = dict(kwargs, ncpus=method_ncpus)
+                p = Process(target=_run_method, 
+                        args=(method, scoring, func, args, kwargs))
+                p.start()
+                logger.info("Started %s (%s) using %s core(s)", 
+                        method, scoring, method_ncpus)
+                running[p.sentinel] = (method, scoring, method_ncpus, p)
+                free -= method_ncpus
+        elif len(running) == 0:
+            break
+        
+        for sentinel in wait(list(running.keys())):
+            method, scoring, method_ncpus, p = running.pop(sentinel)
+            p.join()
+            free += method_ncpus
+            if p.exitcode != 0:
+                failed.append("{} ({})".format(method, scoring))
+    
+    if failed:
+        raise RuntimeError("Method(s) failed: {}".format(", ".join(failed)))
+
+def _motif_table_file(outdir, scoring):
+    """Return the motif table of a maelstrom output directory.
+
+    Tables are saved as memory-mappable .npy files. Text tables of 
+    previous versions are used if they exist.
+    """
+    fname = os.path.join(outdir, "motif.{}.txt.gz".format(scoring))
+    if os.path.exists(fname):
+        return fname
+    return os.path.join(outdir, "motif.{}.npy".format(scoring))
+
 def safe_join(df1, df2):     
     tmp = df1.copy()
     tmp["_safe_count"] = list(range(df1.shape[0]))
@@ -276,7 +362,8 @@ def run_maelstrom(infile, genome, outdir, pwmfile=None, plot=True, cluster=False
         well-tested.
     
     score_table : str, optional
-        Filename of pre-calculated table with motif scores.
+        Filename of pre-calculated table with motif scores. See 
+        gimmemotifs.moap.read_motif_table() for the supported formats.
 
     count_table : str, optional
         Filename of pre-calculated table with motif counts.
@@ -318,24 +405,23 @@ def run_maelstrom(infile, genome, outdir, pwmfile=None, plot=True, cluster=False
     
     # Create a file with the number of motif matches
     if not count_table:
-        count_table = os.path.join(outdir, "motif.count.txt.gz")
+        count_table = _motif_table_file(outdir, "count")
         if not os.path.exists(count_table):
             logger.info("Motif scanning (counts)")
             counts = scan_to_table(infile, genome, "count",
                 pwmfile=pwmfile, ncpus=ncpus)
-            counts.to_csv(count_table, sep="\t", compression="gzip")
+            write_motif_table(counts.astype(np.int32), count_table)
         else:
             logger.info("Counts, using: %s", count_table)
 
     # Create a file with the score of the best motif match
     if not score_table:
-        score_table = os.path.join(outdir, "motif.score.txt.gz")
+        score_table = _motif_table_file(outdir, "score")
         if not os.path.exists(score_table):
             logger.info("Motif scanning (scores)")
             scores = scan_to_table(infile, genome, "score",
                 pwmfile=pwmfile, ncpus=ncpus)
-            scores.to_csv(score_table, sep="\t", float_format="%.3f", 
-                compression="gzip")
+            write_motif_table(scores.astype(np.float32), score_table)
         else:
             logger.info("Scores, using: %s", score_table)
 
@@ -380,20 +466,26 @@ def run_maelstrom(infile, genome, outdir, pwmfile=None, plot=True, cluster=False
         logger.error("No method to run.")
         sys.exit(1)
 
+    jobs = []
     for method, scoring, fname in exps:
-        try:
-            if scoring == "count" and count_table:
-                moap_with_table(fname, count_table, outdir, method, scoring, ncpus=ncpus)
-            elif scoring == "score" and score_table:
-                moap_with_table(fname, score_table, outdir, method, scoring, ncpus=ncpus)
-            else:
-                moap_with_bg(fname, genome, outdir, method, scoring, pwmfile=pwmfile, ncpus=ncpus)
-        
-        except Exception as e:
-            logger.warn("Method %s with scoring %s failed", method, scoring)
-            logger.warn(e)
-            logger.warn("Skipping")
-            raise 
+        # methods with a motif table use their own number of cores, 
+        # otherwise scanning uses all cores
+        method_ncpus = Moap.create(method, ncpus=ncpus).max_ncpus
+        if scoring == "count" and count_table:
+            jobs.append((method, scoring, moap_with_table, 
+                (fname, count_table, outdir, method, scoring), {}, 
+                method_ncpus))
+        elif scoring == "score" and score_table:
+            jobs.append((method, scoring, moap_with_table, 
+                (fname, score_table, outdir, method, scoring), {}, 
+                method_ncpus))
+        else:
+            jobs.append((method, scoring, moap_with_bg,
+                (fname, genome, outdir, method, scoring), {"pwmfile":pwmfile},
+                None))
+    
+    run_methods(jobs, ncpus=ncpus)
+
     dfs = {}
     for method, scoring,fname  in exps:
         t = "{}.{}".format(method,scoring)
@@ -402,7 +494,7 @@ def run_maelstrom(infile, genome, outdir, pwmfile=None, plot=True, cluster=False
         try:
             dfs[t] = pd.read_table(fname, index_col=0, comment="#")
         except:
-            logging.warn("Activity file for {} not found!\n".format(t))
+            logging.warning("Activity file for {} not found!\n".format(t))
    
     if len(methods) > 1:
         logger.info("Rank aggregation")
@@ -413,7 +505,7 @@ def run_maelstrom(infile, genome, outdir, pwmfile=None, plot=True, cluster=False
     # Write motif frequency table
     
     if df.shape[1] == 1:
-        mcount = df.join(pd.read_table(count_table, index_col=0, comment="#"))
+        mcount = df.join(read_motif_table(count_table))
         m_group = mcount.groupby(df.columns[0])
         freq = m_group.sum() / m_group.count()
         freq.to_csv(os.path.join(outdir, "motif.freq.txt"), sep="\t")
@@ -466,14 +558,8 @@ class MaelstromResult():
         )
         
         # Read motif results
-        self.scores = pd.read_table(
-            os.path.join(outdir, "motif.score.txt.gz"), 
-            index_col=0
-        )
-        self.counts = pd.read_table(
-            os.path.join(outdir, "motif.count.txt.gz"), 
-            index_col=0
-        )
+        self.scores = read_motif_table(_motif_table_file(outdir, "score"))
+        self.counts = read_motif_table(_motif_table_file(outdir, "count"))
         fname = os.path.join(outdir, "motif.freq.txt")
         if os.path.exists(fname):
             self.freq = pd.read_table(
@@ -11,7 +11,9 @@ import warnings
 warnings.warn = warn
 
 import os
+import re
 import sys
+import json
 import shutil
 from functools import partial
 try: 
@@ -24,7 +26,7 @@ from multiprocessing import Pool
 
 import pandas as pd 
 import numpy as np
-from scipy.stats import ks_2samp, hypergeom,mannwhitneyu
+from scipy.stats import ks_2samp, hypergeom, mannwhitneyu, norm
 from scipy.cluster.hierarchy import linkage, fcluster
 from statsmodels.sandbox.stats.multicomp import multipletests
 from tqdm import tqdm
@@ -53,6 +55,73 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 logger = logging.getLogger("gimme.maelstrom")
 
 
+def _labels_file(fname):
+    return re.sub(r"\.npy$", ".labels.json", fname)
+
+def write_motif_table(df, fname):
+    """Write a table with motif scores or counts.
+
+    The format is based on the file extension. A .npy file is a binary 
+    NumPy array that can be memory-mapped, the region and motif names are
+    saved in a .labels.json file with the same basename. The .feather and
+    .parquet formats require pyarrow. All other filenames are written as 
+    tab-separated text, gzip-compressed if the name ends with .gz.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame with regions as index and motifs as columns.
+
+    fname : str
+        Output filename.
+    """
+    if fname.endswith(".npy"):
+        np.save(fname, df.values)
+        with open(_labels_file(fname), "w") as f:
+            json.dump({
+                "index": [str(x) for x in df.index],
+                "columns": [str(x) for x in df.columns],
+                }, f)
+    elif fname.endswith(".feather"):
+        df.reset_index().to_feather(fname)
+    elif fname.endswith(".parquet"):
+        df.to_parquet(fname)
+    else:
+        compression = "gzip" if fname.endswith(".gz") else None
+        float_format = "%.3f" if df.values.dtype.kind == "f" else None
+        df.to_csv(fname, sep="\t", float_format=float_format, 
+                compression=compression)
+
+def read_motif_table(fname, mmap=True):
+    """Read a table with motif scores or counts.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of a table written by write_motif_table(), or a 
+        tab-separated text file.
+
+    mmap : bool, optional
+        Memory-map .npy files instead of reading them into memory.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        DataFrame with regions as index and motifs as columns.
+    """
+    if fname.endswith(".npy"):
+        values = np.load(fname, mmap_mode="r" if mmap else None)
+        with open(_labels_file(fname)) as f:
+            labels = json.load(f)
+        return pd.DataFrame(values, index=labels["index"], 
+                columns=labels["columns"], copy=False)
+    if fname.endswith(".feather"):
+        df = pd.read_feather(fname)
+        return df.set_index(df.columns[0])
+    if fname.endswith(".parquet"):
+        return pd.read_parquet(fname)
+    return pd.read_table(fname, index_col=0, comment="#")
+
 class Moap(object):
     """Moap base class.
 
@@ -60,6 +129,8 @@ class Moap(object):
     """
     _predictors = {}
     name = None
+    # maximum number of cores a method can use, None if it can use all cores
+    max_ncpus = None
 
     @classmethod
     def create(cls, name, ncpus=None):
@@ -507,9 +578,61 @@ class LightningClassificationMoap(Moap):
                 self.sig_["sig"].loc[self.act_[col] <= c_low] = True
         logger.info("Done")
 
+def _mwu_pvalues(X, y):
+    """One-sided Mann-Whitney U p-values for all motifs and clusters.
+
+    The same as scipy.stats.mannwhitneyu(pos, neg, alternative="greater"),
+    using the normal approximation with tie and continuity correction.
+
+    Parameters
+    ----------
+    X : array, shape (n_regions, n_motifs)
+        Motif scores.
+
+    y : array, shape (n_regions, n_clusters)
+        Cluster membership (0 or 1).
+
+    Returns
+    -------
+    pvals : array, shape (n_clusters, n_motifs)
+        Mann-Whitney U p-values.
+    """
+    n = X.shape[0]
+    
+    # Ranks and ties are the same for all clusters
+    ranks = pd.DataFrame(X).rank(axis=0).values
+    
+    sorted_X = np.sort(X, axis=0)
+    diff = sorted_X[1:] != sorted_X[:-1]
+    true_row = np.ones((1, X.shape[1]), dtype=bool)
+    pos = np.arange(n)[:, None]
+    start = np.maximum.accumulate(
+            np.where(np.vstack((true_row, diff)), pos, 0), axis=0)
+    end = np.minimum.accumulate(
+            np.where(np.vstack((diff, true_row)), pos, n)[::-1], axis=0)[::-1]
+    tie_size = (end - start + 1).astype(float)
+    T = 1.0 - (tie_size ** 2 - 1).sum(0) / (float(n) ** 3 - n)
+    
+    # Rank sums of every cluster
+    n1 = y.sum(0)[:, None].astype(float)
+    n2 = n - n1
+    u = y.T.dot(ranks) - n1 * (n1 + 1) / 2.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sd = np.sqrt(T * n1 * n2 * (n + 1) / 12.0)
+        z = (u - (n1 * n2 / 2.0 + 0.5)) / sd
+    pvals = norm.sf(z)
+    pvals[:, T == 0] = 1
+    return pvals
+
+def _mwu_pvalues_star(args):
+    return _mwu_pvalues(*args)
+
+def _hypergeom_sf_star(args):
+    return hypergeom.sf(*args)
+
 @register_predictor('MWU')
 class MWUMoap(Moap):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, ncpus=None):
         """Predict motif activities using Mann-Whitney U p-value
     
         This method compares the motif score distribution of each 
@@ -518,6 +641,8 @@ class MWUMoap(Moap):
         
         Parameters
         ----------
+        ncpus : int, optional
+            Number of threads. Default is the number specified in the config.
        
         Attributes
         ----------
@@ -526,6 +651,9 @@ class MWUMoap(Moap):
             testing using the Benjamini-Hochberg correction
         """
         self.act_ = None
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params().get("ncpus", 2))
+        self.ncpus = ncpus
         self.act_description = ("activity values: BH-corrected "
                                "-log10 Mann-Whitney U p-value")
         self.pref_table = "score"
@@ -540,24 +668,28 @@ class MWUMoap(Moap):
         if df_y.shape[1] != 1:
             raise ValueError("y needs to have 1 label column")
         
-        # calculate Mann-Whitney U p-values
-        pvals = []
+        # calculate Mann-Whitney U p-values for all clusters at once, 
+        # in parallel over chunks of motifs
         clusters  =  df_y[df_y.columns[0]].unique()
-        for cluster in clusters:
-            pos = df_X[df_y.iloc[:,0] == cluster]
-            neg = df_X[df_y.iloc[:,0] != cluster]
-            p = []
-            for m in pos:
-                try:
-                    p.append(mannwhitneyu(pos[m], neg[m], alternative="greater")[1])
-                except Exception as e:
-                    sys.stderr.write(str(e) + "\n")
-                    sys.stderr.write("motif {} failed, setting to p = 1\n".format(m))
-                    p.append(1)
-            pvals.append(p)
+        y = np.array([(df_y.iloc[:,0] == c).values for c in clusters], 
+                dtype=float).T
+        X = df_X.values.astype(float)
+        
+        chunksize = 50
+        jobs = [(X[:, i:i + chunksize], y) for i in range(0, X.shape[1], chunksize)]
+        if self.ncpus > 1 and len(jobs) > 1:
+            pool = Pool(self.ncpus)
+            pvals = pool.map(_mwu_pvalues_star, jobs)
+            pool.close()
+            pool.join()
+        else:
+            pvals = [_mwu_pvalues_star(job) for job in jobs]
+        pvals = np.hstack(pvals)
         
+        for m in df_X.columns[(df_X.nunique() == 1).values]:
+            sys.stderr.write("motif {} failed, setting to p = 1\n".format(m))
+
         # correct for multipe testing
-        pvals = np.array(pvals)
         fpr = multipletests(pvals.flatten(), 
                 method="fdr_bh")[1].reshape(pvals.shape)
         
@@ -569,11 +701,17 @@ class MWUMoap(Moap):
 
 @register_predictor('Hypergeom')
 class HypergeomMoap(Moap):
-    def __init__(self, *args, **kwargs):
+    # p-values are calculated for all motifs at once, which is fast enough
+    # that one core is sufficient
+    max_ncpus = 1
+
+    def __init__(self, ncpus=None):
         """Predict motif activities using hypergeometric p-value
 
         Parameters
         ----------
+        ncpus : int, optional
+            Number of threads. Default is the number specified in the config.
        
         Attributes
         ----------
@@ -582,6 +720,9 @@ class HypergeomMoap(Moap):
             testing using the Benjamini-Hochberg correction
         """
         self.act_ = None
+        if ncpus is None:
+            ncpus = int(MotifConfig().get_default_params().get("ncpus", 2))
+        self.ncpus = ncpus
         self.act_description = ("activity values: -log10-transformed, BH-corrected "
                                 "hypergeometric p-values")
         self.pref_table = "count"
@@ -595,32 +736,32 @@ class HypergeomMoap(Moap):
         if df_y.shape[1] != 1:
             raise ValueError("y needs to have 1 label column")
        
-        if set(df_X.dtypes) != set([np.dtype(int)]):
+        if not all([np.issubdtype(dtype, np.integer) for dtype in df_X.dtypes]):
             raise ValueError("need motif counts, not scores")
 
-        # calculate hypergeometric p-values
-        pvals = []
+        # count regions with motif for all clusters at once
         clusters = df_y[df_y.columns[0]].unique()
+        y = np.array([(df_y.iloc[:,0] == c).values for c in clusters], 
+                dtype=int)
         M = df_X.shape[0]
-        for cluster in clusters:
-            pos = df_X[df_y.iloc[:,0] == cluster]
-            neg = df_X[df_y.iloc[:,0] != cluster]
-            
-            pos_true = (pos > 0).sum(0)
-            pos_false = (pos == 0).sum(0)
-            neg_true = (neg > 0).sum(0)
-            
-            p = []
-            for pt, pf, nt in zip(pos_true, pos_false, neg_true):
-                n = pt + nt
-                N = pt + pf
-                x = pt - 1
-                p.append(hypergeom.sf(x, M, n, N))
-            
-            pvals.append(p)
+        has_motif = (df_X.values > 0).astype(int)
         
-        # correct for multipe testing
+        pos_true = y.dot(has_motif)
+        n = has_motif.sum(0)
+        N = y.sum(1)[:, None]
+        
+        # calculate hypergeometric p-values, in parallel over clusters
+        jobs = [(pos_true[i] - 1, M, n, N[i]) for i in range(len(clusters))]
+        if self.ncpus > 1 and len(jobs) > 1:
+            pool = Pool(self.ncpus)
+            pvals = pool.map(_hypergeom_sf_star, jobs)
+            pool.close()
+            pool.join()
+        else:
+            pvals = [_hypergeom_sf_star(job) for job in jobs]
         pvals = np.array(pvals)
+        
+        # correct for multipe testing
         fpr = multipletests(pvals.flatten(), 
                 method="fdr_bh")[1].reshape(pvals.shape)
         
@@ -837,7 +978,8 @@ def moap(inputfile, method="hypergeom", scoring=None, outfile=None, motiffile=No
     
     motiffile : str, optional
         Table with motif scan results. First column should be exactly the same
-        regions as in the inputfile.
+        regions as in the inputfile. See read_motif_table() for the supported
+        formats.
     
     pwmfile : str, optional
         File with motifs in pwm format. Required when motiffile is not 
@@ -912,7 +1054,7 @@ def moap(inputfile, method="hypergeom", scoring=None, outfile=None, motiffile=No
 
         motifs = pd.DataFrame(scores, index=df.index, columns=motif_names)
     else:
-        motifs = pd.read_table(motiffile, index_col=0, comment="#")   
+        motifs = read_motif_table(motiffile)
 
     if outfile and os.path.exists(outfile):
         out = pd.read_table(outfile, index_col=0, comment="#")
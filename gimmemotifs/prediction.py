@@ -21,7 +21,7 @@ from gimmemotifs import tools as tool_classes
 from gimmemotifs.config import MotifConfig, parse_denovo_params
 from gimmemotifs.fasta import Fasta
 from gimmemotifs import mytmpdir
-from gimmemotifs.stats import calc_stats
+from gimmemotifs.stats import calc_background_stats
 
 logger = logging.getLogger("gimme.prediction")
 
@@ -39,19 +39,16 @@ except:
     pass
 
 
-def mp_calc_stats(motifs, fg_fa, bg_fa, bg_name=None):
-    """Parallel calculation of motif statistics."""
+def mp_calc_stats(motifs, fg_fa, background):
+    """Parallel calculation of motif statistics for all backgrounds."""
     try:
-        stats = calc_stats(motifs, fg_fa, bg_fa, ncpus=1)
+        stats = calc_background_stats(motifs, fg_fa, background, ncpus=1)
     except Exception as e:
         raise
         sys.stderr.write("ERROR: {}\n".format(str(e)))
         stats = {}
 
-    if not bg_name:
-        bg_name = "default"
-
-    return bg_name, stats
+    return stats
 
 def _run_tool(job_name, t, fastafile, params):
     """Parallel motif prediction."""
@@ -116,13 +113,12 @@ class PredictionResult(object):
         if self.do_stats and len(motifs) > 0:
             #job_id = "%s_%s" % (motif.id, motif.to_consensus())
             logger.debug("Starting stats job of %s motifs", len(motifs))
-            for bg_name, bg_fa in self.background.items():
-                job = self.job_server.apply_async(
-                                    mp_calc_stats, 
-                                    (motifs, self.fg_fa, bg_fa, bg_name), 
-                                    callback=self.add_stats
-                                    )
-                self.stat_jobs.append(job)
+            job = self.job_server.apply_async(
+                                mp_calc_stats, 
+                                (motifs, self.fg_fa, self.background), 
+                                callback=self.add_stats
+                                )
+            self.stat_jobs.append(job)
         
         logger.debug("stdout %s: %s", job, stdout)
         logger.debug("stdout %s: %s", job, stderr)
@@ -136,16 +132,15 @@ class PredictionResult(object):
             job.get()
         sleep(2)
 
-    def add_stats(self, args):
+    def add_stats(self, stats):
         """Callback to add motif statistics."""
-        bg_name, stats = args
-        logger.debug("Stats: %s %s", bg_name, stats)
+        logger.debug("Stats: %s", stats)
         
         for motif_id in stats.keys():
             if motif_id not in self.stats:
                 self.stats[motif_id] = {}
         
-            self.stats[motif_id][bg_name] = stats[motif_id]
+            self.stats[motif_id].update(stats[motif_id])
 
 #    def submit_remaining_stats(self):
 #        for motif in self.motifs:
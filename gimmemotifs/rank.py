@@ -10,6 +10,7 @@ import subprocess as sp
 import pandas as pd
 import numpy as np
 from scipy.misc import factorial
+from scipy.stats import beta
 from statsmodels.sandbox.stats.multicomp import multipletests
 
 def rankagg_R(df, method="stuart"):
@@ -68,7 +69,69 @@ def qStuart(r):
 
     return(factorial(N) * v[N])
 
-def rankagg(df, method="stuart"):
+def qStuart_matrix(rmat):
+    """Stuart's q for every row of a matrix of sorted normalized ranks.
+
+    Same as qStuart(), but for all rows at once. The factorials and signs
+    are computed only once.
+
+    Parameters
+    ----------
+    rmat : array_like
+        Normalized ranks (between 0 and 1), sorted in every row. All rows 
+        should have the same number of ranks.
+
+    Returns
+    -------
+    q : numpy.ndarray
+        Stuart's q for every row.
+    """
+    rmat = np.asarray(rmat, dtype=float)
+    n_rows, N = rmat.shape
+    l_k = np.arange(N)
+    ones = (-1.0) ** l_k
+    f = factorial(l_k + 1)
+    
+    v = np.ones((n_rows, N + 1))
+    for k in range(N):
+        p = rmat[:, [N - k - 1]] ** (l_k[:k + 1] + 1)
+        v[:, k + 1] = (v[:, k::-1] * p / f[:k + 1]).dot(ones[:k + 1])
+
+    return factorial(N) * v[:, N]
+
+def rho_scores(rmat, exact=False):
+    """Robust rank aggregation (RRA) rho score for every row.
+
+    The rho score is the minimum of the beta p-values of the sorted 
+    normalized ranks, corrected for the number of ranks. The approximate
+    correction is Bonferroni-like (beta(1, N)), the exact correction uses
+    Stuart's q.
+
+    Parameters
+    ----------
+    rmat : array_like
+        Normalized ranks (between 0 and 1), sorted in every row.
+
+    exact : bool, optional
+        Use the exact p-value correction (slower).
+
+    Returns
+    -------
+    rho : numpy.ndarray
+        P-value for every row.
+    """
+    rmat = np.asarray(rmat, dtype=float)
+    N = rmat.shape[1]
+    k = np.arange(1, N + 1)
+    rho = beta.cdf(rmat, k, N - k + 1).min(1)
+    
+    if not exact:
+        return beta.cdf(rho, 1, N)
+    
+    qmat = 1 - beta.ppf(rho[:, None], k, N - k + 1)
+    return 1 - qStuart_matrix(np.sort(qmat, 1))
+
+def rankagg(df, method="stuart", exact=False):
     """Return aggregated ranks.
 
     Implementation is ported from the RobustRankAggreg R package
@@ -80,21 +143,42 @@ def rankagg(df, method="stuart"):
     Parameters
     ----------
     df : pandas.DataFrame
-        DataFrame with values to be ranked and aggregated
+        DataFrame with values to be ranked and aggregated. Every column 
+        should contain the same items, otherwise a ValueError is raised.
+
+    method : str, optional
+        "stuart" (default) or "rra" for the beta-based rho score.
+
+    exact : bool, optional
+        Use the exact p-value correction of the rho score (method "rra").
 
     Returns
     -------
     pandas.DataFrame with aggregated ranks
     """
-    rmat = pd.DataFrame(index=df.iloc[:,0])
-
-    step = 1 / rmat.shape[0]
-    for col in df.columns:
-        rmat[col] = pd.DataFrame({col:np.arange(step, 1 + step, step)}, index=df[col]).loc[rmat.index]
-    rmat = rmat.apply(sorted, 1, result_type="expand")
-    p = rmat.apply(qStuart, 1)
+    index = pd.Index(df.iloc[:,0])
+    
+    # normalized rank of every item in every column
+    step = 1 / index.shape[0]
+    ranks = step + np.arange(index.shape[0]) * step
+    positions = np.array([pd.Index(df[col]).get_indexer(index) 
+        for col in df.columns]).T
+    if (positions == -1).any():
+        missing = index[(positions == -1).any(1)]
+        raise ValueError("all columns should contain the same items, missing "
+                "items: {}".format(", ".join(str(x) for x in missing[:10])))
+    rmat = ranks[positions]
+    rmat = np.sort(rmat, 1)
+    
+    if method == "stuart":
+        p = qStuart_matrix(rmat)
+    elif method == "rra":
+        p = rho_scores(rmat, exact=exact)
+    else:
+        raise ValueError("unknown method {}".format(method))
+    
     df = pd.DataFrame(
         {"p.adjust":multipletests(p, method="h")[1]}, 
-        index=rmat.index).sort_values('p.adjust')     
+        index=index).sort_values('p.adjust')     
     
     return df["p.adjust"] 
@@ -10,7 +10,7 @@ on the basis of motif scanning results.
 """
 
 # External imports
-from scipy.stats import stats, scoreatpercentile, kstest, fisher_exact
+from scipy.stats import stats, scoreatpercentile, kstest, fisher_exact, hypergeom
 from sklearn.metrics import precision_recall_curve, roc_auc_score, roc_curve, average_precision_score
 import numpy as np
 
@@ -20,7 +20,7 @@ __all__ = [
     "score_at_fpr",
     "enr_at_fpr",
     "max_enrichment",
-    "phyper_at_fpr", 
+    "phyper_at_fpr",
     "mncp",
     "roc_auc",
     "roc_auc_xlim",
@@ -30,6 +30,32 @@ __all__ = [
     "ks_significance",
 ]
 
+# Metrics that can be calculated for many motifs at once by matrix_metrics()
+MATRIX_METRICS = [
+    "recall_at_fdr",
+    "fraction_fpr",
+    "score_at_fpr",
+    "enr_at_fpr",
+    "max_enrichment",
+    "phyper_at_fpr",
+    "mncp",
+    "roc_auc",
+    "roc_auc_xlim",
+    "pr_auc",
+    "max_fmeasure",
+]
+
+# Metrics that can be approximated from score histograms by histogram_metrics()
+HISTOGRAM_METRICS = [
+    "recall_at_fdr",
+    "fraction_fpr",
+    "score_at_fpr",
+    "enr_at_fpr",
+    "max_enrichment",
+    "roc_auc",
+    "pr_auc",
+]
+
 def requires_scores(f):
     f.input_type = "score"
     return f
@@ -354,7 +380,7 @@ def roc_auc(fg_vals, bg_vals):
 
 
 @requires_scores
-def roc_auc_xlim(x_bla, y_bla, xlim=0.1):
+def roc_auc_xlim(fg_vals, bg_vals, xlim=0.1):
     """
     Computes the ROC Area Under Curve until a certain FPR value.
 
@@ -374,74 +400,25 @@ def roc_auc_xlim(x_bla, y_bla, xlim=0.1):
     score : float
         ROC AUC score
     """
-    x = x_bla[:]
-    y = y_bla[:]
-
-    x.sort()
-    y.sort()
-
-    u = {}
-    for i in x + y:
-        u[i] = 1
-
-    vals = sorted(u.keys())
-    
-    len_x = float(len(x))
-    len_y = float(len(y))
+    fg_vals = np.asarray(fg_vals, dtype=float)
+    bg_vals = np.asarray(bg_vals, dtype=float)
+    len_fg = len(fg_vals)
+    len_bg = len(bg_vals)
     
-    new_x = []
-    new_y = []
-    
-    x_p = 0
-    y_p = 0
-    for val in vals[::-1]:
-        while len(x) > 0 and x[-1] >= val:
-            x.pop()
-            x_p += 1
-        while len(y) > 0 and y[-1] >= val:
-            y.pop()
-            y_p += 1
-        new_y.append((len_x - x_p) / len_x)
-        new_x.append((len_y - y_p) / len_y)
-    
-    #print new_x
-    #print new_y
-    new_x = 1 - np.array(new_x)
-    new_y = 1 - np.array(new_y)
-    #plot(new_x, new_y)
-    #show()
-
-    x = new_x
-    y = new_y
+    # True and false positives at every distinct score, from high to low
+    scores = np.hstack((fg_vals, bg_vals))
+    idx = np.argsort(-scores, kind="mergesort")
+    tps = np.cumsum(idx < len_fg)
+    fps = np.arange(1, len(scores) + 1) - tps
+    end = np.hstack((np.diff(scores[idx]) != 0, True))
 
-    if len(x) != len(y):
-        raise ValueError("Unequal!")
+    x = 1 - (len_bg - fps[end]) / float(len_bg)
+    y = 1 - (len_fg - tps[end]) / float(len_fg)
 
     if not xlim:
         xlim = 1.0
 
-    auc = 0.0
-    bla = zip(stats.rankdata(x), range(len(x)))
-    bla = sorted(bla, key=lambda x: x[1])
-    
-    prev_x = x[bla[0][1]]
-    prev_y = y[bla[0][1]]
-    index = 1
-
-    while index < len(bla) and x[bla[index][1]] <= xlim:
-
-        _, i = bla[index]
-        
-        auc += y[i] * (x[i] - prev_x) - ((x[i] - prev_x) * (y[i] - prev_y) / 2.0)
-        prev_x = x[i]
-        prev_y = y[i]
-        index += 1
-    
-    if index < len(bla):
-        (rank, i) = bla[index]
-        auc += prev_y * (xlim - prev_x) + ((y[i] - prev_y)/(x[i] - prev_x) * (xlim -prev_x) * (xlim - prev_x)/2)
- 
-    return auc
+    return _roc_auc_xlim(x[None], y[None], xlim)[0]
 
 @requires_scores
 def roc_values(fg_vals, bg_vals):
@@ -555,3 +532,370 @@ def ks_significance(fg_pos, bg_pos=None):
     
 
  
+
+
+def _tie_groups(sorted_scores):
+    """Return start and end index of the group of ties for every position.
+
+    The input is an array of scores that are sorted in every row.
+    """
+    n_rows, n_cols = sorted_scores.shape
+    pos = np.arange(n_cols)
+    diff = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    true_col = np.ones((n_rows, 1), dtype=bool)
+    start = np.maximum.accumulate(
+            np.where(np.hstack((true_col, diff)), pos, 0), axis=1)
+    end = np.minimum.accumulate(
+            np.where(np.hstack((diff, true_col)), pos, n_cols)[:, ::-1], axis=1)[:, ::-1]
+    return start, end
+
+def _rank_auc(fg_ranks, len_bg):
+    """ROC AUC from the ranks of the positives (Mann-Whitney U)."""
+    len_fg = fg_ranks.shape[1]
+    u = fg_ranks.sum(1) - len_fg * (len_fg + 1) / 2.0
+    return u / (len_fg * float(len_bg))
+
+def roc_auc_matrix(fg_scores, bg_scores):
+    """
+    Computes the ROC AUC for many motifs at once.
+
+    The ROC AUC is equal to the Mann-Whitney U statistic divided by the 
+    product of the number of positives and negatives. The U statistic is 
+    calculated from the (average) rank of every positive score within the
+    sorted negative scores.
+
+    Parameters
+    ----------
+    fg_scores : array_like
+        Scores for the positive set, shape (motifs, positive sequences).
+
+    bg_scores : array_like
+        Scores for the negative set, shape (motifs, negative sequences).
+
+    Returns
+    -------
+    score : array
+        ROC AUC score for every motif.
+    """
+    fg_scores = np.atleast_2d(np.asarray(fg_scores, dtype=float))
+    bg_scores = np.sort(np.atleast_2d(np.asarray(bg_scores, dtype=float)), axis=1)
+    len_fg = fg_scores.shape[1]
+    len_bg = bg_scores.shape[1]
+    
+    # Number of negatives with a lower score, ties count for one half
+    u = np.array([
+        np.sum(np.searchsorted(bg, fg, "left") + np.searchsorted(bg, fg, "right"))
+        for fg, bg in zip(fg_scores, bg_scores)]) / 2.0
+    return u / (len_fg * float(len_bg))
+
+def _group_ends(tps, fps, scores):
+    """Return the curve points at every distinct score.
+
+    The input arrays are sorted from high to low score. The output arrays
+    contain the values at the last position of every group of tied scores.
+    As the number of distinct scores differs between rows, rows are padded
+    with the last value.
+    """
+    end = np.hstack((scores[:, 1:] != scores[:, :-1], 
+        np.ones((len(scores), 1), dtype=bool)))
+    n_ends = end.sum(1)
+    rows, cols = np.nonzero(end)
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(n_ends) - n_ends, n_ends)
+    
+    result = []
+    for a in tps, fps:
+        ends = np.repeat(a[:, -1:], n_ends.max(), axis=1)
+        ends[rows, pos] = a[rows, cols]
+        result.append(ends)
+    return result[0], result[1], n_ends
+
+def _roc_auc_xlim(x, y, xlim):
+    """Partial ROC AUC until xlim for all rows of x (FPR) and y (TPR).
+
+    The area is calculated from the first point, not from the origin.
+    """
+    if x.shape[1] < 2:
+        return np.zeros(len(x))
+
+    dx = np.diff(x, axis=1)
+    terms = y[:, 1:] * dx - dx * np.diff(y, axis=1) / 2.0
+    inside = x[:, 1:] <= xlim
+    auc = np.sum(np.where(inside, terms, 0), 1)
+    
+    # Interpolate to xlim for the first point beyond xlim
+    rows = np.nonzero(~inside.all(1))[0]
+    i = np.argmin(inside[rows], 1) + 1
+    prev_x, prev_y = x[rows, i - 1], y[rows, i - 1]
+    auc[rows] += prev_y * (xlim - prev_x) + ((y[rows, i] - prev_y) / 
+            (x[rows, i] - prev_x) * (xlim - prev_x) * (xlim - prev_x) / 2)
+    return auc
+
+def matrix_metrics(fg_vals, bg_vals, stats=None, fpr=0.01, fdr_cutoff=0.1, minbg=2, xlim=0.1):
+    """
+    Computes score-based metrics for many motifs at once.
+
+    The scores of every motif are sorted once. All metrics are calculated 
+    from the cumulative number of true and false positives of the sorted 
+    scores, for all motifs at the same time. The results are the same as
+    those of the individual metric functions.
+
+    Parameters
+    ----------
+    fg_vals : array_like
+        Values for the positive set, shape (motifs, positive sequences).
+
+    bg_vals : array_like
+        Values for the negative set, shape (motifs, negative sequences).
+
+    stats : list, optional
+        Names of the metrics to calculate, default are all metrics in 
+        MATRIX_METRICS.
+
+    fpr : float, optional
+        The FPR for fraction_fpr, score_at_fpr, enr_at_fpr and phyper_at_fpr.
+    
+    fdr_cutoff : float, optional
+        The FDR for recall_at_fdr.
+
+    minbg : int, optional
+        Minimum number of matches in background for max_enrichment.
+
+    xlim : float, optional
+        FPR value for roc_auc_xlim.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with metric names as keys and an array with the value for
+        every motif as values. If there is no maximum F-measure, the value is
+        NaN.
+    """
+    if stats is None:
+        stats = MATRIX_METRICS
+    
+    unknown = [s for s in stats if s not in MATRIX_METRICS]
+    if len(unknown) > 0:
+        raise ValueError("Can't calculate {}".format(",".join(unknown)))
+    
+    fg_vals = np.asarray(fg_vals, dtype=float)
+    bg_vals = np.asarray(bg_vals, dtype=float)
+    n_motifs, len_fg = fg_vals.shape
+    len_bg = bg_vals.shape[1]
+    total = len_fg + len_bg
+    
+    if list(stats) == ["roc_auc"]:
+        # Only the negative scores need to be sorted
+        return {"roc_auc": roc_auc_matrix(fg_vals, bg_vals)}
+
+    # Sort the scores of every motif once
+    scores = np.hstack((fg_vals, bg_vals))
+    rows = np.arange(n_motifs)[:, None]
+    idx = np.argsort(scores, axis=1)
+    sorted_scores = scores[rows, idx]
+    sorted_labels = np.hstack((np.ones(len_fg), np.zeros(len_bg)))[idx]
+
+    is_fg = sorted_labels == 1
+
+    # Cumulative true and false positives from high to low score
+    tps = np.cumsum(sorted_labels[:, ::-1], axis=1)
+    fps = np.arange(1, total + 1) - tps
+    curve_stats = ["pr_auc", "recall_at_fdr", "max_fmeasure", "roc_auc_xlim"]
+    if any([s in stats for s in curve_stats]):
+        tp, fp, n_ends = _group_ends(tps, fps, sorted_scores[:, ::-1])
+    
+    if "roc_auc" in stats or "mncp" in stats:
+        start, end = _tie_groups(sorted_scores)
+        total_rank = ((start + end) / 2.0 + 1)[is_fg].reshape(n_motifs, len_fg)
+
+    result = {}
+    if "roc_auc" in stats:
+        result["roc_auc"] = _rank_auc(total_rank, len_bg)
+    
+    if "pr_auc" in stats:
+        delta_tp = np.diff(np.hstack((np.zeros((n_motifs, 1)), tp)), axis=1)
+        result["pr_auc"] = np.sum(delta_tp / len_fg * tp / (tp + fp), 1)
+
+    if "recall_at_fdr" in stats:
+        fdr = 1 - tp / (tp + fp)
+        recall = np.where(fdr <= fdr_cutoff, tp / tp[:, -1:], 0)
+        result["recall_at_fdr"] = recall.max(1)
+    
+    if "max_fmeasure" in stats:
+        # Only use the points that are kept by sklearn roc_curve()
+        keep = np.hstack((
+            np.ones((n_motifs, 1), dtype=bool),
+            np.logical_or(np.diff(fp, 2, axis=1), np.diff(tp, 2, axis=1)),
+            np.ones((n_motifs, 1), dtype=bool)))
+        keep[n_ends <= 2] = True
+        x = fp / fp[:, -1:]
+        y = tp / tp[:, -1:]
+        p = y / (y + x)
+        filt = keep & ((p * y) > 0) & ((p + y) > 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f = np.where(filt, (2 * p * y) / (p + y), -np.inf)
+        f = f.max(1)
+        f[np.isinf(f)] = np.nan
+        result["max_fmeasure"] = f
+
+    if "roc_auc_xlim" in stats:
+        x = 1 - (len_bg - fp) / float(len_bg)
+        y = 1 - (len_fg - tp) / float(len_fg)
+        result["roc_auc_xlim"] = _roc_auc_xlim(x, y, xlim if xlim else 1.0)
+
+    if "max_enrichment" in stats:
+        # All top k scores, for k from 1 to total - 1, ties are not grouped
+        fg_count = tps[:, :-1]
+        bg_count = fps[:, :-1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            enr = (fg_count / len_fg) / (bg_count / len_bg)
+        enr = np.where(bg_count >= minbg, enr, 0)
+        result["max_enrichment"] = np.max(np.hstack((np.zeros((n_motifs, 1)), enr)), 1)
+
+    if "mncp" in stats:
+        # Average ranks within the positive set
+        fg_cum = np.cumsum(sorted_labels, axis=1)
+        fg_before = (fg_cum - sorted_labels)[rows, start]
+        fg_in_group = fg_cum[rows, end] - fg_before
+        fg_rank = (fg_before + (fg_in_group + 1) / 2.0)[is_fg].reshape(n_motifs, len_fg)
+        slopes = ((len_fg - fg_rank + 1) / len_fg ) / (
+                (total - total_rank + 1)/ total)
+        result["mncp"] = np.mean(slopes, 1)
+
+    fpr_stats = ["fraction_fpr", "score_at_fpr", "enr_at_fpr", "phyper_at_fpr"]
+    if any([s in stats for s in fpr_stats]):
+        # Same as scoreatpercentile() of the sorted background scores
+        bg_sorted = sorted_scores[sorted_labels == 0].reshape(n_motifs, len_bg)
+        i = (100 - 100 * fpr) / 100.0 * (len_bg - 1)
+        if i == int(i):
+            cutoff = bg_sorted[:, int(i)]
+        else:
+            a, b = bg_sorted[:, int(i)], bg_sorted[:, int(i) + 1]
+            cutoff = a + (b - a) * (i - int(i))
+        
+        fg_matches = np.sum(fg_vals >= cutoff[:, None], 1)
+        bg_matches = np.sum(bg_vals >= cutoff[:, None], 1)
+
+        if "score_at_fpr" in stats:
+            result["score_at_fpr"] = cutoff
+        if "fraction_fpr" in stats:
+            result["fraction_fpr"] = fg_matches / float(len_fg)
+        if "enr_at_fpr" in stats:
+            with np.errstate(divide="ignore"):
+                enr = fg_matches / bg_matches.astype(float) * len_bg / float(len_fg)
+            result["enr_at_fpr"] = np.where(bg_matches == 0, np.inf, enr)
+        if "phyper_at_fpr" in stats:
+            # Fisher's exact test, alternative "greater"
+            # Older scipy versions can't broadcast the hypergeom parameters
+            pval = np.array([hypergeom.cdf(k, total, n, len_bg) for k, n in 
+                zip(bg_matches, fg_matches + bg_matches)])
+            no_test = (fg_matches + bg_matches == 0) | (fg_matches + bg_matches == total)
+            result["phyper_at_fpr"] = np.where(no_test, 1.0, pval)
+
+    return result
+
+def histogram_metrics(fg_hist, bg_hist, bin_edges, stats=None, fpr=0.01, fdr_cutoff=0.1, minbg=2):
+    """
+    Approximates score-based metrics from score histograms.
+
+    All scores in the same bin are treated as ties. The finer the bins, the
+    closer the results are to the exact metrics. For the ROC AUC the maximum 
+    absolute error is returned as well (roc_auc_error). This error is caused
+    by the unknown order of positive and negative scores within a bin. The 
+    score at a specific FPR is rounded down to a bin edge, so the error is at
+    most one bin width. The other metrics at an FPR are calculated at this 
+    rounded score.
+
+    Parameters
+    ----------
+    fg_hist : array_like
+        Histogram counts for the positive set, shape (motifs, bins).
+
+    bg_hist : array_like
+        Histogram counts for the negative set, shape (motifs, bins).
+
+    bin_edges : array_like
+        Bin edges, in increasing order, shape (motifs, bins + 1).
+
+    stats : list, optional
+        Names of the metrics to calculate, default are all metrics in 
+        HISTOGRAM_METRICS.
+
+    fpr : float, optional
+        The FPR for fraction_fpr, score_at_fpr and enr_at_fpr.
+    
+    fdr_cutoff : float, optional
+        The FDR for recall_at_fdr.
+
+    minbg : int, optional
+        Minimum number of matches in background for max_enrichment.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with metric names as keys and an array with the value for
+        every motif as values.
+    """
+    if stats is None:
+        stats = HISTOGRAM_METRICS
+    
+    unknown = [s for s in stats if s not in HISTOGRAM_METRICS]
+    if len(unknown) > 0:
+        raise ValueError("Can't calculate {}".format(",".join(unknown)))
+    
+    fg_hist = np.asarray(fg_hist, dtype=float)
+    bg_hist = np.asarray(bg_hist, dtype=float)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    n_motifs = len(fg_hist)
+    len_fg = fg_hist.sum(1)[:, None]
+    len_bg = bg_hist.sum(1)[:, None]
+    zeros = np.zeros((n_motifs, 1))
+
+    # Cumulative true and false positives from the highest bin down
+    tp = np.cumsum(fg_hist[:, ::-1], axis=1)
+    fp = np.cumsum(bg_hist[:, ::-1], axis=1)
+    low_edges = bin_edges[:, -2::-1]
+
+    result = {}
+    if "roc_auc" in stats:
+        result["roc_auc"] = np.trapz(
+                np.hstack((zeros, tp)) / len_fg, 
+                np.hstack((zeros, fp)) / len_bg, axis=1)
+        result["roc_auc_error"] = np.sum(fg_hist * bg_hist, 1) / (
+                2 * len_fg[:, 0] * len_bg[:, 0])
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        precision = tp / (tp + fp)
+    
+    if "pr_auc" in stats:
+        delta_tp = np.diff(np.hstack((zeros, tp)), axis=1)
+        result["pr_auc"] = np.nansum(delta_tp / len_fg * precision, 1)
+
+    if "recall_at_fdr" in stats:
+        recall = np.where(1 - precision <= fdr_cutoff, tp / len_fg, 0)
+        result["recall_at_fdr"] = recall.max(1)
+    
+    if "max_enrichment" in stats:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            enr = (tp / len_fg) / (fp / len_bg)
+        enr = np.where(fp >= minbg, enr, 0)
+        result["max_enrichment"] = np.max(np.hstack((zeros, enr)), 1)
+
+    fpr_stats = ["fraction_fpr", "score_at_fpr", "enr_at_fpr"]
+    if any([s in stats for s in fpr_stats]):
+        # Lowest bin where the fraction of background above the lower edge
+        # is at most the FPR (or the highest bin).
+        i = np.maximum(np.sum(fp / len_bg <= fpr, 1) - 1, 0)
+        rows = np.arange(n_motifs)
+        fg_matches = tp[rows, i]
+        bg_matches = fp[rows, i]
+        
+        if "score_at_fpr" in stats:
+            result["score_at_fpr"] = low_edges[rows, i]
+        if "fraction_fpr" in stats:
+            result["fraction_fpr"] = fg_matches / len_fg[:, 0]
+        if "enr_at_fpr" in stats:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                enr = fg_matches / bg_matches * len_bg[:, 0] / len_fg[:, 0]
+            result["enr_at_fpr"] = np.where(bg_matches == 0, np.inf, enr)
+
+    return result
@@ -21,7 +21,7 @@ from diskcache import Cache
 import numpy as np
 from scipy.stats import scoreatpercentile
 
-from gimmemotifs.background import RandomGenomicFasta
+from gimmemotifs.background import BackgroundCache
 from gimmemotifs.config import MotifConfig,CACHE_DIR
 from gimmemotifs.fasta import Fasta
 from gimmemotifs.c_metrics import pwmscan
@@ -95,6 +95,66 @@ def scan_to_best_match(fname, motifs, ncpus=None, genome=None, score=False):
     
     return result
 
+def scan_to_best_match_arrays(fname, motifs, ncpus=None, genome=None):
+    """Scan a FASTA file with motifs.
+
+    Scan a FASTA file and return the score, position and strand of the best
+    match per motif as arrays. Compared to scan_to_best_match() this uses 
+    much less memory.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of a sequence file in FASTA format.
+
+    motifs : list
+        List of motif instances.
+
+    ncpus : int, optional
+        Number of cores to use.
+
+    genome : str, optional
+        Genome or index directory in case of BED/regions.
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        Best score of every motif in every sequence, shape (motifs, sequences).
+
+    positions : numpy.ndarray
+        Position of the best match, shape (motifs, sequences).
+
+    strands : numpy.ndarray
+        Strand of the best match, 1 or -1, shape (motifs, sequences).
+    """
+    # Initialize scanner
+    s = Scanner(ncpus=ncpus)
+    s.set_motifs(motifs)
+    s.set_threshold(threshold=0.0)
+    if genome:
+        s.set_genome(genome)
+    
+    if isinstance(motifs, six.string_types):
+        motifs = read_motifs(motifs)
+
+    logger.debug("scanning %s...", fname)
+    scores = []
+    positions = []
+    strands = []
+    for matches in s.best_match(fname):
+        scores.append([m[0] for m in matches])
+        positions.append([m[1] for m in matches])
+        strands.append([m[2] for m in matches])
+
+    # Close the pool and reclaim memory
+    del s
+    
+    shape = (len(scores), len(motifs))
+    scores = np.array(scores, dtype=float).reshape(shape).T
+    positions = np.array(positions, dtype=int).reshape(shape).T
+    strands = np.array(strands, dtype=np.int8).reshape(shape).T
+    return scores, positions, strands
+
 def parse_threshold_values(motif_file, cutoff):
     motifs = read_motifs(motif_file)
     d = parse_cutoff(motifs, cutoff)
@@ -225,7 +285,7 @@ def scan_it_moods(infile, motifs, cutoff, bgfile, nreport=1, scan_rc=True, pvalu
     fa = Fasta(infile)
     chunk = 500
     if (len(fa) / chunk) < ncpus:
-        chunk = len(fa) / (ncpus + 1)
+        chunk = max(1, len(fa) // (ncpus + 1))
 
     jobs = []
     func = scan_fa_with_motif_moods
@@ -419,13 +479,9 @@ class Scanner(object):
         
         
         logger.info("Using background: genome {} with length {}".format(genome, length))
-        with Cache(CACHE_DIR) as cache:
-            self.background_hash = "{}\{}".format(genome, int(length))
-            fa = cache.get(self.background_hash)
-            if not fa:
-                fa = RandomGenomicFasta(genome, length, nseq)
-                cache.set(self.background_hash, fa)
-        self.background = fa
+        self.background_hash = "{}\{}".format(genome, int(length))
+        self.background = BackgroundCache().get_or_create(
+                "genomic", genome, length, nseq)
     
     def set_threshold(self, fpr=None, threshold=None):
         """Set motif scanning threshold based on background sequences.
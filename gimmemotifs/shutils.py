@@ -5,8 +5,14 @@
 # distribution.
 """ Odds and ends that for which I didn't (yet) find another place."""
 # Python imports
+import gzip
+import io
 import os
+import struct
 import subprocess as sp
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 def which(fname):
     """Find location of executable."""
@@ -47,3 +53,169 @@ def find_by_ext(dirname, ext):
                     os.path.splitext(fname)[-1] in ext] 
  
     return retfiles 
+
+def is_gzipped(fname):
+    """Check if a file is gzip (or bgzip) compressed."""
+    with open(fname, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+def is_bgzipped(fname):
+    """Check if a file is compressed with bgzip (blocked gzip)."""
+    with open(fname, "rb") as f:
+        header = f.read(16)
+    return (len(header) == 16 and header[:2] == b"\x1f\x8b" and 
+            header[3] & 4 and header[12:14] == b"BC")
+
+def _inflate_blocks(blocks, fname):
+    """Decompress a list of BGZF blocks.
+
+    Every block is a (payload, trailer) tuple of the raw deflate data and the
+    CRC32 and size of the uncompressed data, which are checked.
+    """
+    result = []
+    for payload, trailer in blocks:
+        try:
+            data = zlib.decompress(payload, -15)
+        except zlib.error as e:
+            raise IOError("{} is corrupt: {}".format(fname, e))
+        crc, size = struct.unpack("<II", trailer)
+        if crc != zlib.crc32(data) & 0xffffffff or size != len(data):
+            raise IOError("{} is corrupt: CRC32 or size mismatch".format(fname))
+        result.append(data)
+    return b"".join(result)
+
+class BgzfReader(io.RawIOBase):
+    """Read a bgzip compressed file, decompressing blocks in parallel.
+
+    BGZF files consist of independent compressed blocks of at most 64 kb.
+    Batches of blocks are decompressed by a pool of threads (zlib releases
+    the GIL), while the file is read sequentially.
+
+    Parameters
+    ----------
+    fname : str
+        Name of bgzip compressed file.
+
+    ncpus : int, optional
+        Number of threads, default is the number of CPUs (at most 8).
+
+    blocks_per_job : int, optional
+        Number of blocks that is decompressed by a thread at once.
+    """
+    def __init__(self, fname, ncpus=None, blocks_per_job=64):
+        super(BgzfReader, self).__init__()
+        if ncpus is None:
+            ncpus = min(8, os.cpu_count() or 1)
+        self.ncpus = ncpus
+        self.blocks_per_job = blocks_per_job
+        self._f = open(fname, "rb")
+        self._executor = ThreadPoolExecutor(max_workers=ncpus)
+        self._jobs = deque()
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _read_blocks(self):
+        """Read the compressed payload of the next batch of blocks."""
+        blocks = []
+        while len(blocks) < self.blocks_per_job:
+            header = self._f.read(12)
+            if len(header) == 0:
+                break
+            if len(header) < 12:
+                raise IOError("{} is truncated".format(self._f.name))
+            if header[:2] != b"\x1f\x8b":
+                raise IOError("{} is not a valid BGZF file".format(self._f.name))
+            xlen = struct.unpack("<H", header[10:12])[0]
+            extra = self._read_exact(xlen)
+            bsize = None
+            i = 0
+            while i + 4 <= len(extra):
+                slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+                if extra[i:i + 2] == b"BC" and slen == 2:
+                    bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+                i += 4 + slen
+            if bsize is None:
+                raise IOError("{} is not a valid BGZF file".format(self._f.name))
+            # block size - header - extra field, the last 8 bytes are CRC32 and size
+            size = bsize + 1 - 12 - xlen
+            if size < 8:
+                raise IOError("{} is not a valid BGZF file".format(self._f.name))
+            data = self._read_exact(size)
+            blocks.append((data[:-8], data[-8:]))
+        return blocks
+
+    def _read_exact(self, size):
+        """Read size bytes, raise an IOError if the file is truncated."""
+        data = self._f.read(size)
+        if len(data) < size:
+            raise IOError("{} is truncated".format(self._f.name))
+        return data
+
+    def _fill(self):
+        """Decompress the next batch, keep all threads busy."""
+        while not self._eof and len(self._jobs) < 2 * self.ncpus:
+            blocks = self._read_blocks()
+            if len(blocks) == 0:
+                self._eof = True
+            else:
+                self._jobs.append(self._executor.submit(
+                    _inflate_blocks, blocks, self._f.name))
+        if len(self._jobs) == 0:
+            return False
+        self._buffer = self._jobs.popleft().result()
+        self._pos = 0
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            if not self._fill():
+                return 0
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for job in self._jobs:
+                job.cancel()
+            self._executor.shutdown(wait=True)
+            self._f.close()
+        super(BgzfReader, self).close()
+
+def open_file(fname, mode="r", ncpus=None):
+    """Open a plain text, gzip or bgzip compressed file for reading.
+
+    Compression is detected from the file contents. Blocks of bgzip 
+    compressed files are decompressed in parallel.
+
+    Parameters
+    ----------
+    fname : str
+        File name.
+
+    mode : str, optional
+        'r' or 'rt' for text, 'rb' for binary.
+
+    ncpus : int, optional
+        Number of threads to decompress bgzip files.
+
+    Returns
+    -------
+    file object
+    """
+    binary = "b" in mode
+    if not is_gzipped(fname):
+        return open(fname, "rb" if binary else "r")
+    
+    if is_bgzipped(fname):
+        f = io.BufferedReader(BgzfReader(fname, ncpus=ncpus), buffer_size=1 << 20)
+    else:
+        f = gzip.open(fname, "rb")
+    if binary:
+        return f
+    return io.TextIOWrapper(f)
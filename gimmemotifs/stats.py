@@ -7,13 +7,13 @@ import numpy as np
 from scipy.stats import rankdata
 
 from gimmemotifs import rocmetrics
-from gimmemotifs.scanner import scan_to_best_match
+from gimmemotifs.scanner import scan_to_best_match_arrays, Scanner
 from gimmemotifs.motif import read_motifs, Motif
 from gimmemotifs.config import MotifConfig
 
 logger = logging.getLogger("gimme.stats")
 
-def calc_stats_iterator(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None):
+def calc_stats_iterator(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None, approximate=False, nbins=1000):
     """Calculate motif enrichment metrics.
 
     Parameters
@@ -38,50 +38,108 @@ def calc_stats_iterator(motifs, fg_file, bg_file, genome=None, stats=None, ncpus
     ncpus : int, optional
         Number of cores to use.
 
+    approximate : bool, optional
+        Approximate the metrics from score histograms. The scan results are 
+        not kept in memory, which makes it possible to use very large sets
+        of sequences. Only the metrics in 
+        gimmemotifs.rocmetrics.HISTOGRAM_METRICS are available. See 
+        gimmemotifs.rocmetrics.histogram_metrics() for the accuracy.
+
+    nbins : int, optional
+        Number of histogram bins per motif if approximate is True. The bins
+        span the range from the minimum to the maximum motif score.
+
     Returns
     -------
     result : dict
         Dictionary with results where keys are motif ids and the values are
         dictionary with metric name and value pairs.
     """
+    if approximate:
+        if not stats:
+            stats = rocmetrics.HISTOGRAM_METRICS
+        unknown = [s for s in stats if s not in rocmetrics.HISTOGRAM_METRICS]
+        if len(unknown) > 0:
+            raise ValueError("Can't approximate {}".format(",".join(unknown)))
+
     if not stats:
         stats = rocmetrics.__all__
     
-    if isinstance(motifs, Motif):
-        all_motifs = [motifs]
-    else:
-        if type([]) == type(motifs):
-            all_motifs = motifs
-        else:
-            all_motifs = read_motifs(motifs, fmt="pwm")
+    all_motifs = _as_motif_list(motifs)
     
     if ncpus is None:
         ncpus = int(MotifConfig().get_default_params()["ncpus"])
-    chunksize = 240
 
-    for i in range(0, len(all_motifs), chunksize):
-        result = {}
-        logger.debug("chunk %s of %s",
-            (i / chunksize) + 1, len(all_motifs) // chunksize + 1)
-        motifs = all_motifs[i:i + chunksize]
-       
-        fg_total = scan_to_best_match(fg_file, motifs, ncpus=ncpus, genome=genome)
-        bg_total = scan_to_best_match(bg_file, motifs, ncpus=ncpus, genome=genome)
+    for motifs in _motif_chunks(all_motifs):
+        if approximate:
+            yield _histogram_stats(motifs, stats, fg_file, bg_file, 
+                    genome=genome, ncpus=ncpus, nbins=nbins)
+            continue
+
+        fg_scores, fg_pos, _ = scan_to_best_match_arrays(
+                fg_file, motifs, ncpus=ncpus, genome=genome)
+        bg_scores, bg_pos, _ = scan_to_best_match_arrays(
+                bg_file, motifs, ncpus=ncpus, genome=genome)
      
-        logger.debug("calculating statistics")
-        
-        if ncpus == 1:
-            it = _single_stats(motifs, stats, fg_total, bg_total) 
-        else:
-            it = _mp_stats(motifs, stats, fg_total, bg_total, ncpus) 
-        
-        for motif_id, s, ret in it:
-            if motif_id not in result:
-                result[motif_id] = {}
-            result[motif_id][s] = ret
-        yield result
+        yield calc_stats_from_arrays(motifs, fg_scores, bg_scores, 
+                fg_pos, bg_pos, stats=stats, ncpus=ncpus)
+
+def calc_background_stats(motifs, fg_file, background, genome=None, stats=None, ncpus=None):
+    """Calculate motif enrichment metrics for multiple backgrounds.
+
+    The positive sequences are scanned only once and the scan results are
+    used for all backgrounds. Every background is also scanned once.
+
+    Parameters
+    ----------
+    motifs : str, list or Motif instance
+        A file with motifs in pwm format, a list of Motif instances or a 
+        single Motif instance.
+
+    fg_file : str
+        Filename of a FASTA, BED or region file with positive sequences.
+
+    background : dict
+        Dictionary with background names as keys and filenames of FASTA, 
+        BED or region files with negative sequences as values.
+
+    genome : str, optional
+        Genome or index directory in case of BED/regions.
+    
+    stats : list, optional
+        Names of metrics to calculate. See gimmemotifs.rocmetrics.__all__ 
+        for available metrics.
+
+    ncpus : int, optional
+        Number of cores to use.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with results where keys are motif ids and the values are
+        dictionaries with the background names as keys and a dictionary with
+        metric name and value pairs as values.
+    """
+    if not stats:
+        stats = rocmetrics.__all__
+    
+    if ncpus is None:
+        ncpus = int(MotifConfig().get_default_params()["ncpus"])
+    
+    result = {}
+    for motifs in _motif_chunks(_as_motif_list(motifs)):
+        fg_scores, fg_pos, _ = scan_to_best_match_arrays(
+                fg_file, motifs, ncpus=ncpus, genome=genome)
+        for bg_name, bg_file in background.items():
+            bg_scores, bg_pos, _ = scan_to_best_match_arrays(
+                    bg_file, motifs, ncpus=ncpus, genome=genome)
+            bg_result = calc_stats_from_arrays(motifs, fg_scores, bg_scores, 
+                    fg_pos, bg_pos, stats=stats, ncpus=ncpus)
+            for motif_id, motif_stats in bg_result.items():
+                result.setdefault(motif_id, {})[bg_name] = motif_stats
+    return result
 
-def calc_stats(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None):
+def calc_stats(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None, approximate=False, nbins=1000):
     """Calculate motif enrichment metrics.
 
     Parameters
@@ -106,6 +164,13 @@ def calc_stats(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None):
     ncpus : int, optional
         Number of cores to use.
 
+    approximate : bool, optional
+        Approximate the metrics from score histograms, see 
+        calc_stats_iterator().
+
+    nbins : int, optional
+        Number of histogram bins per motif if approximate is True.
+
     Returns
     -------
     result : dict
@@ -113,7 +178,9 @@ def calc_stats(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None):
         dictionary with metric name and value pairs.
     """
     result = {}
-    for batch_result in calc_stats_iterator(motifs, fg_file, bg_file, genome=genome, stats=stats, ncpus=ncpus):
+    for batch_result in calc_stats_iterator(motifs, fg_file, bg_file, 
+            genome=genome, stats=stats, ncpus=ncpus, 
+            approximate=approximate, nbins=nbins):
         for motif_id in batch_result:
             if motif_id not in result:
                 result[motif_id] = {}
@@ -121,47 +188,208 @@ def calc_stats(motifs, fg_file, bg_file, genome=None, stats=None, ncpus=None):
                 result[motif_id][s] = ret
     return result
 
-def _single_stats(motifs, stats, fg_total, bg_total):
-    # Initialize multiprocessing pool
+def _as_motif_list(motifs):
+    if isinstance(motifs, Motif):
+        return [motifs]
+    if type([]) == type(motifs):
+        return motifs
+    return read_motifs(motifs, fmt="pwm")
+
+def _motif_chunks(all_motifs, chunksize=240):
+    for i in range(0, len(all_motifs), chunksize):
+        logger.debug("chunk %s of %s",
+            (i / chunksize) + 1, len(all_motifs) // chunksize + 1)
+        yield all_motifs[i:i + chunksize]
+
+def calc_stats_from_arrays(motifs, fg_scores, bg_scores, fg_pos=None, bg_pos=None, stats=None, ncpus=None):
+    """Calculate motif enrichment metrics from scan results.
+
+    The scan results can be obtained with 
+    gimmemotifs.scanner.scan_to_best_match_arrays(). In this way the best 
+    scores and positions are available for other analyses, such as plots,
+    without scanning the sequences again.
+
+    Parameters
+    ----------
+    motifs : list
+        List of Motif instances, in the same order as the rows of the arrays.
+
+    fg_scores : array_like
+        Best motif scores in the positive sequences, shape (motifs, sequences).
+
+    bg_scores : array_like
+        Best motif scores in the negative sequences, shape (motifs, sequences).
+
+    fg_pos : array_like, optional
+        Position of the best match in the positive sequences. Required for 
+        position-based metrics.
+
+    bg_pos : array_like, optional
+        Position of the best match in the negative sequences. Required for 
+        position-based metrics.
+
+    stats : list, optional
+        Names of metrics to calculate. See gimmemotifs.rocmetrics.__all__ 
+        for available metrics.
+
+    ncpus : int, optional
+        Number of cores to use.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with results where keys are motif ids and the values are
+        dictionary with metric name and value pairs.
+    """
+    if not stats:
+        stats = rocmetrics.__all__
+
+    if ncpus is None:
+        ncpus = int(MotifConfig().get_default_params()["ncpus"])
+
+    fg_scores = np.asarray(fg_scores, dtype=float)
+    bg_scores = np.asarray(bg_scores, dtype=float)
+    values = {"score": (fg_scores, bg_scores), "pos": (fg_pos, bg_pos)}
     
-    for motif in motifs:
-        motif_id = motif.id
-        fg_vals = fg_total[motif_id]
-        bg_vals = bg_total[motif_id]
+    logger.debug("calculating statistics")
+    
+    # Score-based metrics are calculated for all motifs at once
+    matrix_stats = []
+    if fg_scores.shape[1] > 0 and bg_scores.shape[1] > 0:
+        matrix_stats = [s for s in stats if s in rocmetrics.MATRIX_METRICS]
+    other_stats = [s for s in stats if s not in matrix_stats]
+
+    its = []
+    if len(matrix_stats) > 0:
+        its.append(_matrix_stats(motifs, matrix_stats, fg_scores, bg_scores))
+    if len(other_stats) > 0:
+        if ncpus == 1:
+            its.append(_single_stats(motifs, other_stats, values))
+        else:
+            its.append(_mp_stats(motifs, other_stats, values, ncpus))
+    
+    result = {}
+    for it in its:
+        for motif_id, s, ret in it:
+            if motif_id not in result:
+                result[motif_id] = {}
+            result[motif_id][s] = ret
+    return result
+
+def scan_to_histogram(fname, motifs, bin_edges, ncpus=None, genome=None):
+    """Scan a sequence file and count the best motif scores in bins.
+
+    The scan results are added to the histogram while scanning, so the 
+    memory use does not depend on the number of sequences.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of a FASTA, BED or region file.
+
+    motifs : list
+        List of motif instances.
+
+    bin_edges : array_like
+        Bin edges for every motif, shape (motifs, bins + 1). Scores outside
+        of the range are counted in the first or last bin.
+
+    ncpus : int, optional
+        Number of cores to use.
+
+    genome : str, optional
+        Genome or index directory in case of BED/regions.
+
+    Returns
+    -------
+    hist : numpy.ndarray
+        Histogram counts, shape (motifs, bins).
+    """
+    s = Scanner(ncpus=ncpus)
+    s.set_motifs(motifs)
+    s.set_threshold(threshold=0.0)
+    if genome:
+        s.set_genome(genome)
+
+    bin_edges = np.asarray(bin_edges)
+    n_motifs = len(motifs)
+    nbins = bin_edges.shape[1] - 1
+    offset = np.arange(n_motifs) * nbins
+    hist = np.zeros(n_motifs * nbins, dtype=int)
+    
+    logger.debug("scanning %s...", fname)
+    batch = []
+    for scores in s.best_score(fname):
+        batch.append(scores)
+        if len(batch) == 10000:
+            hist += _bincount(np.array(batch), bin_edges, offset)
+            batch = []
+    if len(batch) > 0:
+        hist += _bincount(np.array(batch), bin_edges, offset)
+    
+    # Close the pool and reclaim memory
+    del s
+
+    return hist.reshape(n_motifs, nbins)
+
+def _bincount(scores, bin_edges, offset):
+    nbins = bin_edges.shape[1] - 1
+    width = (bin_edges[:, -1] - bin_edges[:, 0]) / nbins
+    idx = np.floor((scores - bin_edges[:, 0]) / width).astype(int)
+    idx = np.clip(idx, 0, nbins - 1) + offset
+    return np.bincount(idx.flatten(), minlength=len(offset) * nbins)
+
+def _histogram_stats(motifs, stats, fg_file, bg_file, genome=None, ncpus=None, nbins=1000):
+    bin_edges = np.array([
+        np.linspace(m.pwm_min_score(), m.pwm_max_score(), nbins + 1) for m in motifs])
+    fg_hist = scan_to_histogram(fg_file, motifs, bin_edges, ncpus=ncpus, genome=genome)
+    bg_hist = scan_to_histogram(bg_file, motifs, bin_edges, ncpus=ncpus, genome=genome)
+    
+    logger.debug("calculating statistics")
+    values = rocmetrics.histogram_metrics(fg_hist, bg_hist, bin_edges, stats)
+    
+    result = {}
+    for i, motif in enumerate(motifs):
+        result[str(motif)] = dict(
+                [(s, float(values[s][i])) for s in values])
+    return result
+
+def _matrix_stats(motifs, stats, fg_scores, bg_scores):
+    values = rocmetrics.matrix_metrics(fg_scores, bg_scores, stats)
+    for i, motif in enumerate(motifs):
+        for s in stats:
+            ret = float(values[s][i])
+            if s == "max_fmeasure" and np.isnan(ret):
+                ret = None
+            yield str(motif), s, ret
+
+def _stat_input(func, values, i):
+    """Return the positive and negative values of motif i for a metric."""
+    if func.input_type not in values:
+        raise ValueError("Unknown input_type for stats") 
+    fg, bg = values[func.input_type]
+    if fg is None or bg is None:
+        raise ValueError("No {} values for {}".format(
+            func.input_type, func.__name__))
+    return fg[i], bg[i]
+
+def _single_stats(motifs, stats, values):
+    for i, motif in enumerate(motifs):
         for s in stats:
             func = getattr(rocmetrics, s)
-            if func.input_type == "score":
-                fg = [x[0] for x in fg_vals]
-                bg = [x[0] for x in bg_vals]
-            elif func.input_type == "pos":
-                fg = [x[1] for x in fg_vals]
-                bg = [x[1] for x in bg_vals]
-            else:
-                raise ValueError("Unknown input_type for stats") 
-            
+            fg, bg = _stat_input(func, values, i)
             ret = func(fg, bg)
             yield str(motif), s, ret
 
-def _mp_stats(motifs, stats, fg_total, bg_total, ncpus):
+def _mp_stats(motifs, stats, values, ncpus):
     # Initialize multiprocessing pool
     pool = Pool(ncpus, maxtasksperchild=1000)
     
     jobs = []
-    for motif in motifs:
-        motif_id = motif.id
-        fg_vals = fg_total[motif_id]
-        bg_vals = bg_total[motif_id]
+    for i, motif in enumerate(motifs):
         for s in stats:
             func = getattr(rocmetrics, s)
-            if func.input_type == "score":
-                fg = [x[0] for x in fg_vals]
-                bg = [x[0] for x in bg_vals]
-            elif func.input_type == "pos":
-                fg = [x[1] for x in fg_vals]
-                bg = [x[1] for x in bg_vals]
-            else:
-                raise ValueError("Unknown input_type for stats") 
-            
+            fg, bg = _stat_input(func, values, i)
             j = pool.apply_async(func, 
                         (fg, bg))
             jobs.append([str(motif), s, j])
@@ -19,19 +19,19 @@ import tempfile
 from math import log
 import requests
 from subprocess import Popen
-from tempfile import NamedTemporaryFile
 
 # External imports
 from scipy import special
 import numpy as np
-import pybedtools
 from genomepy import Genome
 
 # gimme imports
 from gimmemotifs.fasta import Fasta
+from gimmemotifs.genome_index import regions_to_fasta
 from gimmemotifs.plot import plot_histogram
 from gimmemotifs.rocmetrics import ks_pvalue
 from gimmemotifs.config import MotifConfig
+from gimmemotifs.shutils import is_gzipped, open_file
 
 lgam = special.gammaln
 
@@ -80,7 +80,7 @@ def phyper(k, good, bad, N):
     return np.sum(pvalues)
 
 def divide_file(fname, sample, rest, fraction, abs_max):
-    with open(fname) as f:
+    with open_file(fname) as f:
         lines = f.readlines()
     #random.seed()
     random.shuffle(lines)
@@ -119,26 +119,20 @@ def divide_file(fname, sample, rest, fraction, abs_max):
     
 def divide_fa_file(fname, sample, rest, fraction, abs_max):
     fa = Fasta(fname)
-    ids = fa.ids[:]
 
-    x = int(fraction * len(ids))
+    x = int(fraction * len(fa))
     if x > abs_max:
         x = abs_max
 
-    sample_seqs = random.sample(ids, x)
+    fa_sample, fa_rest = fa.split(x)
 
     # Rest
-    f_sample = open(sample, "w")
-    f_rest = open(rest, "w")
-    for name,seq in fa.items():
-        if name in sample_seqs:
-            f_sample.write(">%s\n%s\n" % (name, seq))
-        else:
-            f_rest.write(">%s\n%s\n" % (name, seq))
-    f_sample.close()
-    f_rest.close()
+    for fa_out, outname in ((fa_sample, sample), (fa_rest, rest)):
+        with open(outname, "w") as f:
+            for name,seq in fa_out.items():
+                f.write(">%s\n%s\n" % (name, seq))
     
-    return x, len(ids[x:])    
+    return x, len(fa_rest)
 
 def write_equalwidth_bedfile(bedfile, width, outfile):
     """Read input from <bedfile>, set the width of all entries to <width> and 
@@ -146,7 +140,7 @@ def write_equalwidth_bedfile(bedfile, width, outfile):
     Input file needs to be in BED or WIG format."""
 
     BUFSIZE = 10000
-    f = open(bedfile)
+    f = open_file(bedfile)
     out = open(outfile, "w")
     lines = f.readlines(BUFSIZE)
     line_count = 0
@@ -336,7 +330,7 @@ def gff_enrichment(sample, background, numsample, numbackground, outfile):
     out.close()
 
 def is_valid_bedfile(bedfile, columns=6):
-    f = open(bedfile)
+    f = open_file(bedfile)
     for i, line in enumerate(f.readlines()):
         if not (line.startswith("browser") or line.startswith("track")):
             vals = line.split("\t")
@@ -363,7 +357,7 @@ def is_valid_bedfile(bedfile, columns=6):
     return True
 
 def median_bed_len(bedfile):
-    f = open(bedfile)
+    f = open_file(bedfile)
     l = []
     for i, line in enumerate(f.readlines()):
         if not (line.startswith("browser") or line.startswith("track")):
@@ -476,21 +470,71 @@ def _treesort(order, nodeorder, nodecounts, tree):
                     clusterids[j] = -i-1
     return np.argsort(neworder)
 
-def number_of_seqs_in_file(fname):
-    try:
-        fa = Fasta(fname)
-        return len(fa)
-    except Exception:
-        pass
+# Memoized file types and sequence counts, see _file_key()
+_FILE_INFO = {}
+
+def _file_key(fname):
+    """Return a key that changes when the file changes.
 
+    The path, size and modification time are used instead of a checksum of 
+    the contents, as the checksum would need a full read of the file.
+    """
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_size, st.st_mtime)
+
+def _count_fasta_records(fname):
+    """Count the '>' characters at the start of a line."""
+    if is_gzipped(fname):
+        with open_file(fname, "rb") as f:
+            return sum(1 for line in f if line.startswith(b">"))
+
+    if os.path.getsize(fname) == 0:
+        return 0
+    with open(fname, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     try:
-        bed = pybedtools.BedTool(fname)
-        return len([x for x in bed])
-    except Exception:
-        pass
+        n = int(mm[:1] == b">")
+        pos = mm.find(b"\n>")
+        while pos != -1:
+            n += 1
+            pos = mm.find(b"\n>", pos + 2)
+    finally:
+        mm.close()
+    return n
+
+def _count_regions(fname):
+    """Count the lines that are not empty, a comment or a UCSC line."""
+    p = re.compile(r'^(#|track|browser)') 
+    with open_file(fname) as f:
+        return sum(1 for line in f if line.strip() and not p.search(line))
+
+def number_of_seqs_in_file(fname):
+    """Return the number of sequences or regions in a file.
 
-    sys.stderr.write("unknown filetype {}\n".format(fname))
-    sys.exit(1)
+    The file is streamed, FASTA records are counted by scanning for '>'.
+    The result is memoized.
+
+    Parameters
+    ----------
+    fname : str
+        Name of FASTA, BED, narrowPeak or region file.
+
+    Returns
+    -------
+    int
+        Number of sequences or regions.
+    """
+    key = ("count",) + _file_key(fname)
+    if key not in _FILE_INFO:
+        ftype = determine_file_type(fname)
+        if ftype == "fasta":
+            _FILE_INFO[key] = _count_fasta_records(fname)
+        elif ftype in ["bed", "narrowpeak", "region"]:
+            _FILE_INFO[key] = _count_regions(fname)
+        else:
+            sys.stderr.write("unknown filetype {}\n".format(fname))
+            sys.exit(1)
+    return _FILE_INFO[key]
 
 def determine_file_type(fname):
     """
@@ -499,7 +543,8 @@ def determine_file_type(fname):
     The following file types are supported:
     BED, narrowPeak, FASTA, list of chr:start-end regions
     If the extension is bed, fa, fasta or narrowPeak, we will believe this
-    without checking!
+    without checking! Otherwise the type is determined from the first lines 
+    of the file. The result is memoized.
 
     Parameters
     ----------
@@ -517,7 +562,7 @@ def determine_file_type(fname):
     if not os.path.isfile(fname):
         raise ValueError("{} is not a file!", fname)
 
-    ext = os.path.splitext(fname)[1].lower()
+    ext = os.path.splitext(re.sub(r'\.b?gz$', '', fname))[1].lower().lstrip(".")
     if ext in ["bed"]:
         return "bed"
     elif ext in ["fa", "fasta"]:
@@ -525,16 +570,22 @@ def determine_file_type(fname):
     elif ext in ["narrowpeak"]:
         return "narrowpeak"
 
-    try:
-        Fasta(fname)
-        return "fasta"
-    except:
-        pass
+    key = ("type",) + _file_key(fname)
+    if key not in _FILE_INFO:
+        _FILE_INFO[key] = _sniff_file_type(fname)
+    return _FILE_INFO[key]
+
+def _sniff_file_type(fname):
+    """Determine the file type from the first lines of the file."""
     # Read first line that is not a comment or an UCSC-specific line
     p = re.compile(r'^(#|track|browser)') 
-    with open(fname) as f:
-        for line in f.readlines():
+    line = ""
+    with open_file(fname) as f:
+        for line in f:
             line = line.strip()
+            if line.startswith(">"):
+                # The sequences are validated when the file is read
+                return "fasta"
             if not p.search(line):
                 break
     region_p = re.compile(r'^(.+):(\d+)-(\d+)$')
@@ -607,11 +658,7 @@ def as_fasta(seqs, genome=None):
         if genome is None:
             raise ValueError("need genome to convert to FASTA")
 
-        tmpfa = NamedTemporaryFile()
-        if type(genome) == type(""):
-            genome = Genome(genome)
-        genome.track2fasta(seqs, tmpfa.name) 
-        return Fasta(tmpfa.name)
+        return regions_to_fasta(genome, seqs)
 
 def file_checksum(fname):
     """Return md5 checksum of file.
@@ -8,6 +8,7 @@ from genomepy import Genome
 from gimmemotifs.fasta import Fasta
 from gimmemotifs.config import (MotifConfig, FA_VALID_BGS, BED_VALID_BGS)
 from gimmemotifs.utils import determine_file_type
+from gimmemotifs.shutils import open_file
 # import logger
 
 def check_bed_file(fname):
@@ -16,7 +17,7 @@ def check_bed_file(fname):
         logger.error("Inputfile %s does not exist!", fname)
         sys.exit(1)
 
-    for i, line in enumerate(open(fname)):
+    for i, line in enumerate(open_file(fname)):
         if line.startswith("#") or line.startswith("track") or line.startswith("browser"):
             # comment or BED specific stuff
             pass
@@ -0,0 +1,200 @@
+import unittest
+import tempfile
+import os
+import numpy as np
+from genomepy import Genome
+from gimmemotifs.background import ( BackgroundCache, MarkovFasta, 
+                                    gc_window_index, matched_gc_bedfile,
+                                    matched_gc_regions )
+from gimmemotifs.fasta import Fasta
+
+class TestBackground(unittest.TestCase):
+    """ A test class to test background generation """
+
+    def setUp(self):
+        self.fasta = Fasta("test/data/stats/p73.fa")
+        self.genome = "test/data/genome_index/genome/genome.fa"
+
+    def test1_markov_matrix(self):
+        """ Test Markov transition matrix """
+        for k in [1, 2, 3]:
+            m = MarkovFasta(self.fasta, k=k, matrix_only=True)
+            self.assertEqual(4 ** k, len(m.trans))
+            self.assertAlmostEqual(1, sum(m.init.values()))
+            for probs in m.trans.values():
+                self.assertAlmostEqual(1, sum(probs.values()))
+        
+        # check a transition frequency
+        seq = "".join(self.fasta.seqs).upper()
+        m = MarkovFasta(self.fasta, k=1, matrix_only=True)
+        self.assertAlmostEqual(
+                seq.count("CG") / float(seq.count("C")), 
+                m.trans["C"]["G"], 
+                places=2)
+
+    def test2_markov_fasta(self):
+        """ Test Markov background sequences """
+        m = MarkovFasta(self.fasta, n=500, k=2, seed=42)
+        self.assertEqual(500, len(m))
+        lengths = set(len(seq) for seq in self.fasta.seqs)
+        for seq in m.seqs:
+            self.assertIn(len(seq), lengths)
+            self.assertTrue(set(seq) <= set("ACGT"))
+        
+        # same seed, same sequences
+        m2 = MarkovFasta(self.fasta, n=500, k=2, seed=42)
+        self.assertEqual(m.seqs, m2.seqs)
+        
+        # fixed length
+        m = MarkovFasta(self.fasta, n=10, length=50, k=3)
+        self.assertEqual([50] * 10, [len(seq) for seq in m.seqs])
+        
+        # dinucleotide frequencies are similar to the input
+        ref = MarkovFasta(self.fasta, k=1, matrix_only=True).trans_matrix
+        result = MarkovFasta(m2, k=1, matrix_only=True).trans_matrix
+        self.assertLess(np.abs(ref - result).max(), 0.05)
+        
+        # higher orders only use the k-mers in the input
+        kmers = set(seq[i:i + 7].upper() for seq in self.fasta.seqs 
+                for i in range(len(seq) - 7))
+        m = MarkovFasta(self.fasta, n=20, k=7, seed=42)
+        self.assertEqual(set(x for x in kmers if set(x) <= set("ACGT")), 
+                set(m.trans.keys()))
+        for seq in m.seqs:
+            self.assertIn(len(seq), lengths)
+            self.assertTrue(set(seq) <= set("ACGT"))
+        
+        # empty input sequences are skipped
+        f = Fasta()
+        f["empty"] = ""
+        f["seq"] = self.fasta.seqs[0]
+        m = MarkovFasta(f, n=10, k=2)
+        self.assertEqual([len(self.fasta.seqs[0])] * 10, [len(seq) for seq in m.seqs])
+        self.assertEqual([""], m._generate_sequences([0]))
+
+    def test3_gc_window_index(self):
+        """ Test GC window index """
+        seq = Genome(self.genome)["chr2"][:].seq.upper()
+        index = gc_window_index(self.genome, 100, step=50)
+        self.assertEqual(["chr2"], list(index["chroms"]))
+        self.assertEqual([5999], list(index["counts"]))
+        for i in [0, 37, 1000, 5998]:
+            window = seq[i * 50:i * 50 + 100]
+            self.assertEqual(window.count("G") + window.count("C"), index["gc"][i])
+            self.assertEqual(window.count("N"), index["n"][i])
+
+        with self.assertRaises(ValueError):
+            gc_window_index(self.genome, 100, step=30)
+        
+        # large windows
+        index = gc_window_index(self.genome, 70000, step=10000)
+        window = seq[10000:80000]
+        self.assertEqual(window.count("G") + window.count("C"), index["gc"][1])
+
+    def test4_matched_gc_bedfile(self):
+        """ Test GC% matched background """
+        seq = Genome(self.genome)["chr2"][:].seq
+        fa = Fasta()
+        for i in range(10, 50):
+            fa.add("seq{}".format(i), seq[i * 1000:i * 1000 + 100])
+        fname = tempfile.NamedTemporaryFile(suffix=".fa").name
+        fa.writefasta(fname)
+        
+        bedfile = tempfile.NamedTemporaryFile(suffix=".bed").name
+        matched_gc_bedfile(bedfile, fname, self.genome, 200, seed=1)
+        regions = [line.split() for line in open(bedfile)]
+        self.assertEqual(200, len(regions))
+        
+        gc = lambda s: (s.upper().count("G") + s.upper().count("C")) / float(len(s))
+        ref = np.histogram([gc(s) for s in fa.seqs], bins=20, range=(0, 1))[0]
+        result = np.histogram(
+                [gc(seq[int(start):int(end)]) for _, start, end in regions],
+                bins=20, range=(0, 1))[0]
+        self.assertEqual(list(ref * 5), list(result))
+        
+        # regions are not aligned to the region length
+        self.assertGreater(len(set(int(start) % 100 for _, start, _ in regions)), 1)
+
+    def test4b_matched_n_and_length(self):
+        """ Test background matched for N content and length """
+        seq = Genome(self.genome)["chr2"][:].seq
+        gc = lambda s: (s.upper().count("G") + s.upper().count("C")) / float(len(s))
+        
+        # one sequence with 25% Ns
+        fa = Fasta()
+        fa.add("n", seq[9975:10075])
+        for i in range(11, 50):
+            fa.add("seq{}".format(i), seq[i * 1000:i * 1000 + 100])
+        fname = tempfile.NamedTemporaryFile(suffix=".fa").name
+        fa.writefasta(fname)
+        
+        regions = matched_gc_regions(fname, self.genome, 40, n_fraction=0.3, seed=1)
+        self.assertEqual(40, len(regions))
+        n = [seq[start:end].upper().count("N") for _, start, end in regions]
+        self.assertEqual([25], [x for x in n if x > 0])
+        
+        # different lengths
+        rng = np.random.RandomState(1)
+        lengths = rng.randint(50, 300, 200)
+        fa = Fasta()
+        for i, l in enumerate(lengths):
+            fa.add("seq{}".format(i), seq[10000 + i * 1000:10000 + i * 1000 + l])
+        fa.writefasta(fname)
+        
+        regions = matched_gc_regions(fname, self.genome, 400, seed=1)
+        self.assertEqual(400, len(regions))
+        result = np.array([end - start for _, start, end in regions])
+        self.assertTrue(set(result) <= set(lengths))
+        self.assertLess(abs(np.median(result) - np.median(lengths)), 20)
+        for q in [10, 90]:
+            self.assertLess(
+                abs(np.percentile(result, q) - np.percentile(lengths, q)), 30)
+        
+        ref = np.histogram([gc(s) for s in fa.seqs], bins=10, range=(0, 1))[0]
+        result = np.histogram(
+                [gc(seq[start:end]) for _, start, end in regions],
+                bins=10, range=(0, 1))[0]
+        self.assertLess(np.abs(ref / 200.0 - result / 400.0).sum(), 0.1)
+
+    def test5_background_cache(self):
+        """ Test cached backgrounds """
+        cache = BackgroundCache(tempfile.mkdtemp(), max_size=15000)
+        fa = cache.get_or_create("genomic", self.genome, 100, 200)
+        self.assertEqual(200, len(fa))
+        self.assertEqual(1, len(cache.list()))
+
+        # second time from cache
+        fa2 = cache.get_or_create("genomic", self.genome, 100, 200)
+        self.assertEqual(fa.ids, fa2.ids)
+        self.assertEqual(fa.seqs, fa2.seqs)
+
+        # different seed, different background; least recently used is removed
+        fa3 = cache.get_or_create("genomic", self.genome, 100, 200, seed=1)
+        self.assertNotEqual(fa.seqs, fa3.seqs)
+        entries = cache.list()
+        self.assertEqual(1, len(entries))
+        self.assertEqual(1, entries[0]["seed"])
+        self.assertIsNone(cache.get(self.genome, "genomic", 100, 200))
+        
+        cache.clear()
+        self.assertEqual([], cache.list())
+        
+        # seeded backgrounds are reproducible
+        fa4 = cache.get_or_create("genomic", self.genome, 100, 200, seed=1)
+        self.assertEqual(fa3.seqs, fa4.seqs)
+        fa5 = cache.get_or_create("genomic", self.genome, 100, 200, seed=2)
+        self.assertNotEqual(fa3.seqs, fa5.seqs)
+        
+        # the gene file is part of the key
+        genefiles = []
+        for i in range(2):
+            fname = os.path.join(cache.cache_dir, "genes{}.bed".format(i))
+            with open(fname, "w") as f:
+                f.write("chr2\t{}\t2000\tgene\t0\t+\n".format(1000 + i))
+            genefiles.append(fname)
+        self.assertNotEqual(
+                cache.key(self.genome, "promoter", 100, 1, genefile=genefiles[0]),
+                cache.key(self.genome, "promoter", 100, 1, genefile=genefiles[1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import tempfile
 import os
-from gimmemotifs.cluster import cluster_motifs
+from gimmemotifs.cluster import cluster_motifs, reduce_motifs
 
 class TestMotifPwm(unittest.TestCase):
     """ A test class to test motif clustering """
@@ -28,6 +28,18 @@ class TestMotifPwm(unittest.TestCase):
         self.assertEqual([3,2], [len(c[1]) for c 
             in sorted(clusters, key=lambda x: len(x))])
 
+    def test2_reduce_motifs(self):
+        """ reduce a pwm file to non-redundant motifs """
+        clusters = reduce_motifs(self.pwm, threshold=0.95)
+        
+        self.assertEqual(2, len(clusters))
+        self.assertEqual([2,3], sorted([len(c[1]) for c in clusters]))
+        for motif, members in clusters:
+            self.assertEqual(motif.id, members[0].id)
+        
+        clusters = reduce_motifs(self.pwm, threshold=0.95, average=True)
+        self.assertEqual(2, len(clusters))
+
     def tearDown(self):
         pass
 
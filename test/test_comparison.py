@@ -1,7 +1,10 @@
 import unittest
 import tempfile
 import os
-from gimmemotifs.comparison import MotifComparer
+import numpy as np
+from gimmemotifs import comparison
+from gimmemotifs.comparison import MotifComparer, seqcor, seqcor_matrix
+from gimmemotifs.motif import Motif, read_motifs
 from time import sleep
 
 class TestComparison(unittest.TestCase):
@@ -28,6 +31,140 @@ class TestComparison(unittest.TestCase):
         self.assertEqual(1, scores[2])
         self.assertAlmostEqual(3.1666e-8, scores[3])
 
+    def test2_closest_match_prefilter(self):
+        """ Closest match with candidate pre-filter """
+        mc = MotifComparer()
+
+        pwm = "test/data/pwmscan/TATA.pwm"
+        ret = mc.get_closest_match(pwm, prefilter=50)
+        
+        match = ret['TATA-box']
+        self.assertEqual('GM.5.0.TBP.0001', match[0])
+        self.assertAlmostEqual(-0.1041, match[1][0], 4)
+    
+    def test3_prefilter_recall(self):
+        """ Candidate pre-filter recall """
+        mc = MotifComparer()
+        
+        pwm = "test/data/pwms/motifs.pwm"
+        candidates = mc.get_candidates(pwm, pwm, ntop=1)
+        for motif_id, motifs in candidates.items():
+            self.assertEqual(motif_id, motifs[0].id)
+        
+        recall = mc.prefilter_recall(pwm, pwm, ntop=2, parallel=False)
+        self.assertEqual(1.0, recall)
+
+    def test4_score_dist(self):
+        """ Score distribution lookup and generation """
+        mc = MotifComparer()
+
+        mean, sd = mc.scoredist["wic"]["total_mean"]
+        self.assertAlmostEqual(-2.2672, mean[11, 10])
+        self.assertAlmostEqual(0.3417, sd[11, 10])
+        # Interpolated length
+        self.assertTrue(mean[12, 12] > mean[13, 13] > mean[14, 14])
+        
+        # Score distribution is not pickled
+        self.assertNotIn("scoredist", mc.__getstate__())
+
+        pwm = "test/data/pwms/motifs.pwm"
+        with tempfile.NamedTemporaryFile() as tmp:
+            mc.generate_score_dist(pwm, "total", "wic", "mean", outfile=tmp.name, ncpus=2)
+            lines = [l.split("\t") for l in open(tmp.name)]
+        # Motifs have two different lengths
+        self.assertEqual(4, len(lines))
+        for l1, l2, m, s in lines:
+            self.assertTrue(float(s) >= 0)
+        # The worker processes are stopped
+        self.assertIsNone(mc._pool)
+
+    def test5_seqcor_matrix(self):
+        """ All-vs-all seqcor """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        # a palindromic motif, for ties between strands, a motif with a 
+        # flat profile and a short motif
+        half = [[0.8, 0.1, 0.05, 0.05], [0.05, 0.6, 0.3, 0.05], 
+                [0.1, 0.1, 0.7, 0.1]]
+        palindrome = Motif(half + Motif(half).rc().pwm)
+        palindrome.id = "palindrome"
+        flat = Motif([[0.25, 0.25, 0.25, 0.25]] * 8)
+        flat.id = "flat"
+        short = Motif([[0.7, 0.1, 0.1, 0.1], [0.1, 0.1, 0.7, 0.1]])
+        short.id = "short"
+        motifs += [palindrome, flat, short]
+        
+        def check(scores, positions, strands):
+            for i, m1 in enumerate(motifs):
+                for j, m2 in enumerate(motifs):
+                    score, pos, strand = seqcor(m1, m2)
+                    if np.isnan(score):
+                        self.assertTrue(np.isnan(scores[i, j]))
+                    else:
+                        self.assertAlmostEqual(score, scores[i, j])
+                    self.assertEqual(pos, positions[i, j])
+                    self.assertEqual(strand, strands[i, j])
+        
+        check(*seqcor_matrix(motifs, motifs))
+        self.assertTrue(np.isnan(seqcor(flat, motifs[0])[0]))
+        
+        mc = MotifComparer()
+        result = mc.get_all_scores(motifs, motifs, "total", "seqcor", "mean")
+        self.assertAlmostEqual(1.0, result[motifs[0].id][motifs[0].id][0])
+        
+        # cached profiles give the same result as scanning
+        self.assertEqual(seqcor(motifs[0], motifs[1]), 
+                seqcor(motifs[0], motifs[1], seq=comparison.RCDB))
+        
+        # the cache is limited in size, motifs are compared in chunks that
+        # fit in the cache
+        max_size = comparison._RCDB_PROFILES_MAX
+        comparison._RCDB_PROFILES_MAX = 2
+        comparison._RCDB_PROFILES.clear()
+        try:
+            check(*seqcor_matrix(motifs, motifs))
+            self.assertEqual(2, len(comparison._RCDB_PROFILES))
+        finally:
+            comparison._RCDB_PROFILES_MAX = max_size
+
+    def test6_score_matrix(self):
+        """ Parallel comparison with persistent pool """
+        mc = MotifComparer()
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        
+        scores, positions, strands = mc.get_score_matrix(motifs, motifs, "total", "wic", "mean", ncpus=2)
+        self.assertEqual((5, 5), scores.shape)
+        for i, m1 in enumerate(motifs):
+            for j, m2 in enumerate(motifs):
+                score = mc.compare_motifs(m1, m2, "total", "wic", "mean")
+                self.assertAlmostEqual(score[0], scores[i, j])
+                self.assertEqual(score[1], positions[i, j])
+        
+        # The pool is reused for known motifs
+        pool = mc._pool
+        result = mc.get_all_scores(motifs[:1], motifs[1:], "total", "wic", "mean")
+        self.assertIs(pool, mc._pool)
+        self.assertAlmostEqual(scores[0, 1], result[motifs[0].id][motifs[1].id][0])
+        mc.close()
+        self.assertIsNone(mc._pool)
+        
+        # Errors in the worker processes are raised with the motif ids
+        with MotifComparer() as mc:
+            with self.assertRaisesRegexp(RuntimeError, motifs[0].id):
+                mc.get_score_matrix(motifs, motifs, "total", "unknown", "mean", ncpus=2)
+
+    def test7_pool_changed_motifs(self):
+        """ Motifs changed in place are compared again """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        with MotifComparer() as mc:
+            mc.get_all_scores(motifs, motifs, "total", "wic", "mean", ncpus=2)
+            parallel = mc.get_all_scores(motifs, motifs, "total", "wic", "mean", trim=0.5, ncpus=2)
+        serial = MotifComparer().get_all_scores(motifs, motifs, "total", "wic", "mean", parallel=False)
+        for m1 in motifs:
+            for m2 in motifs:
+                self.assertAlmostEqual(serial[m1.id][m2.id][0], parallel[m1.id][m2.id][0])
+                self.assertEqual(serial[m1.id][m2.id][1:], parallel[m1.id][m2.id][1:])
+        self.assertIsNone(mc._pool)
+
     def tearDown(self):
         pass
 
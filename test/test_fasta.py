@@ -31,6 +31,110 @@ class TestFasta(unittest.TestCase):
             with open(tempname) as f_ref:
                 self.assertEqual(f.read().strip(), f_ref.read().strip())
     
+    def test4_lazy(self):
+        """ Lazy, indexed Fasta """
+        f = Fasta(self.fasta_file, lazy=True)
+        self.assertEqual(self.f.ids, f.ids)
+        self.assertEqual(self.f.seqs, list(f.seqs))
+        self.assertEqual("CCCCGGGG", f["seq3"])
+        self.assertEqual(["ACGT", "CCCCGGGG"], list(f[1:].seqs))
+        
+        # sequences are read when the Fasta object is changed
+        f["seq4"] = "TTTT"
+        del f["seq1"]
+        self.assertEqual(["seq2", "seq3", "seq4"], f.ids)
+        self.assertEqual(["ACGT", "CCCCGGGG", "TTTT"], f.seqs)
+        
+        # headers with '>', sequences are validated on access
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".fa") as tmp:
+            tmp.write(">a b>c\nACGT\n>d\n1234\n")
+            tmp.flush()
+            f = Fasta(tmp.name, lazy=True)
+            self.assertEqual(["a b>c", "d"], f.ids)
+            self.assertEqual(["a", "d"], Fasta(tmp.name, split_whitespace=True, lazy=True).ids)
+            self.assertEqual("ACGT", f["a b>c"])
+            with self.assertRaises(IOError):
+                f["d"]
+    
+    def test5_lookup(self):
+        """ Fasta lookup by id """
+        f = Fasta()
+        for i in range(1000):
+            f.add("seq{}".format(i), "A" * i)
+        self.assertEqual("A" * 500, f["seq500"])
+        self.assertTrue(f.has_key("seq999"))
+        self.assertIsNone(f["seq1000"])
+        
+        f["seq10"] = "C"
+        self.assertEqual("C", f["seq10"])
+        del f["seq0"]
+        self.assertEqual("A", f["seq1"])
+        self.assertFalse("seq0" in f)
+        
+        f.ids = ["new{}".format(i) for i in range(len(f))]
+        self.assertEqual("C", f["new9"])
+    
+    def test6_iter_fasta(self):
+        """ Stream FASTA records """
+        records = list(iter_fasta(self.fasta_file))
+        self.assertEqual(list(self.f.items()), records)
+
+    def test7_view(self):
+        """ Fasta views """
+        import pickle
+        f = Fasta()
+        for i in range(100):
+            f.add("seq{}".format(i), "A" * i)
+        
+        view = f[10:20]
+        self.assertTrue(isinstance(view, FastaView))
+        self.assertEqual(10, len(view))
+        self.assertEqual("A" * 12, view["seq12"])
+        self.assertIsNone(view["seq20"])
+        self.assertEqual(["seq14", "seq16"], view[4::2][:2].ids)
+        
+        sub = f.subset([5, -1, 3])
+        self.assertEqual(["seq5", "seq99", "seq3"], sub.ids)
+        self.assertEqual([5, 99, 3], list(sub.positions))
+        
+        # modifying the view does not change the parent
+        view["seq10"] = "C"
+        view.add("new", "G")
+        self.assertEqual("C", view["seq10"])
+        self.assertEqual(11, len(view))
+        self.assertEqual("A" * 10, f["seq10"])
+        self.assertEqual(100, len(f))
+        
+        f2 = pickle.loads(pickle.dumps(f[50:52]))
+        self.assertEqual(Fasta, type(f2))
+        self.assertEqual(["seq50", "seq51"], f2.ids)
+        self.assertEqual(["A" * 50, "A" * 51], f2.seqs)
+        
+        # modifying the parent does not change the view
+        sub = f[:2]
+        del f["seq0"]
+        f["seq1"] = "TTTT"
+        self.assertEqual(["seq0", "seq1"], sub.ids)
+        self.assertEqual("A", sub["seq1"])
+        f.add("seq0", "C")
+        
+        # views of views, changed after creation
+        view = f[10:20]
+        view2 = view[2:4]
+        view["seq13"] = "G"
+        self.assertEqual(["seq13", "seq14"], view2.ids)
+        self.assertEqual("A" * 13, view2["seq13"])
+        self.assertEqual("A" * 13, f["seq13"])
+        self.assertEqual([2, 3], list(view2.positions))
+        
+        sample, rest = f.split(30)
+        self.assertEqual(30, len(sample))
+        self.assertEqual(70, len(rest))
+        self.assertEqual(sorted(f.ids), sorted(sample.ids + rest.ids))
+        self.assertEqual(sample.ids, [x for x in f.ids if x in sample])
+        
+        self.assertEqual(5, len(set(f.get_random(5).ids)))
+
     def tearDown(self):
             pass
 
@@ -2,8 +2,11 @@ import unittest
 import tempfile
 import os
 import glob
+import shutil
 from shutil import rmtree
 from gimmemotifs.genome_index import *
+from gimmemotifs.fasta import Fasta
+from genomepy import Genome
 
 class TestGenomeIndex(unittest.TestCase):
     """ A test class for GenomeIndex class """
@@ -114,6 +117,105 @@ class TestGenomeIndex(unittest.TestCase):
 #        for d in fadir, index_dir:
 #            rmtree(d)
 #    
+    def _write_chroms(self, line_size=7):
+        """ write the test genome as one FASTA file per sequence """
+        fasta_dir = tempfile.mkdtemp()
+        f = Fasta(os.path.join(self.fasta_dir, "genome", "genome.fa"))
+        for name, seq in f.items():
+            with open(os.path.join(fasta_dir, name + ".fa"), "w") as out:
+                out.write(">{}\n".format(name))
+                for i in range(0, len(seq), line_size):
+                    out.write(seq[i:i + line_size] + "\n")
+        return f, fasta_dir
+
+    def test_mapped_get_sequence(self):
+        """ get_sequence retrieves sequences from the memory-mapped genome """
+        f, fasta_dir = self._write_chroms()
+        self.g.create_index(fasta_dir, self.index_dir)
+        g = GenomeIndex(self.index_dir)
+        self.assertEqual(g.get_sequence("chr1", 0, 4), "AAAA")
+        self.assertEqual(g.get_sequence("chr1", 2, 6), "AACC")
+        self.assertEqual(g.get_sequence("chr1", 0, 26), "AAAACCCCGGGGTTTTAAAACCCCGG")
+        self.assertEqual(g.get_sequence("chr1", 2, 6, "-"), "GGTT")
+        seq = f["chr2"]
+        for start, end in [(0, 1), (6, 7), (7, 8), (13, 100), (1234, 300000)]:
+            self.assertEqual(seq[start:end], g.get_sequence("chr2", start, end))
+        self.assertRaises(ValueError, g.get_sequence, "chr1", 0, 100)
+        self.assertRaises(ValueError, g.get_sequence, "chr1", -100, 3)
+
+        regions = [("chr2", 20, 30), ("chr1", 4, 8), ("chr1", 0, 4, "-")]
+        self.assertEqual(
+                [seq[20:30], "CCCC", "TTTT"], 
+                g.get_regions(regions))
+        rmtree(fasta_dir)
+
+    def test_create_fai_index(self):
+        """ create_index creates a faidx index of multi-sequence FASTA files """
+        fasta_dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(self.fasta_dir, "genome", "genome.fa"), fasta_dir)
+        self.g.create_index(fasta_dir, self.index_dir, ncpus=2)
+        
+        fai = os.path.join(self.index_dir, "genome.fa.fai")
+        with open(fai) as f_new:
+            with open(os.path.join(self.fasta_dir, "genome", "genome.fa.fai")) as f_ref:
+                self.assertEqual(f_ref.read(), f_new.read())
+        
+        g = GenomeIndex(self.index_dir)
+        self.assertEqual(["chr1", "chr2", "chr3"], sorted(g.get_chromosomes()))
+        self.assertEqual(300040, g.get_size())
+        self.assertEqual("TTTTGGGGCCCCAA", g.get_sequence("chr3", 0, 14))
+
+        # different line lengths can't be indexed
+        with open(os.path.join(fasta_dir, "invalid.fa"), "w") as f:
+            f.write(">seq1\nACGT\nAC\nACGT\n")
+        self.assertRaises(ValueError, self.g.create_index, fasta_dir, self.index_dir, 1)
+        rmtree(fasta_dir)
+
+    def test_mapped_genome_fai(self):
+        """ MappedGenome reads sequences using a faidx index """
+        fname = os.path.join(self.fasta_dir, "genome", "genome.fa")
+        f = Fasta(fname)
+        g = MappedGenome.from_fai(fname + ".fai")
+        self.assertEqual(sorted(f.ids), sorted(g.keys()))
+        for name, seq in f.items():
+            self.assertEqual(len(seq), g.size(name))
+            self.assertEqual(seq, g.get_seq(name, 0, len(seq)))
+        self.assertEqual(f["chr2"][299990:300000], g.get_seq("chr2", 299990, 300000))
+        
+        # sequences on one line are not copied
+        view = g.get_seq_bytes("chr1", 1, 3)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b"AA", view.tobytes())
+        self.assertEqual(b"AACC", g.get_seq_bytes("chr1", 2, 6))
+        # the file stays mapped as long as the view is used
+        g.close()
+        self.assertEqual(b"AA", view.tobytes())
+
+    def test_regions_to_fasta(self):
+        """ regions_to_fasta gives the same result as track2fasta """
+        fname = os.path.join(self.fasta_dir, "genome", "genome.fa")
+        bedfile = os.path.join(self.index_dir, "regions.bed")
+        with open(bedfile, "w") as f:
+            f.write("chr2\t100\t200\tpeak1\t0\t-\n")
+            f.write("chr2\t60\t70\n")
+            f.write("chr2\t1000\t2000\tgene\t0\t-\t1000\t2000\t0\t2\t10,20,\t0,500,\n")
+        
+        g = Genome(fname)
+        for kwargs in [{}, {"stranded":True, "extend_up":5, "extend_down":3}]:
+            ref = g.track2fasta(bedfile, **kwargs)
+            result = regions_to_fasta(fname, bedfile, **kwargs)
+            self.assertEqual([seq.name for seq in ref], result.ids)
+            self.assertEqual([seq.seq for seq in ref], result.seqs)
+        
+        result = regions_to_fasta(g, ["chr1:0-4", "chr1:4-8"])
+        self.assertEqual(["chr1:0-4", "chr1:4-8"], result.ids)
+        self.assertEqual(["AAAA", "CCCC"], result.seqs)
+        
+        regions = [("chr1", 4, 8), ("chr1", 0, 4, "-")]
+        self.assertEqual(["CCCC", "TTTT"], fetch_sequences(fname, regions))
+        result = regions_to_fasta(fname, regions, stranded=True)
+        self.assertEqual(["CCCC", "TTTT"], result.seqs)
+
     def tearDown(self):
         for file in os.listdir(self.index_dir):
             os.remove(os.path.join(self.index_dir, file))
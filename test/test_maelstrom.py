@@ -6,9 +6,13 @@ from shutil import rmtree
 import pandas as pd
 
 from gimmemotifs.config import MotifConfig
-from gimmemotifs.maelstrom import run_maelstrom
+from gimmemotifs.maelstrom import run_maelstrom, run_methods
 from gimmemotifs.genome_index import get_genome,check_genome,GenomeIndex
 
+def _write_ncpus(fname, ncpus=None):
+    with open(fname, "w") as f:
+        f.write(str(ncpus))
+
 class TestMoap(unittest.TestCase):
     """ A test class to test maelstrom"""
 
@@ -43,6 +47,25 @@ class TestMoap(unittest.TestCase):
         #    os.unlink(fname)
         #os.unlink(self.outfile)
 
+    def test2_run_methods(self):
+        """ Run methods in parallel """
+        tmpdir = tempfile.mkdtemp()
+        fnames = [os.path.join(tmpdir, str(i)) for i in range(4)]
+        method_ncpus = [4, 1, None, 10]
+        jobs = [("m{}".format(i), "score", _write_ncpus, (fname,), {}, n) 
+                for i, (fname, n) in enumerate(zip(fnames, method_ncpus))]
+        run_methods(jobs, ncpus=6)
+        for fname, n in zip(fnames, ["4", "1", "6", "6"]):
+            with open(fname) as f:
+                self.assertEqual(n, f.read())
+        
+        # A method that fails
+        jobs.append(("fail", "score", _write_ncpus, 
+            (os.path.join(tmpdir, "nodir", "file"),), {}, 1))
+        with self.assertRaises(RuntimeError):
+            run_methods(jobs, ncpus=2)
+        rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -2,7 +2,7 @@ import unittest
 import tempfile
 import os
 from gimmemotifs.c_metrics import *
-from gimmemotifs.rocmetrics import pr_auc
+from gimmemotifs.rocmetrics import pr_auc, roc_auc_xlim
 
 class TestMetrics(unittest.TestCase):
     """ A test class for column comparison metrics (metric.py) """
@@ -34,6 +34,14 @@ class TestMetrics(unittest.TestCase):
         result = pr_auc(fg_values, bg_values)
         self.assertAlmostEqual(result, expect, 4)
     
+    def test_roc_auc_xlim(self):
+        """ Test ROC AUC until FPR value """
+        fg_values = [4,5,3,6,5]
+        bg_values = [1,3,5,0,1,1,3,2]
+        for xlim, expect in [(0.1, 0.036), (0.5, 0.4), (1.0, 0.9)]:
+            result = roc_auc_xlim(fg_values, bg_values, xlim=xlim)
+            self.assertAlmostEqual(result, expect, 10)
+    
     
     def tearDown(self):
         pass
@@ -1,7 +1,10 @@
 import unittest
 import tempfile
 import os
-from gimmemotifs.moap import moap
+import numpy as np
+from scipy.stats import mannwhitneyu
+import pandas as pd
+from gimmemotifs.moap import moap, _mwu_pvalues, read_motif_table, write_motif_table
 
 class TestMoap(unittest.TestCase):
     """ A test class to test Moap functionality"""
@@ -54,6 +57,41 @@ class TestMoap(unittest.TestCase):
                     )
             self.assertEquals((623, 2), df.shape)
 
+    def test3_mwu_pvalues(self):
+        """ Test Mann-Whitney U p-values for all motifs at once """
+        np.random.seed(1)
+        X = np.round(np.random.randn(200, 5), 1)
+        clusters = np.random.randint(0, 3, 200)
+        y = np.array([clusters == c for c in range(3)], dtype=float).T
+        
+        pvals = _mwu_pvalues(X, y)
+        self.assertEqual((3, 5), pvals.shape)
+        for c in range(3):
+            for m in range(5):
+                p = mannwhitneyu(X[clusters == c, m], X[clusters != c, m], 
+                        alternative="greater")[1]
+                self.assertAlmostEqual(p, pvals[c, m])
+
+    def test4_binary_motif_table(self):
+        """ Test motif activity prediction with binary motif tables """
+        tmpdir = tempfile.mkdtemp()
+        counts = read_motif_table(self.motifs_count2)
+        fname = os.path.join(tmpdir, "motif.count.npy")
+        write_motif_table(counts.astype(np.int32), fname)
+        
+        df = read_motif_table(fname)
+        # memory-mapped, read-only
+        self.assertFalse(df.values.flags.writeable)
+        self.assertEqual(list(counts.index), list(df.index))
+        self.assertEqual(list(counts.columns), list(df.columns))
+        self.assertTrue((counts.values == df.values).all())
+
+        df1 = moap(self.clusters2, method="hypergeom", scoring="count",
+                motiffile=self.motifs_count2)
+        df2 = moap(self.clusters2, method="hypergeom", scoring="count",
+                motiffile=fname)
+        self.assertTrue(np.allclose(df1.values, df2.values))
+
 if __name__ == '__main__':
     unittest.main()
 
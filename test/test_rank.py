@@ -1,8 +1,9 @@
 import unittest
 import tempfile
 import os
+import numpy as np
 import pandas as pd
-from gimmemotifs.rank import rankagg
+from gimmemotifs.rank import rankagg, qStuart, qStuart_matrix
 
 class TestRank(unittest.TestCase):
     """ A test class to test rank aggregation """
@@ -27,6 +28,34 @@ class TestRank(unittest.TestCase):
         for v1, v2 in zip(ref, result):
             self.assertAlmostEqual(v1, v2)
 
+    def test3_qstuart_matrix(self):
+        """ Test Stuart's q for all rows at once """
+        np.random.seed(1)
+        rmat = np.sort(np.random.random((20, 6)), 1)
+        result = qStuart_matrix(rmat)
+        for row, q in zip(rmat, result):
+            self.assertAlmostEqual(qStuart(pd.Series(row)), q)
+
+    def test4_rankagg_rra(self):
+        """ Test rank aggregation with RRA rho score """
+        df = pd.read_table(self.rank_in, index_col=0)
+        ref = rankagg(df)
+        for exact in [False, True]:
+            result = rankagg(df, method="rra", exact=exact)
+            self.assertEqual(ref.shape, result.shape)
+            self.assertEqual(ref.index[0], result.index[0])
+            self.assertTrue(((result >= 0) & (result <= 1)).all())
+        
+        # exact correction is less conservative
+        approx = rankagg(df, method="rra")
+        exact = rankagg(df, method="rra", exact=True)
+        self.assertTrue((exact.loc[approx.index] <= approx + 1e-12).all())
+
+    def test5_rankagg_missing(self):
+        """ Test rank aggregation with missing items """
+        df = pd.DataFrame({"a": ["x", "y", "z"], "b": ["z", "y", "w"]})
+        with self.assertRaises(ValueError):
+            rankagg(df)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,12 @@
 import unittest
 import tempfile
 import os
-from gimmemotifs.stats import calc_stats
+from gimmemotifs.stats import calc_stats, calc_background_stats, calc_stats_from_arrays
+from gimmemotifs.scanner import scan_to_best_match_arrays
 from gimmemotifs.motif import read_motifs
 from time import sleep
+import numpy as np
+from gimmemotifs import rocmetrics
 
 class TestStats(unittest.TestCase):
     """ A test class to test motif stats """
@@ -74,6 +77,110 @@ class TestStats(unittest.TestCase):
         stats = calc_stats(motif, self.fg_fa, self.bg_fa, stats=["roc_auc"])
         self.assertGreater(stats[m_id]["roc_auc"] , 0.9)
     
+    def test3_matrix_metrics(self):
+        """ Calculate metrics for all motifs at once """
+        np.random.seed(42)
+        # Rounded values to get ties
+        fg = np.round(np.random.randn(4, 50) * 4 + 2) / 2
+        bg = np.round(np.random.randn(4, 300) * 4) / 2
+
+        result = rocmetrics.matrix_metrics(fg, bg)
+        for s in rocmetrics.MATRIX_METRICS:
+            func = getattr(rocmetrics, s)
+            for i in range(len(fg)):
+                if s == "roc_auc_xlim":
+                    expect = func(list(fg[i]), list(bg[i]))
+                else:
+                    expect = func(fg[i], bg[i])
+                self.assertAlmostEqual(expect, result[s][i], 10)
+
+        # Mix of score-based and position-based metrics
+        stats = ["roc_auc", "mncp", "ks_pvalue"]
+        result = calc_stats(self.motifs, self.fg_fa, self.bg_fa, stats=stats)
+        for m in result:
+            self.assertEqual(set(stats), set(result[m].keys()))
+    
+    def test4_roc_auc_matrix(self):
+        """ Calculate ROC AUC for all motifs at once """
+        np.random.seed(1)
+        fg = np.round(np.random.randn(10, 100) + 0.5, 1)
+        bg = np.round(np.random.randn(10, 1000), 1)
+        
+        result = rocmetrics.roc_auc_matrix(fg, bg)
+        self.assertEqual((10,), result.shape)
+        for i in range(len(fg)):
+            self.assertAlmostEqual(rocmetrics.roc_auc(fg[i], bg[i]), result[i])
+    
+    def test5_approximate_stats(self):
+        """ Approximate motif statistics from score histograms """
+        stats = ["roc_auc", "pr_auc", "recall_at_fdr", "enr_at_fpr"]
+        exact = calc_stats(self.motifs, self.fg_fa, self.bg_fa, stats=stats)
+        approx = calc_stats(self.motifs, self.fg_fa, self.bg_fa, stats=stats,
+                approximate=True, nbins=1000)
+        
+        for m in exact:
+            self.assertIn("roc_auc_error", approx[m])
+            self.assertLessEqual(
+                    abs(exact[m]["roc_auc"] - approx[m]["roc_auc"]),
+                    approx[m]["roc_auc_error"])
+            self.assertAlmostEqual(exact[m]["pr_auc"], approx[m]["pr_auc"], 2)
+            self.assertAlmostEqual(exact[m]["recall_at_fdr"], approx[m]["recall_at_fdr"], 2)
+        
+        with self.assertRaises(ValueError):
+            calc_stats(self.motifs, self.fg_fa, self.bg_fa, 
+                    stats=["ks_pvalue"], approximate=True)
+
+    def test6_background_stats(self):
+        """ Calculate motif statistics for multiple backgrounds """
+        stats = ["roc_auc", "ks_pvalue"]
+        background = {"random":self.bg_fa, "p73":self.fg_fa}
+        result = calc_background_stats(self.motifs, self.fg_fa, background, 
+                stats=stats, ncpus=1)
+        
+        self.assertEqual(2, len(result))
+        for bg, bg_fa in background.items():
+            single = calc_stats(self.motifs, self.fg_fa, bg_fa, stats=stats, ncpus=1)
+            for m in single:
+                self.assertEqual(single[m], result[m][bg])
+        
+        m_id = "p53_Average_8_CATGyCnGGrCATGy"
+        self.assertEqual(0.5, result[m_id]["p73"]["roc_auc"])
+
+    def test7_stats_from_arrays(self):
+        """ Calculate motif statistics from scan arrays """
+        motifs = read_motifs(self.motifs, fmt="pwm")
+        fg_scores, fg_pos, fg_strands = scan_to_best_match_arrays(
+                self.fg_fa, motifs, ncpus=1)
+        bg_scores, bg_pos, _ = scan_to_best_match_arrays(
+                self.bg_fa, motifs, ncpus=1)
+        
+        self.assertEqual((2, 100), fg_scores.shape)
+        self.assertEqual(fg_scores.shape, fg_pos.shape)
+        self.assertEqual(set([-1, 1]), set(fg_strands.flatten()))
+
+        # Compare to the metrics of every single motif, using scores with 
+        # ties
+        rng = np.random.RandomState(42)
+        fg_scores = np.round(rng.normal(1, 1, (2, 100)), 1)
+        bg_scores = np.round(rng.normal(0, 1, (2, 300)), 1)
+        fg_pos = rng.randint(0, 50, (2, 100))
+        bg_pos = rng.randint(0, 190, (2, 300))
+        result = calc_stats_from_arrays(motifs, fg_scores, bg_scores, 
+                fg_pos, bg_pos, ncpus=1)
+        for i, motif in enumerate(motifs):
+            for s in rocmetrics.__all__:
+                func = getattr(rocmetrics, s)
+                if func.input_type == "pos":
+                    expect = func(fg_pos[i], bg_pos[i])
+                else:
+                    expect = func(fg_scores[i], bg_scores[i])
+                self.assertAlmostEqual(expect, result[str(motif)][s])
+
+        # Positions are needed for the position-based metrics
+        with self.assertRaises(ValueError):
+            calc_stats_from_arrays(motifs, fg_scores, bg_scores, 
+                    stats=["ks_pvalue"], ncpus=1)
+
     def tearDown(self):
         pass
 
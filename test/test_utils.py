@@ -2,11 +2,27 @@ import unittest
 import tempfile
 import os
 import glob
+import gzip
+import struct
+import zlib
 from gimmemotifs.utils import *
 from gimmemotifs.fasta import Fasta
 from genomepy import Genome
 from tempfile import mkdtemp
 from shutil import rmtree
+from gimmemotifs.shutils import open_file, is_bgzipped
+
+def write_bgzf(fname, data, block_size=1000):
+    """ Write data to a blocked gzip file, as bgzip does """
+    with open(fname, "wb") as out:
+        for i in list(range(0, len(data), block_size)) + [len(data)]:
+            chunk = data[i:i + block_size]
+            c = zlib.compressobj(6, zlib.DEFLATED, -15)
+            payload = c.compress(chunk) + c.flush()
+            out.write(b"\x1f\x8b\x08\x04" + b"\x00" * 4 + b"\x00\xff")
+            out.write(struct.pack("<HBBHH", 6, 66, 67, 2, len(payload) + 25))
+            out.write(payload)
+            out.write(struct.pack("<II", zlib.crc32(chunk) & 0xffffffff, len(chunk)))
 
 class TestUtils(unittest.TestCase):
     """ A test class to test utils functions """
@@ -76,6 +92,93 @@ class TestUtils(unittest.TestCase):
             ftype = os.path.basename(fname).split(".")[0]
             self.assertEqual(ftype, determine_file_type(fname))
 
+    def test_number_of_seqs(self):
+        """ count sequences and regions in a file """
+        for fname in glob.glob("test/data/filetype/*"):
+            ftype = os.path.basename(fname).split(".")[0]
+            if ftype == "unknown":
+                continue
+            if ftype == "fasta":
+                n = len(Fasta(fname))
+            else:
+                with open(fname) as f:
+                    n = len(f.readlines())
+            self.assertEqual(n, number_of_seqs_in_file(fname))
+        
+        # the result changes with the file
+        tmpdir = mkdtemp()
+        fname = os.path.join(tmpdir, "test.txt")
+        with open(fname, "w") as f:
+            f.write("track name=test\nchr1\t10\t20\n")
+        self.assertEqual("bed", determine_file_type(fname))
+        self.assertEqual(1, number_of_seqs_in_file(fname))
+        with open(fname, "w") as f:
+            f.write(">seq1\nACGT\n>seq2\n\n>seq3\nAC\nGT\n")
+        self.assertEqual("fasta", determine_file_type(fname))
+        self.assertEqual(3, number_of_seqs_in_file(fname))
+        # the first sequence is empty
+        with open(fname, "w") as f:
+            f.write(">a\n>b\nACGT\n")
+        self.assertEqual("fasta", determine_file_type(fname))
+        self.assertEqual(2, number_of_seqs_in_file(fname))
+        rmtree(tmpdir)
+
+    def test_compressed_input(self):
+        """ read gzip and bgzip compressed input """
+        tmpdir = mkdtemp()
+        for fname in glob.glob("test/data/filetype/*") + [os.path.join(self.datadir, "test.bed")]:
+            with open(fname, "rb") as f:
+                data = f.read()
+            gz = os.path.join(tmpdir, os.path.basename(fname) + ".gz")
+            with gzip.open(gz, "wb") as f:
+                f.write(data)
+            bgz = os.path.join(tmpdir, os.path.basename(fname) + ".bgz")
+            write_bgzf(bgz, data, block_size=100)
+            self.assertTrue(is_bgzipped(bgz))
+            self.assertFalse(is_bgzipped(gz))
+
+            for compressed in [gz, bgz]:
+                with open_file(compressed) as f:
+                    self.assertEqual(data.decode(), f.read())
+                self.assertEqual(
+                        determine_file_type(fname), 
+                        determine_file_type(compressed))
+        
+        # sequences from compressed BED and FASTA files
+        g = Genome("genome", genome_dir=self.genome_dir)
+        bedfile = os.path.join(self.datadir, "test.bed")
+        for compressed in [bedfile + ".gz", bedfile + ".bgz"]:
+            compressed = os.path.join(tmpdir, os.path.basename(compressed))
+            self.assertEqual(as_fasta(bedfile, g).seqs, as_fasta(compressed, g).seqs)
+        
+        fafile = os.path.join(self.datadir, "test.fa")
+        bgz = os.path.join(tmpdir, "test.fa.bgz")
+        with open(fafile, "rb") as f:
+            write_bgzf(bgz, f.read())
+        self.assertEqual(Fasta(fafile).seqs, Fasta(bgz).seqs)
+        self.assertEqual(len(Fasta(fafile)), number_of_seqs_in_file(bgz))
+        
+        # truncated and corrupted files raise an error
+        with open(bgz, "rb") as f:
+            data = f.read()
+        broken = os.path.join(tmpdir, "broken.fa.bgz")
+        for size in [len(data) - 30, len(data) - 5, 20]:
+            with open(broken, "wb") as f:
+                f.write(data[:size])
+            with self.assertRaises(IOError):
+                Fasta(broken)
+        # change the size or the CRC32 at the end of the first block
+        first_block = struct.unpack("<H", data[16:18])[0] + 1
+        for pos in [first_block - 1, first_block - 5]:
+            corrupt = bytearray(data)
+            corrupt[pos] ^= 1
+            with open(broken, "wb") as f:
+                f.write(bytes(corrupt))
+            with self.assertRaises(IOError):
+                Fasta(broken)
+        
+        rmtree(tmpdir)
+
     def tearDown(self):
         pass
 